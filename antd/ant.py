@@ -80,6 +80,10 @@ CHANNEL_STATUS_UNASSIGNED = 0
 CHANNEL_STATUS_ASSIGNED = 1
 CHANNEL_STATUS_SEARCHING = 2
 CHANNEL_STATUS_TRACKING = 3
+# lib config, flagged extended data (AP2)
+LIB_CONFIG_CHANNEL_ID = 0x80
+LIB_CONFIG_RSSI = 0x40
+LIB_CONFIG_TIMESTAMP = 0x20
 
 class AntError(Exception):
     """
@@ -299,8 +303,8 @@ def message(direction, name, id, pack_format, arg_names, retry_policy=default_re
 
         @classmethod
         def unpack_args(cls, packed_args):
-            try: return Message(*msg_struct.unpack(packed_args))
-            except AttributeError: return Message(*([None] * len(arg_names)))
+            try: return cls(*msg_struct.unpack(packed_args))
+            except AttributeError: return cls(*([None] * len(arg_names)))
 
         def pack_args(self):
             try: return msg_struct.pack(*self.args)
@@ -324,6 +328,27 @@ def message(direction, name, id, pack_format, arg_names, retry_policy=default_re
 
     return Message
 
+def data_message(direction, name, id):
+    """
+    Return a class for a data message (broadcast,
+    acknowledged, or burst.) When enabled with LibConfig
+    (AP2 only) data may be followed by flagged extended
+    data. The channel id of the sender is saved in
+    extended_data, data is always the 8 byte payload.
+    """
+    class DataMessage(message(direction, name, id, "B8s", ["channel_number", "data"])):
+
+        extended_data = ""
+
+        @classmethod
+        def unpack_args(cls, packed_args):
+            msg = super(DataMessage, cls).unpack_args(packed_args[:9])
+            if len(packed_args) >= 14 and ord(packed_args[9]) & LIB_CONFIG_CHANNEL_ID:
+                msg.extended_data = packed_args[9:14]
+            return msg
+
+    return DataMessage
+
 # ANT Message Protocol Definitions
 UnassignChannel = message(DIR_OUT, "UNASSIGN_CHANNEL", 0x41, "B", ["channel_number"], retry_policy=timeout_retry_policy)
 AssignChannel = message(DIR_OUT, "ASSIGN_CHANNEL", 0x42, "BBB", ["channel_number", "channel_type", "network_number"], retry_policy=timeout_retry_policy)
@@ -337,14 +362,15 @@ OpenChannel = message(DIR_OUT, "OPEN_CHANNEL", 0x4b, "B", ["channel_number"], re
 CloseChannel = message(DIR_OUT, "CLOSE_CHANNEL", 0x4c, "B", ["channel_number"], retry_policy=timeout_retry_policy, matcher=close_channel_matcher, validator=close_channel_validator)
 RequestMessage = message(DIR_OUT, "REQUEST_MESSAGE", 0x4d, "BB", ["channel_number", "msg_id"], retry_policy=timeout_retry_policy, matcher=request_message_matcher)
 SetSearchWaveform = message(DIR_OUT, "SET_SEARCH_WAVEFORM", 0x49, "BH", ["channel_number", "waveform"], retry_policy=timeout_retry_policy)
+LibConfig = message(DIR_OUT, "LIB_CONFIG", 0x6e, "xB", ["lib_config"], retry_policy=timeout_retry_policy)
 SendBroadcastData = message(DIR_OUT, "SEND_BROADCAST_DATA", 0x4e, "B8s", ["channel_number", "data"], matcher=send_data_matcher, validator=send_data_validator)
 SendAcknowledgedData = message(DIR_OUT, "SEND_ACKNOWLEDGED_DATA", 0x4f, "B8s", ["channel_number", "data"], retry_policy=wait_and_retry_policy, matcher=send_data_matcher, validator=send_data_validator)
 SendBurstTransferPacket = message(DIR_OUT, "SEND_BURST_TRANSFER_PACKET", 0x50, "B8s", ["channel_number", "data"], retry_policy=wait_and_retry_policy, matcher=send_data_matcher, validator=send_data_validator)
 StartupMessage = message(DIR_IN, "STARTUP_MESSAGE", 0x6f, "B", ["startup_message"])
 SerialError = message(DIR_IN, "SERIAL_ERROR", 0xae, None, ["error_number", "msg_contents"])
-RecvBroadcastData = message(DIR_IN, "RECV_BROADCAST_DATA", 0x4e, "B8s", ["channel_number", "data"])
-RecvAcknowledgedData = message(DIR_IN, "RECV_ACKNOWLEDGED_DATA", 0x4f, "B8s", ["channel_number", "data"])
-RecvBurstTransferPacket = message(DIR_IN, "RECV_BURST_TRANSFER_PACKET", 0x50, "B8s", ["channel_number", "data"])
+RecvBroadcastData = data_message(DIR_IN, "RECV_BROADCAST_DATA", 0x4e)
+RecvAcknowledgedData = data_message(DIR_IN, "RECV_ACKNOWLEDGED_DATA", 0x4f)
+RecvBurstTransferPacket = data_message(DIR_IN, "RECV_BURST_TRANSFER_PACKET", 0x50)
 ChannelEvent = message(DIR_IN, "CHANNEL_EVENT", 0x40, "BBB", ["channel_number", "msg_id", "msg_code"])
 ChannelStatus = message(DIR_IN, "CHANNEL_STATUS", 0x52, "BB", ["channel_number", "channel_status"])
 ChannelId = message(DIR_IN, "CHANNEL_ID", 0x51, "BHBB", ["channel_number", "device_number", "device_type_id", "man_id"])
@@ -364,7 +390,7 @@ class Capabilities(message(DIR_IN, "CAPABILITIES", 0x54, "BBBB", ["max_channels"
 
 ALL_ANT_COMMANDS = [ UnassignChannel, AssignChannel, SetChannelId, SetChannelPeriod, SetChannelSearchTimeout,
                      SetChannelRfFreq, SetNetworkKey, ResetSystem, OpenChannel, CloseChannel, RequestMessage,
-                     SetSearchWaveform, SendBroadcastData, SendAcknowledgedData, SendBurstTransferPacket,
+                     SetSearchWaveform, LibConfig, SendBroadcastData, SendAcknowledgedData, SendBurstTransferPacket,
                      StartupMessage, SerialError, RecvBroadcastData, RecvAcknowledgedData, RecvBurstTransferPacket,
                      ChannelEvent, ChannelStatus, ChannelId, AntVersion, Capabilities, SerialNumber ]
 
@@ -612,6 +638,14 @@ class Session(object):
         """
         return self._send(RequestMessage(0, AntVersion.ID))
 
+    def set_lib_config(self, lib_config):
+        """
+        Enable flagged extended data on received data
+        messages (AP2 only). e.g. LIB_CONFIG_CHANNEL_ID
+        to receive the channel id of each message's sender.
+        """
+        return self._send(LibConfig(lib_config))
+
     def get_serial_number(self):
         """
         Return SN# of and device. 9.5.7.5
@@ -892,9 +926,15 @@ class Channel(object):
         data = data_tostring(data)
         self._session._send(SendBurstData(self.channel_number, data), timeout=timeout, retry=retry)
 
-    def recv_broadcast(self, timeout=None):
+    def recv_broadcast(self, timeout=None, extended=False):
+        """
+        Return the next broadcast data. If extended is true,
+        flagged extended data is appended (if the ANT
+        hardware is configured to provided it.)
+        """
         if timeout is None: timeout = self._session.default_read_timeout
-        return self._session._send(ReadData(self.channel_number, RecvBroadcastData), timeout=timeout).data
+        msg = self._session._send(ReadData(self.channel_number, RecvBroadcastData), timeout=timeout)
+        return msg.data + msg.extended_data if extended else msg.data
 
     def recv_acknowledged(self, timeout=None):
         if timeout is None: timeout = self._session.default_read_timeout
@@ -36,6 +36,9 @@ import os
 import socket
 import binascii
 import ConfigParser
+import sqlite3
+import contextlib
+import threading
 
 import antd.ant as ant
 
@@ -45,12 +48,52 @@ ANTFS_HOST_ID = os.getpid() & 0xFFFFFFFF
 ANTFS_HOST_NAME = socket.gethostname()[:8]
 
 
+class AntFsError(ant.AntError):
+    """
+    The client rejected an ANT-FS file system request,
+    or returned data which failed CRC validation.
+    """
+
+
+def _crc16_table():
+    table = []
+    for byte in range(0, 256):
+        crc = byte
+        for bit in range(0, 8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+_CRC16_TABLE = _crc16_table()
+
+def crc16(data, crc=0):
+    """
+    CRC-16 used by ANT-FS file transfers (same as FIT).
+    Pass the CRC of preceding data as crc to continue
+    a running checksum.
+    """
+    table = _CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ ord(byte)) & 0xFF]
+    return crc
+
+def pad(data, size=8):
+    """
+    Pad data with zeros to a multiple of size.
+    """
+    return data + "\x00" * (-len(data) % size)
+
+
 class Beacon(object):
 
     DATA_PAGE_ID = 0x43
     STATE_LINK, STATE_AUTH, STATE_TRANSPORT, STATE_BUSY = range(0,4)
 
     __struct = struct.Struct("<BBBBI")
+    __ext_struct = struct.Struct("<BHBB")
+
+    # only known if broadcast included extended data
+    device_number = None
 
     @classmethod
     def unpack(cls, msg):
@@ -62,7 +105,12 @@ class Beacon(object):
             result.upload_enabled = 0x10 & result.status_1
             result.data_available = 0x20 & result.status_1
             result.device_state = 0x0f & result.status_2
-            result.data = msg[8:]
+            if len(msg) == 8 + cls.__ext_struct.size and ord(msg[8]) & ant.LIB_CONFIG_CHANNEL_ID:
+                # broadcast with flagged extended data, includes channel id of device
+                flag, result.device_number, result.device_type_id, result.trans_type = cls.__ext_struct.unpack(msg[8:])
+                result.data = ""
+            else:
+                result.data = msg[8:]
             return result
 
     def __str__(self):
@@ -73,6 +121,7 @@ class Command(object):
 
     DATA_PAGE_ID = 0x44
     LINK, DISCONNECT, AUTH, PING, DIRECT = 0x02, 0x03, 0x04, 0x05, 0x0D
+    DOWNLOAD, UPLOAD, ERASE, UPLOAD_DATA = 0x09, 0x0A, 0x0B, 0x0C
 
     __struct = struct.Struct("<BB6x")
 
@@ -174,7 +223,256 @@ class GarminSendDirect(Command):
             return direct
 
 
+class Download(Command):
+    """
+    ANT-FS download request. Data is returned starting
+    from offset, crc_seed must be CRC of the file's
+    data preceding offset.
+    """
+
+    COMMAND_ID = Command.DOWNLOAD
+
+    __struct = struct.Struct("<BBHIxBHI")
+
+    def __init__(self, index=0, offset=0, initial=True, crc_seed=0, max_block_size=0):
+        self.index = index
+        self.offset = offset
+        self.initial = initial
+        self.crc_seed = crc_seed
+        self.max_block_size = max_block_size
+
+    def pack(self):
+        return self.__struct.pack(self.DATA_PAGE_ID, self.COMMAND_ID, self.index, self.offset,
+                                  1 if self.initial else 0, self.crc_seed, self.max_block_size)
+
+    @classmethod
+    def unpack(cls, msg):
+        download = super(Download, cls).unpack(msg)
+        if download and download.command_id == Download.COMMAND_ID:
+            (data_page_id, command_id, download.index, download.offset,
+             download.initial, download.crc_seed, download.max_block_size) = cls.__struct.unpack(download.beacon.data[:16])
+            return download
+
+
+class DownloadResponse(Command):
+
+    COMMAND_ID = Command.DOWNLOAD | 0x80
+    RESPONSE_OK, RESPONSE_NOT_EXIST, RESPONSE_NOT_READABLE, RESPONSE_NOT_READY, \
+            RESPONSE_INVALID_REQUEST, RESPONSE_CRC_INCORRECT = range(0, 6)
+
+    __struct = struct.Struct("<BBBxIII")
+    __footer = struct.Struct("<6xH")
+
+    def __init__(self, response=RESPONSE_OK, data="", offset=0, file_size=0, crc=0):
+        self.response = response
+        self.data = data
+        self.offset = offset
+        self.file_size = file_size
+        self.crc = crc
+
+    def pack(self):
+        return (self.__struct.pack(self.DATA_PAGE_ID, self.COMMAND_ID, self.response,
+                                   len(self.data), self.offset, self.file_size)
+                + pad(self.data) + self.__footer.pack(self.crc))
+
+    @classmethod
+    def unpack(cls, msg):
+        response = super(DownloadResponse, cls).unpack(msg)
+        if response and response.command_id & 0x7F == Download.COMMAND_ID:
+            data = response.beacon.data
+            (data_page_id, command_id, response.response, remaining,
+             response.offset, response.file_size) = cls.__struct.unpack(data[:16])
+            response.data = data[16:16 + remaining]
+            (response.crc,) = cls.__footer.unpack(data[-8:])
+            return response
+
+
+class Upload(Command):
+
+    COMMAND_ID = Command.UPLOAD
+
+    __struct = struct.Struct("<BBHI4xI")
+
+    def __init__(self, index=0, max_size=0, offset=0):
+        self.index = index
+        self.max_size = max_size
+        self.offset = offset
+
+    def pack(self):
+        return self.__struct.pack(self.DATA_PAGE_ID, self.COMMAND_ID, self.index, self.max_size, self.offset)
+
+    @classmethod
+    def unpack(cls, msg):
+        upload = super(Upload, cls).unpack(msg)
+        if upload and upload.command_id == Upload.COMMAND_ID:
+            data_page_id, command_id, upload.index, upload.max_size, upload.offset = cls.__struct.unpack(upload.beacon.data[:16])
+            return upload
+
+
+class UploadResponse(Command):
+
+    COMMAND_ID = Command.UPLOAD | 0x80
+    RESPONSE_OK, RESPONSE_NOT_EXIST, RESPONSE_NOT_WRITEABLE, RESPONSE_NOT_ENOUGH_SPACE, \
+            RESPONSE_INVALID_REQUEST, RESPONSE_NOT_READY = range(0, 6)
+
+    __struct = struct.Struct("<BBBxIII6xH")
+
+    def __init__(self, response=RESPONSE_OK, last_offset=0, max_file_size=0, max_block_size=0, crc=0):
+        self.response = response
+        self.last_offset = last_offset
+        self.max_file_size = max_file_size
+        self.max_block_size = max_block_size
+        self.crc = crc
+
+    def pack(self):
+        return self.__struct.pack(self.DATA_PAGE_ID, self.COMMAND_ID, self.response, self.last_offset,
+                                  self.max_file_size, self.max_block_size, self.crc)
+
+    @classmethod
+    def unpack(cls, msg):
+        response = super(UploadResponse, cls).unpack(msg)
+        if response and response.command_id & 0x7F == Upload.COMMAND_ID:
+            (data_page_id, command_id, response.response, response.last_offset,
+             response.max_file_size, response.max_block_size, response.crc) = cls.__struct.unpack(response.beacon.data[:24])
+            return response
+
+
+class UploadData(Command):
+
+    COMMAND_ID = Command.UPLOAD_DATA
+
+    __struct = struct.Struct("<BBHI")
+    __footer = struct.Struct("<6xH")
+
+    def __init__(self, data="", offset=0, crc_seed=0):
+        self.data = data
+        self.offset = offset
+        self.crc_seed = crc_seed
+        self.crc = crc16(data, crc_seed)
+
+    def pack(self):
+        return (self.__struct.pack(self.DATA_PAGE_ID, self.COMMAND_ID, self.crc_seed, self.offset)
+                + pad(self.data) + self.__footer.pack(self.crc))
+
+    @classmethod
+    def unpack(cls, msg):
+        upload = super(UploadData, cls).unpack(msg)
+        if upload and upload.command_id == UploadData.COMMAND_ID:
+            data = upload.beacon.data
+            data_page_id, command_id, upload.crc_seed, upload.offset = cls.__struct.unpack(data[:8])
+            # data is padded, length is implied by the upload request
+            upload.data = data[8:-8]
+            (upload.crc,) = cls.__footer.unpack(data[-8:])
+            return upload
+
+
+class UploadDataResponse(Command):
+
+    COMMAND_ID = Command.UPLOAD_DATA | 0x80
+    RESPONSE_OK, RESPONSE_FAILED = range(0, 2)
+
+    __struct = struct.Struct("<BBB5x")
+
+    def __init__(self, response=RESPONSE_OK):
+        self.response = response
+
+    def pack(self):
+        return self.__struct.pack(self.DATA_PAGE_ID, self.COMMAND_ID, self.response)
+
+    @classmethod
+    def unpack(cls, msg):
+        response = super(UploadDataResponse, cls).unpack(msg)
+        if response and response.command_id & 0x7F == UploadData.COMMAND_ID:
+            data_page_id, command_id, response.response = cls.__struct.unpack(response.beacon.data[:8])
+            return response
+
+
+class Erase(Command):
+
+    COMMAND_ID = Command.ERASE
+
+    __struct = struct.Struct("<BBH4x")
+
+    def __init__(self, index=0):
+        self.index = index
+
+    def pack(self):
+        return self.__struct.pack(self.DATA_PAGE_ID, self.COMMAND_ID, self.index)
+
+    @classmethod
+    def unpack(cls, msg):
+        erase = super(Erase, cls).unpack(msg)
+        if erase and erase.command_id == Erase.COMMAND_ID:
+            data_page_id, command_id, erase.index = cls.__struct.unpack(erase.beacon.data[:8])
+            return erase
+
+
+class EraseResponse(Command):
+
+    COMMAND_ID = Command.ERASE | 0x80
+    RESPONSE_OK, RESPONSE_FAILED, RESPONSE_NOT_READY = range(0, 3)
+
+    __struct = struct.Struct("<BBB5x")
+
+    def __init__(self, response=RESPONSE_OK):
+        self.response = response
+
+    def pack(self):
+        return self.__struct.pack(self.DATA_PAGE_ID, self.COMMAND_ID, self.response)
+
+    @classmethod
+    def unpack(cls, msg):
+        response = super(EraseResponse, cls).unpack(msg)
+        if response and response.command_id & 0x7F == Erase.COMMAND_ID:
+            data_page_id, command_id, response.response = cls.__struct.unpack(response.beacon.data[:8])
+            return response
+
+
+class Directory(object):
+    """
+    The ANT-FS directory, file index 0 on the client.
+    """
+
+    FLAG_READ, FLAG_WRITE, FLAG_ERASE, FLAG_ARCHIVE, FLAG_APPEND, FLAG_CRYPTO = 0x80, 0x40, 0x20, 0x10, 0x08, 0x04
+
+    File = collections.namedtuple("File", ["index", "data_type", "sub_type", "file_number",
+                                           "data_flags", "flags", "size", "time"])
+
+    __struct = struct.Struct("<BBB5xII")
+    __file_struct = struct.Struct("<HBBHBBII")
+
+    def __init__(self, files=(), version=0x01, time_format=0, current_time=0, last_modified=0):
+        self.files = list(files)
+        self.version = version
+        self.time_format = time_format
+        self.current_time = current_time
+        self.last_modified = last_modified
+
+    def pack(self):
+        return (self.__struct.pack(self.version, self.__file_struct.size, self.time_format,
+                                   self.current_time, self.last_modified)
+                + "".join(self.__file_struct.pack(*f) for f in self.files))
+
+    @classmethod
+    def unpack(cls, data):
+        result = cls()
+        (result.version, entry_length, result.time_format,
+         result.current_time, result.last_modified) = cls.__struct.unpack_from(data)
+        result.files = [cls.File(*cls.__file_struct.unpack_from(data, offset))
+                        for offset in xrange(cls.__struct.size, len(data) - entry_length + 1, entry_length)]
+        return result
+
+    def __str__(self):
+        return self.__class__.__name__ + str(self.__dict__)
+
+
 class KnownDeviceDb(object):
+    """
+    Legacy ConfigParser based store of paired devices.
+    The whole file is rewritten on every change, so it
+    is not safe to share between processes. Only used
+    to import existing pairings into DeviceDb.
+    """
 
     def __init__(self, file = None):
         self.file = file
@@ -220,6 +518,144 @@ class KnownDeviceDb(object):
                 self.cfg.write(file)
 
 
+class DeviceDb(object):
+    """
+    sqlite backed store of paired devices. Each operation
+    runs in its own transaction, so any number of processes
+    can share the same file without overwriting each others
+    pairings. Devices are indexed by both their ANT-FS
+    device_id (serial number) and ANT device number, and
+    arbitrary per-device metadata (last sync time, link
+    parameters, model...) can be recorded with set_meta().
+    If legacy_file is provided, and the database has not
+    been initialized, pairings are imported from the old
+    KnownDeviceDb configuration file. The connection is
+    shared by threads of the process (e.g. SyncScheduler
+    and main loop), access to it is serialized by a lock.
+    """
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, file=":memory:", legacy_file=None, timeout=30):
+        self.file = file
+        # transactions are managed explicitly (see _transaction)
+        self.conn = sqlite3.connect(file, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.conn.text_factory = str
+        self.lock = threading.RLock()
+        with self._transaction() as conn:
+            (version,) = conn.execute("PRAGMA user_version").fetchone()
+            if version < self.SCHEMA_VERSION:
+                conn.execute("CREATE TABLE IF NOT EXISTS device (device_id INTEGER PRIMARY KEY, device_number INTEGER, key TEXT)")
+                conn.execute("CREATE INDEX IF NOT EXISTS device_number_idx ON device (device_number)")
+                conn.execute("CREATE TABLE IF NOT EXISTS device_meta (device_id INTEGER, name TEXT, value, PRIMARY KEY (device_id, name))")
+                if legacy_file and os.path.isfile(legacy_file):
+                    self._import_cfg(conn, legacy_file)
+                conn.execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def get_key(self, device_id):
+        row = self._query_one("SELECT key FROM device WHERE device_id = ?", (device_id,))
+        if row and row[0]: return binascii.unhexlify(row[0])
+
+    def add_key(self, device_id, key):
+        with self._transaction() as conn:
+            self._add_device(conn, device_id)
+            conn.execute("UPDATE device SET key = ? WHERE device_id = ?", (key.encode("hex"), device_id))
+
+    def get_device_id(self, ant_device_number):
+        row = self._query_one("SELECT device_id FROM device WHERE device_number = ?", (ant_device_number,))
+        if row: return row[0]
+
+    def get_device_number(self, device_id):
+        row = self._query_one("SELECT device_number FROM device WHERE device_id = ?", (device_id,))
+        if row: return row[0]
+
+    def add_device_id(self, ant_device_number, device_id):
+        with self._transaction() as conn:
+            self._add_device(conn, device_id)
+            # a device number identifies at most one device
+            conn.execute("UPDATE device SET device_number = NULL WHERE device_number = ? AND device_id != ?",
+                         (ant_device_number, device_id))
+            conn.execute("UPDATE device SET device_number = ? WHERE device_id = ?", (ant_device_number, device_id))
+
+    def get_device_ids(self):
+        return [row[0] for row in self._query("SELECT device_id FROM device ORDER BY device_id")]
+
+    def delete_device(self, device_id):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM device WHERE device_id = ?", (device_id,))
+            conn.execute("DELETE FROM device_meta WHERE device_id = ?", (device_id,))
+
+    def get_meta(self, device_id, name, default=None):
+        row = self._query_one("SELECT value FROM device_meta WHERE device_id = ? AND name = ?", (device_id, name))
+        return row[0] if row and row[0] is not None else default
+
+    def get_all_meta(self, device_id):
+        return dict(self._query("SELECT name, value FROM device_meta WHERE device_id = ?", (device_id,)))
+
+    def set_meta(self, device_id, **values):
+        """
+        Record metadata for the given device, e.g.
+        set_meta(device_id, last_sync=time.time()).
+        A value of None removes the entry.
+        """
+        with self._transaction() as conn:
+            self._add_device(conn, device_id)
+            for name, value in values.items():
+                if value is None:
+                    conn.execute("DELETE FROM device_meta WHERE device_id = ? AND name = ?", (device_id, name))
+                else:
+                    conn.execute("INSERT OR REPLACE INTO device_meta (device_id, name, value) VALUES (?, ?, ?)",
+                                 (device_id, name, value))
+
+    def _add_device(self, conn, device_id):
+        if device_id is None: raise ValueError("device_id required.")
+        conn.execute("INSERT OR IGNORE INTO device (device_id) VALUES (?)", (device_id,))
+
+    def _import_cfg(self, conn, file):
+        legacy = KnownDeviceDb(file)
+        _log.info("Importing known devices from %s.", file)
+        for device_id, key in legacy.key_by_device_id.items():
+            self._add_device(conn, device_id)
+            conn.execute("UPDATE device SET key = ? WHERE device_id = ?", (key.encode("hex"), device_id))
+        for device_number, device_id in legacy.device_id_by_ant_device_number.items():
+            self._add_device(conn, device_id)
+            conn.execute("UPDATE device SET device_number = ? WHERE device_id = ?", (device_number, device_id))
+
+    def _query(self, sql, args=()):
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def _query_one(self, sql, args=()):
+        with self.lock:
+            return self.conn.execute(sql, args).fetchone()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Run the enclosed statements as a single transaction.
+        The write lock is taken immediately, so concurrent
+        read-modify-write cycles from other processes block
+        until this one commits (or timeout expires). Other
+        threads of this process wait on self.lock.
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+            else:
+                self.conn.execute("COMMIT")
+
+
+LinkParams = collections.namedtuple("LinkParams", ["device_number", "device_id", "frequency", "period", "key"])
+
+
 class Host(object):
 
     search_network_key = "\xa8\xa4\x23\xb9\xf5\x5e\x63\xc1"
@@ -232,9 +668,15 @@ class Host(object):
     transport_period = 0b100
     transport_timeout = 2
 
+    device_id = None
+    device_number = None
+    last_link = None
+    # None until we know if ANT hardware supports them
+    extended_messages = None
+
     def __init__(self, ant_session, known_client_keys=None):
         self.ant_session = ant_session
-        self.known_client_keys = known_client_keys if known_client_keys is not None else KnownDeviceDb()
+        self.known_client_keys = known_client_keys if known_client_keys is not None else DeviceDb()
 
     def close(self):
         self.channel.send_acknowledged(Disconnect().pack(), direct=True)
@@ -264,55 +706,101 @@ class Host(object):
         include_unpaired_devices is ignored when device_id is provided.
         """
         timeout = time.time() + search_timeout
+        # if the ANT device number is known, channel will only track the requested device
+        device_number = self.known_client_keys.get_device_number(device_id) if device_id is not None else None
+        for beacon, tracking_device_number in self._beacons(timeout, device_number):
+            tracking_device_id = self.known_client_keys.get_device_id(tracking_device_number)
+            # check if event was a beacon
+            if beacon:
+                _log.debug("Got ANT-FS Beacon. device_number=0x%04x %s", tracking_device_number, beacon)
+                # and if device is a state which will accept our link
+                if  beacon.device_state != Beacon.STATE_LINK:
+                    _log.warning("Device busy, not ready for link. device_number=0x%04x state=%d.",
+                            tracking_device_number, beacon.device_state)
+                # are we looking for a specific device
+                if device_id is not None:
+                    if device_id == tracking_device_id:
+                        # the device exactly matches the one we're looking for
+                        self.beacon = beacon
+                        self.device_id = tracking_device_id
+                        self.device_number = tracking_device_number
+                        return beacon
+                    else:
+                        # a specific device id was request, but is not the one
+                        # currently linked, try again. FIXME should really implement
+                        # AP2 filters
+                        _log.debug("Found device, but device_id does not match. 0x%08x != 0x%08x", tracking_device_id or 0, device_id)
+                elif not include_unpaired_devices and tracking_device_id is None:
+                    # requested not to return unpared devices
+                    # but the one linked is unknown.
+                    # FIXME add device to AP2 filter and contiue search
+                    _log.debug("Found device, but paring not enabled. device_number=0x%04x", tracking_device_number)
+                elif not beacon.data_available and not include_devices_with_no_data:
+                    _log.debug("Found device, but no new data for download. device_number=0x%04x", tracking_device_number)
+                else:
+                    self.beacon = beacon
+                    self.device_id = tracking_device_id # may be None
+                    self.device_number = tracking_device_number
+                    return beacon
+
+    def scan(self, scan_timeout=10, include_unpaired_devices=False):
+        """
+        Return the beacons of all devices found in range.
+        The scan ends when every device found has been seen
+        again (or at scan_timeout.) device_number and device_id
+        (None if unpaired) are set on each returned beacon.
+        Devices are not linked, call search(device_id) to
+        select one of the returned devices.
+        """
+        timeout = time.time() + scan_timeout
+        found = {}
+        repeats = 0
+        for beacon, device_number in self._beacons(timeout):
+            if not beacon:
+                continue
+            elif device_number in found:
+                repeats += 1
+                if repeats >= len(found): break
+            else:
+                repeats = 0
+                beacon.device_number = device_number
+                beacon.device_id = self.known_client_keys.get_device_id(device_number)
+                _log.debug("Scan found device. device_number=0x%04x device_id=0x%08x %s",
+                           device_number, beacon.device_id or 0, beacon)
+                found[device_number] = beacon
+        return [b for b in found.values() if include_unpaired_devices or b.device_id is not None]
+
+    def _beacons(self, timeout, device_number=None):
+        """
+        A generator returning (broadcast, device_number) for
+        each broadcast received until timeout. broadcast is
+        None if it was not an ANT-FS beacon. If device_number
+        is provided, only the given device is tracked.
+        """
+        self._open_antfs_search_channel(device_number)
         while time.time() < timeout:
             try:
-                # if we didn't find a device, maybe another is in range?
-                # restart search every time. Once a device is tracking
-                # we don't get any more hits. So, just keep re-openning
-                # channel until we find device we're looking for.
-                # TODO could implement AP2 filters, but this logic maintains
-                # support for older devices.
-                self._open_antfs_search_channel()
                 # wait to recv beacon from device
-                beacon = Beacon.unpack(self.channel.recv_broadcast(timeout=timeout - time.time()))
+                beacon = Beacon.unpack(self.channel.recv_broadcast(timeout=timeout - time.time(),
+                                                                   extended=self.extended_messages))
             except ant.AntTimeoutError:
                 # ignore timeout error
                 pass
             else:
-                tracking_device_number = self.channel.get_id().device_number
-                tracking_device_id = self.known_client_keys.get_device_id(tracking_device_number)
-                # check if event was a beacon
-                if beacon:
-                    _log.debug("Got ANT-FS Beacon. device_number=0x%04x %s", tracking_device_number, beacon)
-                    # and if device is a state which will accept our link
-                    if  beacon.device_state != Beacon.STATE_LINK:
-                        _log.warning("Device busy, not ready for link. device_number=0x%04x state=%d.",
-                                tracking_device_number, beacon.device_state)
-                    # are we looking for a specific device
-                    if device_id is not None:
-                        if device_id == tracking_device_id:
-                            # the device exactly matches the one we're looking for
-                            self.beacon = beacon
-                            self.device_id = tracking_device_id
-                            return beacon
-                        else:
-                            # a specific device id was request, but is not the one
-                            # currently linked, try again. FIXME should really implement
-                            # AP2 filters
-                            _log.debug("Found device, but device_id does not match. 0x%08x != 0x%08x", tracking_device_id or 0, device_id)
-                            continue
-                    elif not include_unpaired_devices and tracking_device_id is None:
-                        # requested not to return unpared devices
-                        # but the one linked is unknown.
-                        # FIXME add device to AP2 filter and contiue search
-                        _log.debug("Found device, but paring not enabled. device_number=0x%04x", tracking_device_number)
-                        continue
-                    elif not beacon.data_available and not include_devices_with_no_data:
-                        _log.debug("Found device, but no new data for download. device_number=0x%04x", tracking_device_number)
-                    else:
-                        self.beacon = beacon
-                        self.device_id = tracking_device_id # may be None
-                        return beacon
+                if beacon and beacon.device_number is not None:
+                    tracking_device_number = beacon.device_number
+                else:
+                    # no extended data (AP1), ask ANT which device channel is tracking
+                    tracking_device_number = self.channel.get_id().device_number
+                yield beacon, tracking_device_number
+            # if we didn't find a device, maybe another is in range?
+            # restart search every time. Once a device is tracking
+            # we don't get any more hits. So, just keep re-openning
+            # channel until we find device we're looking for.
+            # TODO could implement AP2 filters, but this logic maintains
+            # support for older devices.
+            if time.time() < timeout:
+                self._reopen_antfs_search_channel()
         
     def link(self):
         """
@@ -333,6 +821,7 @@ class Host(object):
         link = Link(freq=random.choice(self.transport_freqs), period=self.transport_period)
         _log.debug("Linking with device. freq=24%02dmhz", link.frequency)
         self.channel.send_acknowledged(link.pack())
+        self.link_cmd = link
         # change this channels frequency to match link
         self._configure_antfs_transport_channel(link)
         # block indefinately for the antfs beacon on new freq.
@@ -377,6 +866,7 @@ class Host(object):
                 if auth_reply: break
             if auth_reply.response_type == Auth.RESPONSE_ACCEPT:
                 _log.debug("Device accepted key.")
+                self._save_link_params(client_id, key)
             else:
                 _log.warning("Device pairing failed. Removing key from db. Try re-pairing.")
                 self.known_client_keys.delete_device(client_id)
@@ -392,6 +882,8 @@ class Host(object):
                 self.known_client_keys.add_key(client_id, auth_reply.auth_string)
                 device_number = self.channel.get_id().device_number
                 self.known_client_keys.add_device_id(device_number, client_id)
+                self.device_number = device_number
+                self._save_link_params(client_id, auth_reply.auth_string)
             else:
                 _log.warning("Device pairing failed. Request rejected?")
         else:
@@ -401,6 +893,113 @@ class Host(object):
         assert self.beacon.device_state == Beacon.STATE_TRANSPORT
         return self.beacon
 
+    def download(self, index, offset=0, crc_seed=0, max_block_size=0):
+        """
+        Download file at index from client, starting
+        at offset. To resume a broken download provide
+        the offset and CRC of data already received.
+        """
+        return "".join(self.download_blocks(index, offset, crc_seed, max_block_size))
+
+    def download_blocks(self, index, offset=0, crc_seed=0, max_block_size=0):
+        """
+        A generator returning the data of file at index
+        one block at a time, starting at offset. Each block
+        has been CRC checked before it is returned, so if
+        the link drops the caller can resume with the
+        offset and CRC of data it has already received.
+        """
+        initial = True
+        while True:
+            request = Download(index, offset, initial, crc_seed, max_block_size)
+            self.channel.write(request.pack())
+            while True:
+                response = DownloadResponse.unpack(self.channel.read())
+                if response: break
+            if response.response != DownloadResponse.RESPONSE_OK:
+                raise AntFsError("Download of file %d failed, response=%d." % (index, response.response))
+            crc = crc16(response.data, crc_seed)
+            if crc != response.crc:
+                raise AntFsError("Download of file %d failed CRC at offset %d. 0x%04x != 0x%04x"
+                                 % (index, response.offset, crc, response.crc))
+            _log.debug("Downloaded file %d. offset=%d length=%d size=%d",
+                       index, response.offset, len(response.data), response.file_size)
+            if response.data: yield response.data
+            offset = response.offset + len(response.data)
+            crc_seed = crc
+            initial = False
+            if offset >= response.file_size or not response.data: break
+
+    def download_directory(self):
+        return Directory.unpack(self.download(0))
+
+    def upload(self, index, data, offset=0):
+        """
+        Upload data to file at index, starting at offset.
+        """
+        self.channel.write(Upload(index, offset + len(data), offset).pack())
+        while True:
+            response = UploadResponse.unpack(self.channel.read())
+            if response: break
+        if response.response != UploadResponse.RESPONSE_OK:
+            raise AntFsError("Upload of file %d failed, response=%d." % (index, response.response))
+        # client returns the CRC of data it already has up to offset
+        crc = response.crc if offset else 0
+        block_size = response.max_block_size or len(data)
+        for start in xrange(0, len(data), block_size):
+            block = UploadData(data[start:start + block_size], offset + start, crc)
+            self.channel.write(block.pack())
+            while True:
+                reply = UploadDataResponse.unpack(self.channel.read())
+                if reply: break
+            if reply.response != UploadDataResponse.RESPONSE_OK:
+                raise AntFsError("Upload of file %d failed at offset %d." % (index, offset + start))
+            crc = block.crc
+
+    def erase(self, index):
+        self.channel.write(Erase(index).pack())
+        while True:
+            response = EraseResponse.unpack(self.channel.read())
+            if response: break
+        if response.response != EraseResponse.RESPONSE_OK:
+            raise AntFsError("Erase of file %d failed, response=%d." % (index, response.response))
+
+    def reconnect(self, timeout=10):
+        """
+        Attempt to restore the most recent link after it was
+        lost, without a full search. The channel is opened
+        directly on the transport frequency of the last link,
+        if the device is still there, transport is re-opened
+        (re-authenticating with known key if needed).
+        Returns the beacon if successful, None if device
+        could not be found. (It has probably reverted to
+        link state, and caller should search() again.)
+        """
+        link = self.last_link
+        if link is None: return None
+        _log.debug("Attempting reconnect. device_number=0x%04x freq=24%02dmhz", link.device_number or 0, link.frequency)
+        try:
+            self._open_antfs_transport_channel(link)
+            self.beacon = Beacon.unpack(self.channel.recv_broadcast(timeout))
+            if self.beacon and self.beacon.device_state == Beacon.STATE_AUTH:
+                _log.debug("Device still linked, re-authenticating.")
+                self.link_cmd = Link(freq=link.frequency, period=link.period)
+                self.auth(pair=False)
+            if self.beacon and self.beacon.device_state == Beacon.STATE_TRANSPORT:
+                self.device_id = link.device_id
+                self.device_number = link.device_number
+                return self.beacon
+            _log.debug("Device not ready for transport, reconnect failed. %s", self.beacon)
+        except (ant.AntError, AssertionError):
+            _log.debug("Reconnect failed.", exc_info=True)
+
+    def _save_link_params(self, device_id, key):
+        self.last_link = LinkParams(self.device_number, device_id, self.link_cmd.frequency, self.link_cmd.period, key)
+        self.known_client_keys.set_meta(device_id,
+                transport_freq=self.link_cmd.frequency,
+                transport_period=self.link_cmd.period,
+                last_link=time.time())
+
     def write(self, msg):
         direct_cmd = GarminSendDirect(msg)
         self.channel.write(direct_cmd.pack())
@@ -409,22 +1008,61 @@ class Host(object):
         direct_reply = GarminSendDirect.unpack(self.channel.read())
         return direct_reply.data if direct_reply else None
 
-    def _open_antfs_search_channel(self):
+    def _open_antfs_search_channel(self, device_number=None):
         self.ant_session.reset_system()
         self.channel = self.ant_session.channels[0]
         self.network = self.ant_session.networks[0]
-        self._configure_antfs_search_channel()
+        self._configure_antfs_search_channel(device_number)
         self.channel.open()
 
-    def _configure_antfs_search_channel(self):
+    def _reopen_antfs_search_channel(self):
+        """
+        Restart search on the already configured channel.
+        Much faster than _open_antfs_search_channel(), no
+        need to wait for hardware reset.
+        """
+        try:
+            self.channel.close()
+            self.channel.open()
+        except ant.AntError:
+            _log.debug("Failed to restart search, resetting channel.", exc_info=True)
+            self._open_antfs_search_channel(self.search_device_number)
+
+    def _enable_extended_messages(self):
+        """
+        Ask ANT to include the channel id in each received
+        message, so search() can identify devices without
+        a get_id() round trip. Only supported on AP2.
+        """
+        if self.extended_messages is not False:
+            try:
+                self.ant_session.set_lib_config(ant.LIB_CONFIG_CHANNEL_ID)
+                self.extended_messages = True
+            except ant.AntError:
+                _log.debug("Extended messages not supported, will use get_id().", exc_info=True)
+                self.extended_messages = False
+
+    def _configure_antfs_search_channel(self, device_number=None):
+        self._enable_extended_messages()
+        self.search_device_number = device_number
         self.network.set_key(self.search_network_key)
         self.channel.assign(channel_type=0x00, network_number=self.network.network_number)
-        self.channel.set_id(device_number=0, device_type_id=0, trans_type=0)
+        self.channel.set_id(device_number=device_number or 0, device_type_id=0, trans_type=0)
         self.channel.set_period(self.search_period)
         self.channel.set_search_timeout(self.search_timeout)
         self.channel.set_rf_freq(self.search_freq)
         self.channel.set_search_waveform(self.search_waveform)
 
+    def _open_antfs_transport_channel(self, link):
+        self.ant_session.reset_system()
+        self.channel = self.ant_session.channels[0]
+        self.network = self.ant_session.networks[0]
+        self.network.set_key(self.search_network_key)
+        self.channel.assign(channel_type=0x00, network_number=self.network.network_number)
+        self.channel.set_id(device_number=link.device_number or 0, device_type_id=0, trans_type=0)
+        self._configure_antfs_transport_channel(link)
+        self.channel.open()
+
     def _configure_antfs_transport_channel(self, link):
         self.channel.set_rf_freq(link.frequency)
         self.channel.set_search_timeout(self.transport_timeout)
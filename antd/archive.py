@@ -0,0 +1,374 @@
+# Copyright (c) 2012, Braiden Kindt.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#   1. Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDER AND CONTRIBUTORS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY
+# WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Compressed archive of raw downloads. Each device has
+a directory of segment files, and an sqlite index.
+Packets are stored once, in zlib compressed blocks,
+a sync is stored as a list of references to its packets.
+Unless runs are deleted from device, each download
+repeats the device's history, so most packets of a
+sync were already archived by an earlier one.
+"""
+
+import logging
+import os
+import time
+import struct
+import zlib
+import hashlib
+import sqlite3
+import shutil
+import contextlib
+
+import antd.plugin as plugin
+import antd.garmin as garmin
+
+_log = logging.getLogger("antd.archive")
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def split_packets(data):
+    """
+    A generator returning each packet (including
+    terminators) of data in raw file format.
+    """
+    offset = 0
+    while offset + 4 <= len(data):
+        (length,) = struct.unpack("<H", data[offset + 2:offset + 4])
+        yield data[offset:offset + length + 4]
+        offset += length + 4
+
+
+class Archive(object):
+    """
+    Archive of one device's syncs, stored in dir.
+    Segment files are a sequence of blocks:
+    char[4] magic, uint8_t kind, uint32_t length,
+    uint32_t crc32 (of uncompressed data), and length
+    bytes of zlib compressed data. PACKETS blocks hold
+    packets in raw file format. A SYNC block holds
+    uint32_t time, uint16_t name length, name, then
+    a reference to each packet of the sync: uint16_t
+    segment, uint32_t block offset, uint16_t packet.
+    """
+
+    SCHEMA_VERSION = 1
+    MAGIC = "ANTA"
+    PACKETS = 1
+    SYNC = 2
+    BLOCK_HEADER = struct.Struct("<4sBII")
+    SYNC_HEADER = struct.Struct("<IH")
+    REF = struct.Struct("<HIH")
+
+    # uncompressed size of packet blocks
+    block_size = 64 * 1024
+    # a new segment is started once current is this size
+    segment_size = 4 * 1024 * 1024
+    # compact() once less than this fraction of the archived
+    # packets are referenced by retained syncs
+    compact_ratio = 0.5
+
+    def __init__(self, dir):
+        self.dir = dir
+        if not os.path.isdir(dir): os.makedirs(dir)
+        self.conn = sqlite3.connect(os.path.join(dir, "index.db"), timeout=30, isolation_level=None)
+        self.conn.text_factory = str
+        with self._transaction() as conn:
+            (version,) = conn.execute("PRAGMA user_version").fetchone()
+            if version < self.SCHEMA_VERSION:
+                conn.execute("CREATE TABLE IF NOT EXISTS packet (hash BLOB PRIMARY KEY, segment INTEGER, offset INTEGER, n INTEGER)")
+                conn.execute("CREATE TABLE IF NOT EXISTS sync (name TEXT PRIMARY KEY, time INTEGER, segment INTEGER, offset INTEGER)")
+                conn.execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+        # (segment, offset) -> packets of recently read blocks
+        self.blocks = {}
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def syncs(self):
+        """
+        Return [(name, time), ...] of archived syncs, oldest first.
+        """
+        return self.conn.execute("SELECT name, time FROM sync ORDER BY time, name").fetchall()
+
+    def add(self, name, data, sync_time=None):
+        """
+        Archive data, packets in raw file format (e.g.
+        contents of a raw file), as the sync name.
+        Returns the number of packets which were new.
+        """
+        if sync_time is None: sync_time = time.time()
+        new = {}
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM sync WHERE name = ?", (name,)).fetchone():
+                _log.debug("Archive: %s already archived.", name)
+                return 0
+            segment = self._last_segment()
+            file = self._open_segment(segment)
+            try:
+                refs = []
+                pending = []
+                pending_size = 0
+                for pkt in split_packets(data):
+                    hash = hashlib.sha1(pkt).digest()
+                    ref = new.get(hash) or self._find_packet(conn, hash)
+                    if ref is None:
+                        # pending block is written at end of current segment
+                        ref = new[hash] = (segment, file.tell(), len(pending))
+                        pending.append(pkt)
+                        pending_size += len(pkt)
+                        if pending_size >= self.block_size:
+                            segment, file = self._write_packets(segment, file, pending)
+                            pending, pending_size = [], 0
+                    refs.append(ref)
+                if pending:
+                    segment, file = self._write_packets(segment, file, pending)
+                offset = file.tell()
+                self._write_block(file, self.SYNC, self.SYNC_HEADER.pack(int(sync_time), len(name)) + name
+                                  + "".join(self.REF.pack(*ref) for ref in refs))
+                file.flush()
+                os.fsync(file.fileno())
+            finally:
+                file.close()
+            conn.executemany("INSERT INTO packet VALUES (?, ?, ?, ?)",
+                             ((sqlite3.Binary(hash),) + ref for hash, ref in new.iteritems()))
+            conn.execute("INSERT INTO sync VALUES (?, ?, ?, ?)", (name, int(sync_time), segment, offset))
+        _log.info("Archive: added %s, %d packet(s), %d new.", name, len(refs), len(new))
+        return len(new)
+
+    def read(self, name):
+        """
+        Return the packets of sync name, in raw file format.
+        """
+        row = self.conn.execute("SELECT segment, offset FROM sync WHERE name = ?", (name,)).fetchone()
+        if row is None: raise KeyError(name)
+        return "".join(self._read_packet(*ref) for ref in self._read_refs(*row))
+
+    def open(self, name):
+        """
+        Return a stream which replays sync name,
+        e.g. for garmin.Device or tcx.export_tcx.
+        """
+        host = garmin.MockHost(self.read(name))
+        host.file_name = name
+        return host
+
+    def verify(self):
+        """
+        Read every block of every segment, raising
+        ArchiveError if any checksum doesn't match.
+        Returns the number of blocks read.
+        """
+        count = 0
+        for segment in range(0, self._last_segment() + 1):
+            file_name = self._segment_file_name(segment)
+            if not os.path.isfile(file_name): continue
+            with open(file_name, "rb") as file:
+                while self._read_block(file) is not None:
+                    count += 1
+        return count
+
+    def apply_retention(self, keep_syncs=None, keep_days=None, now=None):
+        """
+        Delete all but the newest keep_syncs syncs, and
+        syncs older than keep_days. Space is reclaimed by
+        compact() once most archived packets are unused.
+        """
+        if now is None: now = time.time()
+        syncs = self.syncs()
+        expired = set()
+        if keep_syncs is not None:
+            expired.update(name for name, sync_time in syncs[:max(len(syncs) - keep_syncs, 0)])
+        if keep_days is not None:
+            expired.update(name for name, sync_time in syncs if sync_time < now - keep_days * 86400)
+        if not expired: return
+        with self._transaction() as conn:
+            conn.executemany("DELETE FROM sync WHERE name = ?", ((name,) for name in expired))
+        _log.info("Archive: deleted %d expired sync(s).", len(expired))
+        live = set()
+        for segment, offset in self.conn.execute("SELECT segment, offset FROM sync").fetchall():
+            live.update(self._read_refs(segment, offset))
+        (total,) = self.conn.execute("SELECT count(*) FROM packet").fetchone()
+        if len(live) < total * self.compact_ratio:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite archive, keeping only packets of retained syncs.
+        """
+        _log.info("Archive: compacting %s.", self.dir)
+        new_dir = self.dir + ".compact"
+        old_dir = self.dir + ".old"
+        if os.path.isdir(new_dir): shutil.rmtree(new_dir)
+        with Archive(new_dir) as archive:
+            archive.block_size = self.block_size
+            archive.segment_size = self.segment_size
+            for name, sync_time in self.syncs():
+                archive.add(name, self.read(name), sync_time)
+        self.close()
+        os.rename(self.dir, old_dir)
+        os.rename(new_dir, self.dir)
+        shutil.rmtree(old_dir)
+        self.__init__(self.dir)
+
+    def _find_packet(self, conn, hash):
+        return conn.execute("SELECT segment, offset, n FROM packet WHERE hash = ?", (sqlite3.Binary(hash),)).fetchone()
+
+    def _segment_file_name(self, segment):
+        return os.path.join(self.dir, "%06d.seg" % segment)
+
+    def _last_segment(self):
+        segment = 0
+        while os.path.isfile(self._segment_file_name(segment + 1)): segment += 1
+        return segment
+
+    def _write_packets(self, segment, file, packets):
+        """
+        Write a PACKETS block, starting a new segment
+        if current is full. Returns (segment, file).
+        """
+        self._write_block(file, self.PACKETS, "".join(packets))
+        if file.tell() >= self.segment_size:
+            file.flush()
+            os.fsync(file.fileno())
+            file.close()
+            segment += 1
+            file = self._open_segment(segment)
+        return segment, file
+
+    def _open_segment(self, segment):
+        file = open(self._segment_file_name(segment), "ab")
+        file.seek(0, os.SEEK_END)
+        return file
+
+    def _write_block(self, file, kind, data):
+        compressed = zlib.compress(data)
+        file.write(self.BLOCK_HEADER.pack(self.MAGIC, kind, len(compressed), zlib.crc32(data) & 0xFFFFFFFF))
+        file.write(compressed)
+
+    def _read_block(self, file):
+        """
+        Read the block at file's position, returns (kind, data)
+        or None at end of file.
+        """
+        header = file.read(self.BLOCK_HEADER.size)
+        if not header: return None
+        try:
+            magic, kind, length, crc = self.BLOCK_HEADER.unpack(header)
+            if magic != self.MAGIC: raise ArchiveError("Bad block header.")
+            data = zlib.decompress(file.read(length))
+            if zlib.crc32(data) & 0xFFFFFFFF != crc: raise ArchiveError("Block checksum mismatch.")
+        except (struct.error, zlib.error, ArchiveError) as e:
+            raise ArchiveError("%s: corrupt block at offset %d. %s" % (file.name, file.tell(), e))
+        return kind, data
+
+    def _read_block_at(self, segment, offset):
+        with open(self._segment_file_name(segment), "rb") as file:
+            file.seek(offset)
+            return self._read_block(file)
+
+    def _read_refs(self, segment, offset):
+        kind, data = self._read_block_at(segment, offset)
+        sync_time, name_length = self.SYNC_HEADER.unpack_from(data)
+        start = self.SYNC_HEADER.size + name_length
+        return [self.REF.unpack_from(data, n) for n in xrange(start, len(data), self.REF.size)]
+
+    def _read_packet(self, segment, offset, n):
+        try:
+            packets = self.blocks[(segment, offset)]
+        except KeyError:
+            if len(self.blocks) > 16: self.blocks.clear()
+            kind, data = self._read_block_at(segment, offset)
+            packets = self.blocks[(segment, offset)] = list(split_packets(data))
+        return packets[n]
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        else:
+            self.conn.execute("COMMIT")
+
+
+class ArchivePlugin(plugin.Plugin):
+    """
+    Adds each raw file to the device's archive, and
+    applies retention policy. If delete_raw is set raw
+    files are deleted once archived, unless another
+    plugin has queued the file to retry later, then it
+    is deleted when archive's queue is retried. Plugins
+    which read raw files must be registered before this one.
+    """
+
+    archive_dir = "."
+    keep_syncs = None
+    keep_days = None
+    delete_raw = False
+
+    def data_available(self, device_sn, format, files):
+        if "raw" != format: return files
+        processed = []
+        with Archive(self.archive_dir % {"device_id": hex(device_sn)}) as archive:
+            for file in files:
+                _log.info("ArchivePlugin: archiving %s.", file)
+                try:
+                    # no-op if file was archived by an earlier attempt
+                    with garmin.RawFile(file) as raw:
+                        archive.add(os.path.basename(file), raw.data, os.path.getmtime(file))
+                except Exception:
+                    _log.warning("Failed to archive %s.", file, exc_info=True)
+                    continue
+                if self.delete_raw:
+                    if plugin.is_pending(file, exclude=self):
+                        _log.info("ArchivePlugin: %s pending in another plugin, not deleted.", file)
+                        continue
+                    for name in (file, file + ".idx"):
+                        if os.path.isfile(name): os.unlink(name)
+                processed.append(file)
+            try:
+                archive.apply_retention(self.keep_syncs, self.keep_days)
+            except Exception:
+                _log.warning("Failed to apply archive retention.", exc_info=True)
+        return processed
+
+
+# vim: ts=4 sts=4 et
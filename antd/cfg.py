@@ -111,9 +111,11 @@ def create_antfs_host():
     import antd.antfs as antfs
     keys_file = _cfg.get("antd.antfs", "auth_pairing_keys")
     keys_file = os.path.expanduser(keys_file)
-    keys_dir = os.path.dirname(keys_file)
-    if not os.path.exists(keys_dir): os.makedirs(keys_dir)
-    keys = antfs.KnownDeviceDb(keys_file)
+    try: db_file = os.path.expanduser(_cfg.get("antd.antfs", "known_devices_db"))
+    except ConfigParser.NoOptionError: db_file = os.path.splitext(keys_file)[0] + ".db"
+    db_dir = os.path.dirname(db_file)
+    if not os.path.exists(db_dir): os.makedirs(db_dir)
+    keys = antfs.DeviceDb(db_file, keys_file)
     host = antfs.Host(create_ant_session(), keys)
     host.search_network_key = binascii.unhexlify(_cfg.get("antd.antfs", "search_network_key"))
     host.search_freq = int(_cfg.get("antd.antfs", "search_freq"), 0)
@@ -125,6 +127,17 @@ def create_antfs_host():
     host.transport_timeout = int(_cfg.get("antd.antfs", "transport_timeout"), 0)
     return host
 
+def create_sync_scheduler(host):
+    try:
+        if _cfg.getboolean("antd.fleet", "enabled"):
+            import antd.fleet as fleet
+            scheduler = fleet.SyncScheduler(host)
+            scheduler.max_attempts = int(_cfg.get("antd.fleet", "max_attempts"), 0)
+            scheduler.attempt_window = int(_cfg.get("antd.fleet", "attempt_window"), 0)
+            scheduler.scan_timeout = int(_cfg.get("antd.fleet", "scan_timeout"), 0)
+            return scheduler
+    except ConfigParser.NoSectionError: pass
+
 def create_garmin_connect_plugin():
     try:
         if _cfg.getboolean("antd.connect", "enabled"):
@@ -133,6 +146,8 @@ def create_garmin_connect_plugin():
             client.username = _cfg.get("antd.connect", "username")
             client.password = _cfg.get("antd.connect", "password")
             client.cache = os.path.expanduser(_cfg.get("antd.connect", "cache")) 
+            try: client.upload_format = _cfg.get("antd.connect", "upload_format")
+            except ConfigParser.NoOptionError: pass
             return client 
     except ConfigParser.NoSectionError: pass
 
@@ -144,6 +159,8 @@ def create_gupload_plugin():
             client.username = _cfg.get("antd.gupload", "username")
             client.password = _cfg.get("antd.gupload", "password")
             client.cache = os.path.expanduser(_cfg.get("antd.gupload", "cache")) 
+            try: client.upload_format = _cfg.get("antd.gupload", "upload_format")
+            except ConfigParser.NoOptionError: pass
             return client 
     except ConfigParser.NoSectionError: pass
 
@@ -156,6 +173,8 @@ def create_strava_plugin():
             client.smtp_port = _cfg.get("antd.strava", "smtp_port")
             client.smtp_username = _cfg.get("antd.strava", "smtp_username")
             client.smtp_password = _cfg.get("antd.strava", "smtp_password")
+            try: client.upload_format = _cfg.get("antd.strava", "upload_format")
+            except ConfigParser.NoOptionError: pass
             return client
     except ConfigParser.NoSectionError: pass
 
@@ -167,8 +186,56 @@ def create_tcx_plugin():
         try:
             tcx.cache = os.path.expanduser(_cfg.get("antd.tcx", "cache")) 
         except ConfigParser.NoOptionError: pass
+        try:
+            tcx.workers = _cfg.getint("antd.tcx", "workers")
+        except ConfigParser.NoOptionError: pass
+        try:
+            tcx.serializer = _cfg.get("antd.tcx", "serializer")
+        except ConfigParser.NoOptionError: pass
+        try:
+            tcx.pretty_print = _cfg.getboolean("antd.tcx", "pretty_print")
+        except ConfigParser.NoOptionError: pass
+        try:
+            tcx.manifest = os.path.expanduser(_cfg.get("antd.tcx", "manifest")) or None
+        except ConfigParser.NoOptionError: pass
+        try:
+            tcx.batch_runs = _cfg.getint("antd.tcx", "batch_runs")
+        except ConfigParser.NoOptionError: pass
+        try:
+            tcx.batch_points = _cfg.getint("antd.tcx", "batch_points")
+        except ConfigParser.NoOptionError: pass
         return tcx
 
+def create_fit_plugin():
+    try:
+        if _cfg.getboolean("antd.fit", "enabled"):
+            import antd.fit as fit
+            fit = fit.FitPlugin()
+            fit.fit_output_dir = os.path.expanduser(_cfg.get("antd.fit", "fit_output_dir"))
+            try:
+                fit.cache = os.path.expanduser(_cfg.get("antd.fit", "cache"))
+            except ConfigParser.NoOptionError: pass
+            try:
+                fit.workers = _cfg.getint("antd.fit", "workers")
+            except ConfigParser.NoOptionError: pass
+            try:
+                fit.manifest = os.path.expanduser(_cfg.get("antd.fit", "manifest")) or None
+            except ConfigParser.NoOptionError: pass
+            return fit
+    except ConfigParser.NoSectionError: pass
+
+def create_archive_plugin():
+    try:
+        if _cfg.getboolean("antd.archive", "enabled"):
+            import antd.archive as archive
+            archive = archive.ArchivePlugin()
+            archive.archive_dir = os.path.expanduser(_cfg.get("antd.archive", "archive_dir"))
+            archive.keep_syncs = _cfg.getint("antd.archive", "keep_syncs") or None
+            archive.keep_days = _cfg.getint("antd.archive", "keep_days") or None
+            archive.delete_raw = _cfg.getboolean("antd.archive", "delete_raw")
+            return archive
+    except ConfigParser.NoSectionError: pass
+
 def create_notification_plugin():
     try:
         if _cfg.getboolean("antd.notification", "enabled"):
@@ -189,6 +256,18 @@ def get_delete_from_device():
     except ConfigParser.NoOptionError:
         return False
 
+def get_ack_mode():
+    try:
+        return _cfg.get("antd", "ack_mode")
+    except ConfigParser.NoOptionError:
+        return "each"
+
+def get_sync_mode():
+    try:
+        return _cfg.get("antd", "sync_mode")
+    except ConfigParser.NoOptionError:
+        return "full"
+
 def get_retry():
     return int(_cfg.get("antd", "retry"), 0)
 
@@ -46,6 +46,8 @@ class GarminConnect(plugin.Plugin):
 
     username = None
     password = None
+    # "tcx" or "fit"
+    upload_format = "tcx"
 
     logged_in = False
     login_invalid = False
@@ -88,7 +90,7 @@ class GarminConnect(plugin.Plugin):
         return response.text if hasattr(response, "text") else response.content
     
     def data_available(self, device_sn, format, files):
-        if format not in ("tcx"): return files
+        if format != self.upload_format: return files
         result = []
         try:
             for file in files:
@@ -228,6 +230,7 @@ class GarminConnect(plugin.Plugin):
         
 class StravaConnect(plugin.Plugin):
 
+    upload_format = "tcx"
     server = None
     smtp_server = None
     smtp_port = None
@@ -242,7 +245,7 @@ class StravaConnect(plugin.Plugin):
         pass
 
     def data_available(self, device_sn, format, files):
-        if format not in ("tcx"): return files
+        if format != self.upload_format: return files
         result = []
         try:
             for file in files:
@@ -288,9 +291,10 @@ class StravaConnect(plugin.Plugin):
 class GUpload(plugin.Plugin):
     username = None
     password = None
+    upload_format = "tcx"
 
     def data_available(self, device_sn, format, files):
-        if format not in ("tcx"): return files
+        if format != self.upload_format: return files
 
         # gupload exits with an error code !=0 if it fails. This in turn makes subprocess.check_output
         # raise an exception, and we return that no files were processed
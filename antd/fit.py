@@ -0,0 +1,320 @@
+# Copyright (c) 2012, Braiden Kindt.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#   1. Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDER AND CONTRIBUTORS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY
+# WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+FIT (Flexible and Interoperable data Transfer) encoding
+of runs, an alternative to tcx. FIT is binary, files are
+about a tenth the size of the same run as tcx. Only the
+messages needed for an activity file are implemented.
+"""
+
+import logging
+import os
+import time
+import struct
+import cStringIO
+
+import antd.tcx as tcx
+import antd.garmin as garmin
+import antd.antfs as antfs
+
+_log = logging.getLogger("antd.fit")
+
+# base types, (number, struct format, invalid value)
+ENUM = (0x00, "B", 0xFF)
+UINT8 = (0x02, "B", 0xFF)
+SINT16 = (0x83, "h", 0x7FFF)
+UINT16 = (0x84, "H", 0xFFFF)
+SINT32 = (0x85, "i", 0x7FFFFFFF)
+UINT32 = (0x86, "I", 0xFFFFFFFF)
+UINT32Z = (0x8C, "I", 0)
+
+PROTOCOL_VERSION = 0x10
+PROFILE_VERSION = 2100
+
+
+class MessageType(object):
+    """
+    A global FIT message, and the fields of it which
+    are written. Values are packed in field order,
+    None is written as the field's invalid value.
+    """
+
+    def __init__(self, name, number, fields):
+        self.name = name
+        self.number = number
+        self.fields = [name for name, field_num, base_type in fields]
+        self.struct = struct.Struct("<" + "".join(base_type[1] for name, field_num, base_type in fields))
+        self.invalid = [base_type[2] for name, field_num, base_type in fields]
+        self.definition = struct.pack("<BBHB", 0, 0, number, len(fields)) + "".join(
+                struct.pack("<BBB", field_num, struct.calcsize(base_type[1]), base_type[0])
+                for name, field_num, base_type in fields)
+
+    def pack(self, values):
+        return self.struct.pack(*[i if v is None else v for v, i in zip(values, self.invalid)])
+
+
+FILE_ID = MessageType("file_id", 0, [
+    ("type", 0, ENUM),
+    ("manufacturer", 1, UINT16),
+    ("product", 2, UINT16),
+    ("serial_number", 3, UINT32Z),
+    ("time_created", 4, UINT32),
+])
+
+EVENT = MessageType("event", 21, [
+    ("timestamp", 253, UINT32),
+    ("event", 0, ENUM),
+    ("event_type", 1, ENUM),
+])
+
+RECORD = MessageType("record", 20, [
+    ("timestamp", 253, UINT32),
+    ("position_lat", 0, SINT32),
+    ("position_long", 1, SINT32),
+    ("altitude", 2, UINT16),
+    ("heart_rate", 3, UINT8),
+    ("cadence", 4, UINT8),
+    ("distance", 5, UINT32),
+])
+
+LAP = MessageType("lap", 19, [
+    ("message_index", 254, UINT16),
+    ("timestamp", 253, UINT32),
+    ("event", 0, ENUM),
+    ("event_type", 1, ENUM),
+    ("start_time", 2, UINT32),
+    ("start_position_lat", 3, SINT32),
+    ("start_position_long", 4, SINT32),
+    ("end_position_lat", 5, SINT32),
+    ("end_position_long", 6, SINT32),
+    ("total_elapsed_time", 7, UINT32),
+    ("total_timer_time", 8, UINT32),
+    ("total_distance", 9, UINT32),
+    ("total_calories", 11, UINT16),
+    ("avg_speed", 13, UINT16),
+    ("max_speed", 14, UINT16),
+    ("avg_heart_rate", 15, UINT8),
+    ("max_heart_rate", 16, UINT8),
+    ("avg_cadence", 17, UINT8),
+    ("intensity", 23, ENUM),
+    ("lap_trigger", 24, ENUM),
+    ("sport", 25, ENUM),
+])
+
+SESSION = MessageType("session", 18, [
+    ("message_index", 254, UINT16),
+    ("timestamp", 253, UINT32),
+    ("event", 0, ENUM),
+    ("event_type", 1, ENUM),
+    ("start_time", 2, UINT32),
+    ("start_position_lat", 3, SINT32),
+    ("start_position_long", 4, SINT32),
+    ("sport", 5, ENUM),
+    ("sub_sport", 6, ENUM),
+    ("total_elapsed_time", 7, UINT32),
+    ("total_timer_time", 8, UINT32),
+    ("total_distance", 9, UINT32),
+    ("total_calories", 11, UINT16),
+    ("avg_speed", 14, UINT16),
+    ("max_speed", 15, UINT16),
+    ("avg_heart_rate", 16, UINT8),
+    ("max_heart_rate", 17, UINT8),
+    ("first_lap_index", 25, UINT16),
+    ("num_laps", 26, UINT16),
+])
+
+ACTIVITY = MessageType("activity", 34, [
+    ("timestamp", 253, UINT32),
+    ("total_timer_time", 0, UINT32),
+    ("num_sessions", 1, UINT16),
+    ("type", 2, ENUM),
+    ("event", 3, ENUM),
+    ("event_type", 4, ENUM),
+])
+
+# enum values
+FILE_ACTIVITY = 4
+MANUFACTURER_GARMIN = 1
+EVENT_TIMER = 0
+EVENT_SESSION = 8
+EVENT_LAP = 9
+EVENT_ACTIVITY = 26
+EVENT_TYPE_START = 0
+EVENT_TYPE_STOP = 1
+EVENT_TYPE_STOP_ALL = 4
+
+# garmin sport_type and trigger_method to FIT
+SPORTS = {0: 1, 1: 2, 2: 0}
+LAP_TRIGGERS = {0: 0, 1: 2, 2: 4, 3: 1, 4: 0}
+
+
+class Writer(object):
+    """
+    Writes FIT messages to file. A definition message is
+    written the first time each message type is used,
+    and reused by later messages of the same type. The
+    header and CRC are written by close(), messages are
+    buffered until then since the header includes their size.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.data = cStringIO.StringIO()
+        # message type -> local message number
+        self.local = {}
+
+    def define(self, message_type):
+        """
+        Return the record header of message_type's data
+        messages, writing its definition if not yet written.
+        """
+        local = self.local.get(message_type)
+        if local is None:
+            local = self.local[message_type] = len(self.local)
+            assert local < 16
+            self.data.write(chr(0x40 | local) + message_type.definition)
+        return chr(local)
+
+    def write(self, message_type, *values):
+        self.data.write(self.define(message_type) + message_type.pack(values))
+
+    def close(self):
+        data = self.data.getvalue()
+        header = struct.pack("<BBHI4s", 14, PROTOCOL_VERSION, PROFILE_VERSION, len(data), ".FIT")
+        header += struct.pack("<H", antfs.crc16(header))
+        self.file.write(header)
+        self.file.write(data)
+        self.file.write(struct.pack("<H", antfs.crc16(data, antfs.crc16(header))))
+
+
+def scale(value, factor, limit):
+    """
+    Return value * factor rounded, None if value is
+    missing (None or NaN) or doesn't fit in field.
+    """
+    if value is None or value != value: return None
+    value = int(round(value * factor))
+    return value if 0 <= value < limit else None
+
+def write_activity(file, device, activity):
+    """
+    Write activity as a FIT activity file.
+    """
+    writer = Writer(file)
+    start = activity.start_time.time
+    laps = activity.laps
+    end = max(lap.start_time.time + lap.total_time // 100 for lap in laps)
+    if len(activity): end = max(end, activity.time[-1])
+    sport = SPORTS.get(activity.sport_type, 0)
+    writer.write(FILE_ID, FILE_ACTIVITY, MANUFACTURER_GARMIN, device.device_id.product_id,
+                 device.stream.device_id, start)
+    writer.write(EVENT, start, EVENT_TIMER, EVENT_TYPE_START)
+    for lap_num, lap in enumerate(laps):
+        write_records(writer, activity, activity.lap_points(lap_num))
+        lap_end = lap.start_time.time + lap.total_time // 100
+        writer.write(LAP, lap_num, lap_end, EVENT_LAP, EVENT_TYPE_STOP, lap.start_time.time,
+                     lap.begin.lat, lap.begin.lon, lap.end.lat, lap.end.lon,
+                     lap.total_time * 10, lap.total_time * 10, scale(lap.total_dist, 100, 0xFFFFFFFF),
+                     lap.calories, scale(lap.total_dist / lap.total_time * 100 if lap.total_time else None, 1000, 0xFFFF),
+                     scale(lap.max_speed, 1000, 0xFFFF), lap.avg_heart_rate, lap.max_heart_rate,
+                     lap.avg_cadence, lap.intensity, LAP_TRIGGERS.get(lap.trigger_method), sport)
+    writer.write(EVENT, end, EVENT_TIMER, EVENT_TYPE_STOP_ALL)
+    total_time = sum(lap.total_time for lap in laps)
+    total_dist = sum(lap.total_dist for lap in laps)
+    hr_time = sum(lap.total_time for lap in laps if lap.avg_heart_rate)
+    avg_hr = sum(lap.avg_heart_rate * lap.total_time for lap in laps if lap.avg_heart_rate) // hr_time if hr_time else None
+    max_hr = max(lap.max_heart_rate for lap in laps) or None
+    writer.write(SESSION, 0, end, EVENT_SESSION, EVENT_TYPE_STOP, start,
+                 laps[0].begin.lat, laps[0].begin.lon, sport, 0,
+                 (end - start) * 1000, total_time * 10, scale(total_dist, 100, 0xFFFFFFFF),
+                 sum(lap.calories for lap in laps), scale(total_dist / total_time * 100 if total_time else None, 1000, 0xFFFF),
+                 scale(max(lap.max_speed for lap in laps), 1000, 0xFFFF), avg_hr, max_hr, 0, len(laps))
+    writer.write(ACTIVITY, end, total_time * 10, 1, 0, EVENT_ACTIVITY, EVENT_TYPE_STOP)
+    writer.close()
+
+def write_records(writer, activity, points):
+    """
+    Write a record message for each of the given points.
+    """
+    header = writer.define(RECORD)
+    pack = RECORD.struct.pack
+    write = writer.data.write
+    times, lats, lons = activity.time, activity.lat, activity.lon
+    alts, dists, hrs, cads = activity.alt, activity.distance, activity.heart_rate, activity.cadence
+    for n in points:
+        # missing position and cadence are already the FIT invalid values
+        alt, dist = alts[n], dists[n]
+        write(header + pack(times[n], lats[n], lons[n],
+            int(round((alt + 500) * 5)) if alt == alt and -500 <= alt < 12607 else 0xFFFF,
+            hrs[n] or 0xFF, cads[n],
+            int(round(dist * 100)) if dist == dist and 0 <= dist < 42949672 else 0xFFFFFFFF))
+
+def export_fit(device_sn, raw_file_name, output_dir, track_indexes=None):
+    """
+    Given a garmin raw packet dump, write a FIT file of
+    each run to output directory, see tcx.export_tcx().
+    """
+    if isinstance(raw_file_name, basestring):
+        with garmin.RawFile(raw_file_name) as host:
+            return export_fit(device_sn, host, output_dir, track_indexes)
+    host = raw_file_name
+    result = []
+    host.device_id = device_sn
+    device = garmin.Device(host)
+    runs = garmin.extract_runs(device, device.get_runs(), track_indexes)
+    for run in runs:
+        fit_name = time.strftime("%Y%m%d-%H%M%S.fit", run.start_time.gmtime)
+        fit_full_path = os.path.sep.join([output_dir, fit_name])
+        _log.info("fit: writing %s -> %s.", os.path.basename(host.file_name), fit_full_path)
+        with open(fit_full_path, "wb") as file:
+            write_activity(file, device, run)
+        result.append(fit_full_path)
+    return result
+
+
+class FitPlugin(tcx.TcxPlugin):
+    """
+    Converts raw files to FIT, published as format "fit".
+    Options are those of TcxPlugin (workers, manifest),
+    except serializer, pretty_print and batching, each
+    FIT file is a single run.
+    """
+
+    format = "fit"
+    fit_output_dir = "."
+
+    def output_dir(self, device_sn):
+        return self.fit_output_dir % {"device_id": hex(device_sn)}
+
+    def task(self, device_sn, raw_file_name, output_dir, track_indexes, combine=False):
+        return (export_fit, device_sn, raw_file_name, output_dir, track_indexes)
+
+
+# vim: ts=4 sts=4 et
@@ -0,0 +1,164 @@
+# Copyright (c) 2012, Braiden Kindt.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#   1. Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDER AND CONTRIBUTORS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY
+# WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Scheduling of downloads when many paired devices share
+one gateway. Rather than linking with whichever device
+beacons first, all devices in range are scanned and
+ranked so a device which is always in range can't
+starve the others.
+"""
+
+import logging
+import time
+
+_log = logging.getLogger("antd.fleet")
+
+
+class SyncScheduler(object):
+    """
+    Ranks paired devices in range by whether they have
+    data available, time since last successful sync,
+    and number of consecutive failures. History is kept
+    in the host's DeviceDb, so multiple processes
+    (and restarts) share the same view of the fleet.
+    """
+
+    # at most max_attempts downloads per device in attempt_window
+    max_attempts = 3
+    attempt_window = 3600
+    scan_timeout = 10
+    search_timeout = 10
+    # seconds of staleness a device with data available is worth
+    data_available_bonus = 7 * 24 * 3600
+
+    def __init__(self, host):
+        self.host = host
+        self.db = host.known_client_keys
+        # time each device was first seen with data, since last sync
+        self.waiting_since = {}
+        # device selected by next_device, until success() or
+        # the next call to next_device(). kept after failure(),
+        # the download may still be resumed with host.reconnect().
+        self.device_id = None
+
+    def next_device(self, include_devices_with_no_data=False):
+        """
+        Scan for devices, and search for the one which
+        should be downloaded next. Returns its beacon,
+        or None if there is nothing to do.
+        """
+        self.device_id = None
+        now = time.time()
+        beacons = self.host.scan(self.scan_timeout)
+        for beacon in beacons:
+            if beacon.data_available:
+                self.waiting_since.setdefault(beacon.device_id, now)
+        candidates = [b for b in beacons
+                      if (b.data_available or include_devices_with_no_data)
+                      and self.attempts_remaining(b.device_id, now)]
+        for beacon in self.rank(candidates, now):
+            _log.debug("Selected device 0x%08x, score=%d.", beacon.device_id, self.score(beacon, now))
+            if self.host.search(self.search_timeout, device_id=beacon.device_id):
+                self.attempt(beacon.device_id, now)
+                self.device_id = beacon.device_id
+                return self.host.beacon
+            _log.debug("Device 0x%08x left range before link.", beacon.device_id)
+
+    def rank(self, beacons, now=None):
+        """
+        Return beacons sorted highest priority first.
+        """
+        if now is None: now = time.time()
+        return sorted(beacons, key=lambda b: self.score(b, now), reverse=True)
+
+    def score(self, beacon, now):
+        meta = self.db.get_all_meta(beacon.device_id)
+        staleness = now - meta.get("last_sync", 0)
+        if beacon.data_available:
+            staleness += self.data_available_bonus
+        # back-off devices which keep failing (e.g. weak signal)
+        return staleness / (1 + meta.get("failed_count", 0))
+
+    def attempts_remaining(self, device_id, now=None):
+        if now is None: now = time.time()
+        meta = self.db.get_all_meta(device_id)
+        if now - meta.get("attempt_window_start", 0) >= self.attempt_window:
+            return self.max_attempts
+        remaining = self.max_attempts - meta.get("attempt_count", 0)
+        if remaining <= 0:
+            _log.debug("Device 0x%08x exceeded %d attempt(s), skipping.", device_id, self.max_attempts)
+        return max(remaining, 0)
+
+    def attempt(self, device_id, now=None):
+        if now is None: now = time.time()
+        meta = self.db.get_all_meta(device_id)
+        if now - meta.get("attempt_window_start", 0) >= self.attempt_window:
+            self.db.set_meta(device_id, attempt_window_start=now, attempt_count=1)
+        else:
+            self.db.set_meta(device_id, attempt_count=meta.get("attempt_count", 0) + 1)
+
+    def success(self, device_id=None):
+        """
+        Record a successful download of device (default
+        the one returned by next_device), returns sync latency,
+        seconds from when device was first seen with data
+        until download completed.
+        """
+        if device_id is None: device_id, self.device_id = self.device_id, None
+        now = time.time()
+        latency = now - self.waiting_since.pop(device_id, now)
+        self.db.set_meta(device_id, last_sync=now, failed_count=0, attempt_count=0, sync_latency=latency)
+        _log.info("Device 0x%08x synced, latency=%0.1fs.", device_id, latency)
+        return latency
+
+    def failure(self, device_id=None):
+        """
+        Record a failed download of device (default the
+        one returned by next_device). The device remains
+        selected, a resumed download is recorded by success().
+        """
+        if device_id is None: device_id = self.device_id
+        if device_id is None: return
+        failed_count = self.db.get_meta(device_id, "failed_count", 0) + 1
+        self.db.set_meta(device_id, failed_count=failed_count)
+        _log.info("Device 0x%08x download failed, failed_count=%d.", device_id, failed_count)
+
+    def report(self):
+        """
+        Return list of (device_id, last_sync, sync_latency, failed_count)
+        for every paired device.
+        """
+        result = []
+        for device_id in self.db.get_device_ids():
+            meta = self.db.get_all_meta(device_id)
+            result.append((device_id, meta.get("last_sync"), meta.get("sync_latency"), meta.get("failed_count", 0)))
+        return result
+
+
+# vim: ts=4 sts=4 et
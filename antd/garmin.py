@@ -40,11 +40,25 @@ import logging
 import struct
 import time
 import collections
+import re
+import array
+import bisect
+import os
+import mmap
+import threading
+import Queue
 
 import antd.ant as ant
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 _log = logging.getLogger("antd.garmin")
 
+NAN = float("nan")
+
 class P000(object):
     """
     Physical protocol, must be implemented by all devices.
@@ -202,6 +216,33 @@ def tokenize(msg):
         else:
             break
 
+_structs = {}
+
+def get_struct(format):
+    """
+    Return a compiled struct.Struct for format,
+    shared by all callers.
+    """
+    try:
+        return _structs[format]
+    except KeyError:
+        return _structs.setdefault(format, struct.Struct(format))
+
+def value_offsets(format):
+    """
+    Return the offset in bytes of each value unpacked by
+    struct format, e.g. "<HxI" -> [0, 3]. A "s" or "p"
+    field is one value, pad bytes ("x") are no value.
+    """
+    offsets, prefix = [], format[0]
+    for count, code in re.findall(r"(\d*)(\D)", format[1:]):
+        if code in "sp":
+            offsets.append(struct.calcsize(prefix))
+        elif code != "x":
+            offsets.extend(struct.calcsize(prefix + code * n) for n in range(0, int(count or 1)))
+        prefix += count + code
+    return offsets
+
 def chunk(l, n):
     """
     A generator returning n-sized lists
@@ -243,6 +284,17 @@ def abbrev(str, max_len):
     if len(str) > max_len: return str[:max_len] + "..."
     else: return str
 
+def extract_trk_pkts(protocols, get_trks_pkts, index):
+    """
+    Given a collection of track points packets,
+    return the PID_TRK_DATA and PID_TRK_DATA_ARRAY
+    packets which are members of given track index.
+    """
+    start, stop = get_trks_pkts.ranges(protocols.link_proto.PID_TRK_HDR).get(index, (0, 0))
+    for pkt in get_trks_pkts[start:stop]:
+        if pkt.pid in (protocols.link_proto.PID_TRK_DATA, protocols.link_proto.PID_TRK_DATA_ARRAY):
+            yield pkt
+
 def extract_wpts(protocols, get_trks_pkts, index):
     """
     Given a collection of track points packets,
@@ -251,50 +303,165 @@ def extract_wpts(protocols, get_trks_pkts, index):
     such that result is equvalent to cas where each was its
     on packet of PID_TRK_DATA
     """
-    i = iter(get_trks_pkts)
-    # position iter at first wpt record of given index
-    for pid, length, data in i:
-        if pid == protocols.link_proto.PID_TRK_HDR and data.index == index:
-            break
-    # extract wpts
-    for pkt in i:
-        if pkt.pid == protocols.link_proto.PID_TRK_HDR:
-            break
-        elif pkt.pid == protocols.link_proto.PID_TRK_DATA:
-            yield data
-        elif pkt.pid == protocols.link_proto.PID_TRK_DATA_ARRAY:
+    for pkt in extract_trk_pkts(protocols, get_trks_pkts, index):
+        if pkt.pid == protocols.link_proto.PID_TRK_DATA:
+            yield pkt.data
+        else:
             for wpt in pkt.data.wpts: yield wpt
 
-def extract_runs(protocols, get_runs_pkts):
+def newest_run_time(protocols, get_runs_pkts):
+    """
+    Given garmin packets which are result of A1000 (get_runs)
+    return start time of the newest lap, suitable for use
+    as the cursor of an incremental get_runs(), or None
+    if the device has no laps.
+    """
+    laps = get_runs_pkts[1].by_pid[protocols.link_proto.PID_LAP]
+    return max(l.data.start_time.time for l in laps) if laps else None
+
+def extract_runs(protocols, get_runs_pkts, track_indexes=None):
     """
     Given garmin packets which are result of A1000 (get_runs)
-    Return an object tree runs->laps->points for easier processing.
+    Return an Activity for each run. If the track transfer
+    was skipped or aborted (incremental download) only runs
+    which have track data are returned. If track_indexes is
+    provided, only those runs are returned.
     """
     runs, laps, trks = get_runs_pkts
     runs = [r.data for r in runs.by_pid[protocols.link_proto.PID_RUN]]
     laps = [l.data for l in laps.by_pid[protocols.link_proto.PID_LAP]]
+    trk_indexes = trks.ranges(protocols.link_proto.PID_TRK_HDR)
     _log.debug("extract_runs: found %d run(s)", len(runs))
+    # an incremental download only includes tracks of new runs, a
+    # complete transfer ends with PID_XFER_CMPLT
+    incremental = not trks.by_pid[protocols.link_proto.PID_XFER_CMPLT]
+    runs = [r for r in runs if (not incremental or r.track_index in trk_indexes)
+            and (track_indexes is None or r.track_index in track_indexes)]
+    _log.debug("extract_runs: %d run(s) to extract", len(runs))
+    laps_by_index = dict((l.index, l) for l in reversed(laps))
+    activities = []
     for run_num, run in enumerate(runs):
-        run.laps = [l for l in laps if run.first_lap_index <= l.index <= run.last_lap_index]
-        run.time.time = run.laps[0].start_time.time
-        run.wpts = list(extract_wpts(protocols, trks, run.track_index))
-        _log.debug("extract_runs: run %d has: %d lap(s), %d wpt(s)", run_num + 1, len(run.laps), len(run.wpts))
-        for lap in run.laps: lap.wpts = []
-        lap_num = 0
-        for wpt in run.wpts:
-            try:
-                while wpt.time.time >= run.laps[lap_num + 1].start_time.time:
-                    _log.debug("extract_runs: run %d lap %d has: %d wpt(s)",
-                            run_num + 1, lap_num + 1, len(run.laps[lap_num].wpts))
-                    lap_num += 1
-            except IndexError:
-                pass
-            run.laps[lap_num].wpts.append(wpt)
-        all_wpt_in_laps = sum(len(lap.wpts) for lap in run.laps)
-        if len(run.wpts) != all_wpt_in_laps:
+        run_laps = [laps_by_index[n] for n in xrange(run.first_lap_index, run.last_lap_index + 1) if n in laps_by_index]
+        activity = Activity(run, run_laps)
+        for pkt in extract_trk_pkts(protocols, trks, run.track_index):
+            if pkt.pid == protocols.link_proto.PID_TRK_DATA:
+                activity.append(pkt.data)
+            else:
+                activity.extend(pkt.data)
+        activity.assign_laps()
+        _log.debug("extract_runs: run %d has: %d lap(s), %d wpt(s)", run_num + 1, len(activity.laps), len(activity))
+        for lap_num in range(0, len(activity.laps)):
+            _log.debug("extract_runs: run %d lap %d has: %d wpt(s)",
+                    run_num + 1, lap_num + 1, len(activity.lap_points(lap_num)))
+        # points before the first lap started are kept in the first lap
+        all_wpt_in_laps = len(activity) - bisect.bisect_left(activity.time, activity.start_time.time)
+        if len(activity) != all_wpt_in_laps:
             _log.warning("extract_runs: run %d waypoint mismatch: total(%d) != wpt_in_laps(%d)",
-                    run_num + 1, len(run.wpts), all_wpt_in_laps)
-    return runs
+                    run_num + 1, len(activity), all_wpt_in_laps)
+        activities.append(activity)
+    return activities
+
+
+class Activity(object):
+    """
+    A run, its laps, and track points. Track points are
+    stored in columns (array.array), rather than an
+    object per point. Values are stored as the device
+    sent them, except missing alt and distance are NaN.
+    Use point(n) to access a single track point, and
+    lap_points(lap_num) for the indexes of a lap's points.
+    """
+
+    Point = collections.namedtuple("Point", ["time", "valid", "deglat", "deglon", "alt",
+                                             "distance", "heart_rate", "cadence", "sensor"])
+
+    def __init__(self, run, laps):
+        self.run = run
+        self.laps = laps
+        self.sport_type = run.sport_type
+        self.start_time = laps[0].start_time
+        run.time.time = self.start_time.time
+        self.time = array.array("I")
+        self.lat = array.array("i")
+        self.lon = array.array("i")
+        self.alt = array.array("f")
+        self.distance = array.array("f")
+        self.heart_rate = array.array("B")
+        self.cadence = array.array("B")
+        self.sensor = array.array("B")
+        # index of first point of each lap
+        self.lap_start = [0] * len(laps)
+
+    def __len__(self):
+        return len(self.time)
+
+    def append(self, wpt):
+        """
+        Append a D304 track point.
+        """
+        self.time.append(wpt.time.time)
+        self.lat.append(wpt.posn.lat)
+        self.lon.append(wpt.posn.lon)
+        self.alt.append(NAN if wpt.alt is None else wpt.alt)
+        self.distance.append(NAN if wpt.distance is None else wpt.distance)
+        self.heart_rate.append(wpt.heart_rate or 0)
+        self.cadence.append(0xFF if wpt.cadence is None else wpt.cadence)
+        self.sensor.append(wpt.sensor)
+
+    def extend(self, d1018):
+        """
+        Append all track points of a D1018. When decoded by
+        numpy the columns are copied without creating D304s.
+        """
+        if d1018.array is None:
+            for wpt in d1018.wpts: self.append(wpt)
+        else:
+            a = d1018.array
+            # array.array typecodes match numpy's native types
+            self.time.fromstring(a["time"].astype("I").tostring())
+            self.lat.fromstring(a["lat"].astype("i").tostring())
+            self.lon.fromstring(a["lon"].astype("i").tostring())
+            self.alt.fromstring(a["alt"].astype("f").tostring())
+            self.distance.fromstring(a["distance"].astype("f").tostring())
+            self.heart_rate.fromstring(numpy.where(numpy.isnan(a["heart_rate"]), 0, a["heart_rate"]).astype("B").tostring())
+            self.cadence.fromstring(numpy.where(numpy.isnan(a["cadence"]), 0xFF, a["cadence"]).astype("B").tostring())
+            self.sensor.fromstring(a["sensor"].astype("B").tostring())
+
+    def assign_laps(self):
+        """
+        Set the first point of each lap, points belong to the
+        lap which started most recently. Points are assumed
+        to be ordered by time, so each lap's first point is
+        found by binary search of the time column.
+        """
+        start = 0
+        for lap_num in range(1, len(self.laps)):
+            start = max(start, bisect.bisect_left(self.time, self.laps[lap_num].start_time.time))
+            self.lap_start[lap_num] = start
+
+    def lap_points(self, lap_num):
+        """
+        Return the indexes of the given lap's points.
+        """
+        stop = self.lap_start[lap_num + 1] if lap_num + 1 < len(self.laps) else len(self)
+        return xrange(self.lap_start[lap_num], stop)
+
+    def point(self, n):
+        """
+        Return track point n, missing values are None.
+        """
+        lat, lon = self.lat[n], self.lon[n]
+        valid = lat != PositionType.INVALID_SEMI_CIRCLE and lon != PositionType.INVALID_SEMI_CIRCLE
+        alt, distance, cadence = self.alt[n], self.distance[n], self.cadence[n]
+        return self.Point(
+            self.time[n], valid,
+            lat * (180. / 2**31) if valid else None,
+            lon * (180. / 2**31) if valid else None,
+            None if alt != alt else alt,
+            None if distance != distance else distance,
+            self.heart_rate[n] or None,
+            None if cadence == 0xFF else cadence,
+            self.sensor[n])
 
 
 class Device(object):
@@ -306,9 +473,22 @@ class Device(object):
     if the device does not implement a specific
     operation.
     """
+
+    # ACK every packet received (per spec)
+    ACK_EACH = "each"
+    # ACK only the last packet of each burst read from stream,
+    # each ACK is a round trip over the air, so this is faster
+    # when the device sends many packets per burst.
+    ACK_BURST = "burst"
+
+    ack_mode = ACK_EACH
     
-    def __init__(self, stream):
+    def __init__(self, stream, ack_mode=None):
         self.stream = stream
+        if ack_mode is not None: self.ack_mode = ack_mode
+        if self.ack_mode not in (self.ACK_EACH, self.ACK_BURST):
+            raise ValueError("Unknown ack_mode %s." % self.ack_mode)
+        self.checkpoints = {}
         self.init_device_api()
 
     def get_product_data(self):
@@ -317,15 +497,38 @@ class Device(object):
         """
         return self.execute(A000())[0]
 
-    def get_runs(self):
+    def get_runs(self, since=None, sink=None, tracks=True):
         """
-        Get new runs from device.
+        Get new runs from device. If since is provided
+        (see newest_run_time()), runs and laps are still
+        returned in full, but tracks are only downloaded
+        for runs which started after since. Raw packets
+        are written to sink (see RawSink) if provided.
+        If tracks is False only runs and laps are
+        downloaded, see get_tracks(). They are kept
+        until get_tracks() completes, if the link is
+        lost calling get_runs() again replays them.
         """
         if self.run_proto:
-            return self.execute(self.run_proto)
+            self.run_proto.since = since
+            self.run_proto.tracks = tracks
+            return self.execute(self.run_proto, sink, keep_checkpoint=not tracks)
         else:
             raise DeviceNotSupportedError("Device does not support get_runs.")
 
+    def get_tracks(self, runs, sink=None):
+        """
+        Get the tracks skipped by get_runs(tracks=False),
+        runs is the result of get_runs, its (empty) track
+        packets are replaced, and runs is returned.
+        """
+        if not self.run_proto:
+            raise DeviceNotSupportedError("Device does not support get_runs.")
+        if self.run_proto.select_tracks(runs[0], runs[1]):
+            runs[2] = self.execute(self.run_proto.trk_proto, sink)[0]
+        self.checkpoints.pop(self.run_proto.__class__.__name__, None)
+        return runs
+
     def delete_runs(self):
         """
         Delete runs from device.
@@ -338,18 +541,139 @@ class Device(object):
         """
         Initialize the protocols used by this
         instance based on the protocol capabilities
-        array which is return from A000.
+        array which is return from A000. The product
+        data is kept, so it can be saved without
+        another round trip to device.
         """
-        product_data = self.get_product_data()
+        self.product_data = self.get_product_data()
         try:
-            self.device_id = product_data.by_pid[L000.PID_PRODUCT_DATA][0].data
-            self.protocol_array = product_data.by_pid[L000.PID_PROTOCOL_ARRAY][0].data.protocol_array
+            self.device_id = self.product_data.by_pid[L000.PID_PRODUCT_DATA][0].data
+            self.protocol_array = self.product_data.by_pid[L000.PID_PROTOCOL_ARRAY][0].data.protocol_array
             _log.debug("init_device_api: product_id=%d, software_version=%0.2f, description=%s",
                     self.device_id.product_id, self.device_id.software_version/100., self.device_id.description)
             _log.debug("init_device_api: protocol_array=%s", self.protocol_array)
         except (IndexError, TypeError):
             raise DeviceNotSupportedError("Product data not returned by device.")
-        self.data_types_by_protocol = data_types_by_protocol(self.protocol_array)
+        self.profile = DeviceProfile.get(self.device_id, self.protocol_array)
+        self.data_types_by_protocol = self.profile.data_types_by_protocol
+        self.link_proto = self.profile.link_proto()
+        self.cmd_proto = self.profile.cmd_proto()
+        self.trk_proto = self.profile.create_app_protocol(self, "get_trks")
+        self.lap_proto = self.profile.create_app_protocol(self, "get_laps")
+        self.run_proto = self.profile.create_app_protocol(self, "get_runs")
+
+    def execute(self, protocol, sink=None, keep_checkpoint=False):
+        """
+        Execute the give garmin Applection protcol.
+        e.g. one of the Annn classes.
+        The result of each completed command is saved
+        until the whole protocol succeeds. If execution
+        fails (e.g. link to device was lost), executing
+        the same protocol again resumes from the first
+        incomplete command. If sink is provided, each
+        packet is written to it as soon as it is received,
+        and committed when the command's reply is complete.
+        If keep_checkpoint is True, saved results are kept
+        after success, the caller must remove them from
+        checkpoints once they are no longer needed.
+        """
+        name = protocol.__class__.__name__
+        checkpoint = self.checkpoints.setdefault(name, {})
+        result = self._execute(protocol, checkpoint, (), sink)
+        if not keep_checkpoint: del self.checkpoints[name]
+        return result
+
+    def _execute(self, protocol, checkpoint, path, sink=None):
+        result = []
+        steps = iter(protocol.execute())
+        step = 0
+        reply = None
+        while True:
+            # generators are sent the result of their previous step
+            try: next = steps.send(reply) if step and hasattr(steps, "send") else steps.next()
+            except StopIteration: break
+            key = path + (step,)
+            if hasattr(next, "execute"):
+                reply = self._execute(next, checkpoint, key, sink)
+                result.extend(reply)
+            elif key in checkpoint:
+                _log.debug("%s: skipping completed step %s.", protocol.__class__.__name__, key)
+                reply = checkpoint[key]
+                result.append(reply)
+                if sink:
+                    # resumed download may be written to a new file
+                    for pid, length, data in reply:
+                        sink.write(pid, length, data.raw if data else None)
+                    sink.commit()
+            else:
+                pid, data = next
+                in_packets = []
+                aborted = False
+                try:
+                    self.stream.write(pack(pid, data))
+                    while True:
+                        pkt = self.stream.read()
+                        if not pkt: break
+                        for pid, length, raw in tokenize(pkt):
+                            data = protocol.decode_packet(pid, length, raw)
+                            if not aborted and protocol.is_complete(pid, data):
+                                _log.debug("%s: have all requested data, aborting transfer.", protocol.__class__.__name__)
+                                self.stream.write(pack(self.link_proto.PID_COMMAND_DATA, self.cmd_proto.CMND_ABORT_TRANSFER))
+                                aborted = True
+                            if not aborted:
+                                in_packets.append((pid, length, data))
+                                if sink: sink.write(pid, length, raw)
+                            if self.ack_mode == self.ACK_EACH:
+                                self.stream.write(pack(P000.PID_ACK, pid))
+                        if self.ack_mode == self.ACK_BURST:
+                            self.stream.write(pack(P000.PID_ACK, pid))
+                except Exception:
+                    # reply is incomplete, it will be requested again on resume
+                    if sink: sink.rollback()
+                    raise
+                in_packets.append((0, 0, None))
+                if sink:
+                    sink.write(0, 0, None)
+                    sink.commit()
+                checkpoint[key] = reply = protocol.decode_list(in_packets)
+                result.append(reply)
+            step += 1
+
+        return protocol.decode_result(result)
+
+
+class DeviceProfile(object):
+    """
+    The protocol and datatype classes used for a device,
+    resolved from its protocol array. Profiles are cached
+    by (product_id, software_version, protocol_array), so
+    resolution (and its warnings) happen once per model and
+    firmware, not for every Device created by the daemon,
+    or every raw file replayed by tcx.export_tcx.
+    """
+
+    _cache = {}
+
+    @classmethod
+    def get(cls, device_id, protocol_array):
+        """
+        Return the cached profile for given ProductDataType
+        and protocol array, creating one if necessary.
+        """
+        key = (device_id.product_id, device_id.software_version, tuple(protocol_array))
+        try:
+            return cls._cache[key]
+        except KeyError:
+            profile = cls._cache[key] = cls(protocol_array)
+            return profile
+
+    def __init__(self, protocol_array):
+        self.protocol_array = protocol_array
+        self.data_types_by_protocol = data_types_by_protocol(protocol_array)
+        # function_name -> (protocol class, datatype classes)
+        self.app_protocols = {}
+        # optional functions this device can't perform
+        self.skip = set()
         # the tuples in this section define an ordered collection
         # of protocols which are candidates to provide each specific
         # function. Each proto will be device based on the first one
@@ -358,9 +682,9 @@ class Device(object):
         # needs to be supported.
         self.link_proto = self._find_core_protocol("link", (L000, L001))
         self.cmd_proto = self._find_core_protocol("command", (A010,))
-        self.trk_proto = self._find_app_protocol("get_trks", (A301, A302))
-        self.lap_proto = self._find_app_protocol("get_laps", (A906,))
-        self.run_proto = self._find_app_protocol("get_runs", (A1000,))
+        self._find_app_protocol("get_trks", (A301, A302))
+        self._find_app_protocol("get_laps", (A906,))
+        self._find_app_protocol("get_runs", (A1000,))
 
     def _find_core_protocol(self, name, candidates):
         """
@@ -373,11 +697,11 @@ class Device(object):
         else:
             raise DeviceNotSupportedError("Device does not implement a known link protocol. capabilities=%s" 
                     % self.protocol_array)
-        return proto()
+        return proto
 
     def _find_app_protocol(self, function_name, candidates):
         """
-        Return the first protocol in candidates whihc
+        Find the first protocol in candidates whihc
         is supported by this device. additionally, check
         that the datatypes which are returned by the give
         protocol are implented by this python module.
@@ -385,42 +709,29 @@ class Device(object):
         This allows raw data dump to succeed, but trx generation to fail.
         """
         cls = get_proto_cls(self.protocol_array, candidates)
-        data_types = self.data_types_by_protocol.get(cls.__name__, [])
-        data_type_cls = [globals().get(nm, DataType) for nm in data_types]
         if not cls:
             _log.warning("Download may FAIL. Protocol unimplemented. %s:%s", function_name, candidates)
+            self.skip.add(function_name)
         else:
+            data_types = self.data_types_by_protocol.get(cls.__name__, [])
+            data_type_cls = [globals().get(nm, DataType) for nm in data_types]
             _log.debug("Using %s%s for: %s", cls.__name__, data_types, function_name)
             if DataType in data_type_cls:
                 _log.warning("Download may FAIL. DataType unimplemented. %s:%s%s", function_name, cls.__name__, data_types)
-            try:
-                return cls(self, *data_type_cls)
-            except Exception:
-                _log.warning("Download may Fail. Failed to ceate protocol %s.", function_name, exc_info=True)
+            self.app_protocols[function_name] = (cls, data_type_cls)
 
-    def execute(self, protocol):
+    def create_app_protocol(self, device, function_name):
         """
-        Execute the give garmin Applection protcol.
-        e.g. one of the Annn classes.
+        Return a new instance of the protocol used for
+        function_name, or None if device can't perform it.
         """
-        result = []
-        for next in protocol.execute():
-            if hasattr(next, "execute"):
-                result.extend(self.execute(next))
-            else:
-                pid, data = next
-                in_packets = []
-                self.stream.write(pack(pid, data))
-                while True:
-                    pkt = self.stream.read()
-                    if not pkt: break
-                    for pid, length, data in tokenize(pkt):
-                        in_packets.append((pid, length, protocol.decode_packet(pid, length, data)))
-                        self.stream.write(pack(P000.PID_ACK, pid))
-                in_packets.append((0, 0, None))
-                result.append(protocol.decode_list(in_packets))
-
-        return protocol.decode_result(result)
+        if function_name in self.skip: return None
+        cls, data_type_cls = self.app_protocols[function_name]
+        try:
+            return cls(device, *data_type_cls)
+        except Exception:
+            _log.warning("Download may Fail. Failed to ceate protocol %s.", function_name, exc_info=True)
+            self.skip.add(function_name)
 
 
 class MockHost(object):
@@ -448,14 +759,315 @@ class MockHost(object):
             return ""
 
     def _read(self, data):
-        while data:
-            (length,) = struct.unpack("<H", data[2:4])
-            if length: pkt = data[0:length + 4]
+        # packets are sliced by offset, slicing off
+        # the head of data would copy the remainder.
+        offset = 0
+        while offset + 4 <= len(data):
+            (length,) = struct.unpack("<H", data[offset + 2:offset + 4])
+            if length: pkt = data[offset:offset + length + 4]
             else: pkt = ""
-            data = data[length + 4:]
+            offset += length + 4
             yield pkt
 
 
+class RawFile(MockHost):
+    """
+    A MockHost which replays the given raw file.
+    The file is mmap'd rather than read into memory,
+    only the packets read are copied out of the map.
+    Runs, laps, and tracks can also be read directly
+    using the file's RawIndex, without replay.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with open(file_name, "rb") as file:
+            if os.fstat(file.fileno()).st_size:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # empty files can't be mapped
+                self.map = None
+        self.data = self.map if self.map is not None else ""
+        self._index = None
+        self._data_type_by_pid = None
+        super(RawFile, self).__init__(self.data)
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = RawIndex.load(self.file_name, self.data)
+        return self._index
+
+    def section(self, n):
+        """
+        Return the raw packets of the n-th reply
+        stored in file, including terminator.
+        """
+        sections = self.index.sections
+        stop = sections[n + 1] if n + 1 < len(sections) else len(self.data)
+        return self.data[sections[n]:stop]
+
+    def packet(self, offset):
+        """
+        Return the decoded packet at given offset.
+        """
+        pid, length = struct.unpack("<HH", self.data[offset:offset + 4])
+        data = self.data[offset + 4:offset + 4 + length]
+        return pid, length, self.data_type_by_pid.get(pid, DataType).decode(data) if length else None
+
+    def records(self, pid):
+        """
+        Return the data of every packet with given
+        pid, pid must be one of RawIndex.pids.
+        """
+        return [self.packet(offset)[2] for offset in self.index.offsets(pid)]
+
+    def track(self, index):
+        """
+        Return the packets of the given track
+        index, the header and its track points.
+        """
+        start, stop = self._track_span(index)
+        result = []
+        while start < stop:
+            pkt = self.packet(start)
+            result.append(pkt)
+            start += pkt[1] + 4
+        return result
+
+    def track_data(self, index):
+        """
+        Return the raw packets of the given track
+        index, the header and its track points.
+        """
+        start, stop = self._track_span(index)
+        return self.data[start:stop]
+
+    def track_points(self, index):
+        """
+        Return the number of track points of the
+        given track index, points are not decoded.
+        """
+        return sum(data.num_valid_wpt if pid == L001.PID_TRK_DATA_ARRAY else 1
+                   for pid, length, data in self.track(index)[1:])
+
+    def tracks_complete(self):
+        """
+        Return True if the file has a complete track transfer,
+        False if it was skipped or aborted, and only tracks of
+        new runs were downloaded (see extract_runs).
+        """
+        sections = self.index.sections
+        if not sections: return False
+        for pid, length, data in tokenize(self.section(len(sections) - 1)):
+            if pid == L001.PID_XFER_CMPLT and length >= 2:
+                return struct.unpack("<H", data[:2])[0] == A010.CMND_TRANSFER_TRK
+        return False
+
+    def _track_span(self, index):
+        """
+        Return (start, stop) offsets of the packets of
+        the given track index, (0, 0) if not in file.
+        """
+        for start in self.index.offsets(L001.PID_TRK_HDR):
+            if self.packet(start)[2].index != index: continue
+            offset = start
+            while True:
+                (length,) = struct.unpack("<H", self.data[offset + 2:offset + 4])
+                offset += length + 4
+                if offset + 4 > len(self.data): break
+                (pid,) = struct.unpack("<H", self.data[offset:offset + 2])
+                if pid in (0, L001.PID_TRK_HDR, L001.PID_XFER_CMPLT): break
+            return start, offset
+        return 0, 0
+
+    @property
+    def data_type_by_pid(self):
+        """
+        Datatypes of the device which created this file,
+        found by replaying the product data (first reply).
+        """
+        if self._data_type_by_pid is None:
+            device = Device(MockHost(self.section(0)))
+            self._data_type_by_pid = {}
+            for proto in (device.link_proto, device.trk_proto, device.lap_proto, device.run_proto):
+                if proto: self._data_type_by_pid.update(proto.data_type_by_pid)
+        return self._data_type_by_pid
+
+    def close(self):
+        if self.map is not None: self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class RawIndex(object):
+    """
+    Offsets of the packets in a raw file which are needed
+    to find runs, laps and tracks without replaying the
+    whole file: the start of each reply (section), and
+    each product data, run, lap and track header packet.
+    The index is saved beside the raw file, raw_file.idx.
+    """
+
+    MAGIC = "ANTDIDX1"
+    # pid of entries marking the start of a reply
+    SECTION = 0
+    pids = (L000.PID_PRODUCT_DATA, L000.PID_PROTOCOL_ARRAY, L001.PID_RUN, L001.PID_LAP, L001.PID_TRK_HDR)
+
+    def __init__(self, size, entries):
+        # size of raw file, when indexed
+        self.size = size
+        # [(pid, offset), ...] in file order
+        self.entries = entries
+        self.sections = self.offsets(self.SECTION)
+
+    def offsets(self, pid):
+        return [offset for entry_pid, offset in self.entries if entry_pid == pid]
+
+    @classmethod
+    def build(cls, data):
+        """
+        Return index of the given raw packets (str or mmap).
+        """
+        entries = []
+        offset = 0
+        section_start = True
+        while offset + 4 <= len(data):
+            pid, length = struct.unpack("<HH", data[offset:offset + 4])
+            if section_start: entries.append((cls.SECTION, offset))
+            if pid in cls.pids: entries.append((pid, offset))
+            section_start = not pid and not length
+            offset += length + 4
+        return cls(len(data), entries)
+
+    @classmethod
+    def read(cls, file_name):
+        with open(file_name, "rb") as file:
+            data = file.read()
+        if data[:len(cls.MAGIC)] != cls.MAGIC:
+            raise ValueError("%s is not an index." % file_name)
+        size, count = struct.unpack_from("<II", data, len(cls.MAGIC))
+        values = struct.unpack_from("<" + "HI" * count, data, len(cls.MAGIC) + 8)
+        return cls(size, zip(values[::2], values[1::2]))
+
+    def save(self, file_name):
+        with open(file_name, "wb") as file:
+            file.write(self.MAGIC + struct.pack("<II", self.size, len(self.entries)))
+            file.write(struct.pack("<" + "HI" * len(self.entries), *[v for e in self.entries for v in e]))
+
+    @classmethod
+    def load(cls, raw_file_name, data=None):
+        """
+        Return the index of given raw file. The saved index
+        is used unless it is missing, or the raw file has
+        changed size since it was written (e.g. download
+        was still in progress), then the index is rebuilt.
+        """
+        idx_file_name = raw_file_name + ".idx"
+        size = os.path.getsize(raw_file_name)
+        try:
+            index = cls.read(idx_file_name)
+            if index.size == size: return index
+        except (IOError, ValueError, struct.error):
+            pass
+        if data is None:
+            with open(raw_file_name, "rb") as file:
+                data = file.read()
+        index = cls.build(data)
+        try:
+            index.save(idx_file_name)
+        except IOError:
+            _log.debug("Could not save index %s.", idx_file_name, exc_info=True)
+        return index
+
+
+class RawSink(object):
+    """
+    Writes raw packets to file as they are downloaded,
+    in the format of dump(), so a download which fails
+    part way is still saved. Writes are made by a
+    background thread, so file io doesn't delay the ACKs.
+    commit() is called at the end of each command's
+    reply, file is flushed and fsync'd. rollback()
+    discards packets written since last commit, e.g.
+    the partial reply of a command which failed, it
+    will be requested again when download resumes.
+    """
+
+    _COMMIT = object()
+    _ROLLBACK = object()
+
+    def __init__(self, file):
+        self.file = file
+        self.committed = file.tell()
+        self.error = None
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.loop, name="raw-sink")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, pid, length, data):
+        self.check_error()
+        self.queue.put(struct.pack("<HH", pid, length) + (data or ""))
+
+    def commit(self):
+        self.check_error()
+        self.queue.put(self._COMMIT)
+
+    def rollback(self):
+        self.queue.put(self._ROLLBACK)
+
+    def flush(self):
+        """
+        Wait for all queued packets to be written.
+        """
+        self.queue.join()
+        self.check_error()
+
+    def close(self):
+        """
+        Wait for all queued packets to be written, file
+        is not closed. Uncommitted packets are discarded.
+        """
+        self.rollback()
+        self.queue.put(None)
+        self.thread.join()
+        self.check_error()
+
+    def check_error(self):
+        if self.error:
+            raise IOError("Failed writing raw packets to %s." % self.file.name, self.error)
+
+    def loop(self):
+        while True:
+            msg = self.queue.get()
+            try:
+                if msg is None:
+                    break
+                elif self.error:
+                    pass
+                elif msg is self._COMMIT:
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                    self.committed = self.file.tell()
+                elif msg is self._ROLLBACK:
+                    if self.file.tell() != self.committed:
+                        _log.debug("RawSink: discarding %d byte(s) of incomplete reply.", self.file.tell() - self.committed)
+                        self.file.seek(self.committed)
+                        self.file.truncate()
+                else:
+                    self.file.write(msg)
+            except Exception as e:
+                _log.error("RawSink: write to %s failed.", self.file.name, exc_info=True)
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+
 class Protocol(object):
     """
     A protocol defines the required comands
@@ -485,11 +1097,18 @@ class Protocol(object):
         """
         if length:
             data_cls = self.data_type_by_pid.get(pid, DataType)
-            return data_cls(data)
+            return data_cls.decode(data)
 
     def decode_list(self, pkts):
         return PacketList(pkts)
 
+    def is_complete(self, pid, data):
+        """
+        Return True if the given packet is not needed,
+        and the rest of the transfer can be aborted.
+        """
+        return False
+
     def decode_result(self, list):
         return list
 
@@ -575,12 +1194,36 @@ class A1000(DownloadProtocol):
             self.link_proto.PID_RUN: run_type,
         })
         self.pid_data = [self.link_proto.PID_RUN]
+        # only download tracks of runs newer than since
+        self.since = None
+        # if False, only runs and laps are downloaded
+        self.tracks = True
         
     def execute(self):
         _log.debug("A1000: executing transfer runs")
-        yield (self.link_proto.PID_COMMAND_DATA, self.cmd_proto.CMND_TRANSFER_RUNS)
-        yield self.lap_proto
-        yield self.trk_proto
+        runs = yield (self.link_proto.PID_COMMAND_DATA, self.cmd_proto.CMND_TRANSFER_RUNS)
+        laps = yield self.lap_proto
+        if self.select_tracks(runs, laps[0]) and self.tracks:
+            yield self.trk_proto
+
+    def select_tracks(self, runs, laps):
+        """
+        Set the tracks which need to be downloaded, given
+        runs and laps. Return False if there are none.
+        """
+        self.trk_proto.track_indexes = None
+        if self.since is not None:
+            new_laps = set(l.data.index for l in laps.by_pid[self.link_proto.PID_LAP]
+                           if l.data.start_time.time > self.since)
+            self.trk_proto.track_indexes = set(r.data.track_index for r in runs.by_pid[self.link_proto.PID_RUN]
+                                               if r.data.first_lap_index in new_laps)
+            _log.debug("A1000: %d new run(s) since %d.", len(self.trk_proto.track_indexes), self.since)
+        return self.trk_proto.track_indexes is None or bool(self.trk_proto.track_indexes)
+
+    def decode_result(self, list):
+        # tracks are skipped when there are no new runs
+        if len(list) < 3: list.append(PacketList([(0, 0, None)]))
+        return list
 
 
 class A301(DownloadProtocol):
@@ -600,11 +1243,34 @@ class A301(DownloadProtocol):
             self.link_proto.PID_TRK_DATA,
             self.link_proto.PID_TRK_DATA_ARRAY,
         ]
+        # if set, transfer is aborted once all these tracks are received
+        self.track_indexes = None
 
     def execute(self):
         _log.debug("A301: executing transfer tracks")
+        self.remaining = set(self.track_indexes or [])
+        self.trk_index = None
         yield (self.link_proto.PID_COMMAND_DATA, self.cmd_proto.CMND_TRANSFER_TRK)
 
+    def is_complete(self, pid, data):
+        """
+        A track is complete when the next track header
+        arrives, so skipping the unwanted tracks which
+        follow the last requested one.
+        """
+        if self.track_indexes is None or pid != self.link_proto.PID_TRK_HDR:
+            return False
+        self.remaining.discard(self.trk_index)
+        self.trk_index = data.index
+        return not self.remaining
+
+    def on_finish(self, pid, data):
+        if self.track_indexes is not None and not self.remaining:
+            _log.info("%s: Finished download. Aborted after %d requested track(s).",
+                    self.__class__.__name__, len(self.track_indexes))
+        else:
+            super(A301, self).on_finish(pid, data)
+
     def on_data(self, pid, data):
         """
         PID_TRK_DATA_ARRAY return multiple data objects per
@@ -645,12 +1311,31 @@ class PacketList(list):
     def __init__(self, iterable):
         super(PacketList, self).__init__(self.Packet(*i) for i in iterable)
         self._update_packets_by_id()
+        self._ranges = {}
 
     def _update_packets_by_id(self):
         d = collections.defaultdict(list)
         for pkt in self: d[pkt[0]].append(pkt)
         self.by_pid = d
 
+    def ranges(self, hdr_pid, key="index"):
+        """
+        Return a dict mapping the key of each header
+        packet (e.g. PID_TRK_HDR's index) to the (start, stop)
+        slice of the packets which follow it, up to
+        the next header. Built once, on first use.
+        """
+        try:
+            return self._ranges[hdr_pid, key]
+        except KeyError:
+            ranges = {}
+            hdrs = [n for n, pkt in enumerate(self) if pkt.pid == hdr_pid] + [len(self)]
+            for start, stop in zip(hdrs, hdrs[1:]):
+                # first header wins if key is repeated
+                ranges.setdefault(getattr(self[start].data, key), (start + 1, stop))
+            self._ranges[hdr_pid, key] = ranges
+            return ranges
+
 
 class DataType(object):
     """
@@ -658,26 +1343,152 @@ class DataType(object):
     interpruts the data payload of a garmin packet.
     Default implentation save message .raw property
     but provides no addition properties.
+
+    Subclasses describe their fields declaratively in
+    layout, a list of (struct_format, [arg_names]) or
+    (DataType, arg_name). The layout is compiled once
+    per class, and fields are unpacked in place at a
+    running offset in raw, no copies of the data are made.
+    Values derived from the unpacked fields are set by
+    _decoded(). Types which parse more than their layout
+    (e.g. arrays) override __init__.
     """
 
-    def __init__(self, raw_str):
+    layout = []
+    # if false, decode() returns a LazyDataType
+    decode_eagerly = False
+    # fields of the first layout entry which LazyDataType decodes
+    eager_fields = []
+
+    @classmethod
+    def decode(cls, raw_str):
+        """
+        Return an instance of this type for raw_str,
+        which is not decoded until used, unless
+        decode_eagerly is set.
+        """
+        if cls.decode_eagerly:
+            return cls(raw_str)
+        else:
+            return LazyDataType(cls, raw_str)
+
+    def __init__(self, raw_str, offset=0):
         self.raw = raw_str
-        self.unparsed = self.raw
+        self._offset = self._end = offset
+        self._stop = len(raw_str)
         self.str_args = []
+        for compiled in self.compiled_layout():
+            if len(compiled) == 3:
+                self._unpack_struct(*compiled)
+            else:
+                self._parse(*compiled)
+        self._decoded()
+
+    def _decoded(self):
+        """
+        Called once all fields of layout are unpacked.
+        """
+
+    @classmethod
+    def compiled_layout(cls):
+        """
+        Return layout compiled to a list of (struct.Struct, segments, str_args)
+        or (DataType, arg_name), see merged_layout(). A segment is (DataType
+        or None, arg_name, arg_names, start, stop, offset): values[start:stop]
+        of the struct are set as arg_names of this instance if DataType is
+        None, else as the fields of a DataType instance set as arg_name,
+        whose data starts offset bytes into the struct.
+        """
+        compiled = cls.__dict__.get("_compiled_layout")
+        if compiled is None:
+            compiled = []
+            for format, items in cls.merged_layout():
+                if not isinstance(format, basestring):
+                    compiled.append((format, items))
+                    continue
+                compiled_struct = get_struct(format)
+                offsets = value_offsets(format)
+                segments, str_args, n = [], [], 0
+                for type, arg_name, arg_names in items:
+                    # nested types keep offset of their first value
+                    segments.append((type, arg_name, arg_names, n, n + len(arg_names), offsets[n] if arg_names else 0))
+                    str_args.extend(arg_names if type is None else [arg_name])
+                    n += len(arg_names)
+                assert n == len(compiled_struct.unpack_from("\x00" * compiled_struct.size))
+                compiled.append((compiled_struct, segments, str_args))
+            cls._compiled_layout = compiled
+        return compiled
+
+    @classmethod
+    def merged_layout(cls):
+        """
+        Return layout with entries merged into as few struct formats
+        as possible, a list of (format, [(DataType or None, arg_name,
+        arg_names), ...]) or (DataType, arg_name). Consecutive entries
+        with little-endian ("<") formats are joined into one format.
+        A nested type which is_fixed_size() is joined the same way,
+        using its own format, any other nested type is parsed on its
+        own and ends the format being joined.
+        """
+        merged = []
+        for format, arg_names in cls.layout:
+            if isinstance(format, basestring):
+                items = [(None, None, arg_names)]
+            elif format.is_fixed_size():
+                ((nested_struct, segments, nested_arg_names),) = format.compiled_layout()
+                items = [(format, arg_names, nested_arg_names)]
+                format = nested_struct.format
+            else:
+                merged.append((format, arg_names))
+                continue
+            if merged and isinstance(merged[-1][0], basestring) and merged[-1][0][0] == format[0] == "<":
+                last_format, last_items = merged.pop()
+                format, items = last_format + format[1:], last_items + items
+            merged.append((format, items))
+        return merged
+
+    @classmethod
+    def is_fixed_size(cls):
+        """
+        True if this type is only the fields of its layout, compiled
+        to a single struct with no nested types, e.g. PositionType.
+        It can be unpacked as part of the struct of a containing type.
+        """
+        if cls.__init__.im_func is not DataType.__init__.im_func:
+            return False
+        compiled = cls.compiled_layout()
+        return (len(compiled) == 1 and len(compiled[0]) == 3
+                and [segment[0] for segment in compiled[0][1]] == [None])
+
+    @property
+    def unparsed(self):
+        return self.raw[self._end:self._stop]
 
     def _unpack(self, format, arg_names):
         """
         Use the givem format to extract the give
         proeprty names from this instance unparsed text.
         """
-        sz = struct.calcsize(format)
-        data = self.unparsed[:sz]
-        self.unparsed = self.unparsed[sz:]
-        args = struct.unpack(format, data)
-        assert len(args) == len(arg_names)
-        for name, arg in zip(arg_names, args):
-            setattr(self, name, arg)
-        self.str_args.extend(arg_names)
+        self._unpack_struct(get_struct(format), [(None, None, arg_names, 0, len(arg_names), 0)], arg_names)
+
+    def _unpack_struct(self, compiled, segments, str_args):
+        offset = self._end
+        args = compiled.unpack_from(self.raw, offset)
+        self._end = offset + compiled.size
+        for type, arg_name, arg_names, start, stop, nested_offset in segments:
+            if type is None:
+                self.__dict__.update(zip(arg_names, args[start:stop]))
+            else:
+                # fixed size nested type, values already unpacked
+                data = type.__new__(type)
+                data.__dict__.update(zip(arg_names, args[start:stop]))
+                data.raw = self.raw
+                data._offset = offset + nested_offset
+                data._end = data._stop = data._offset + type._compiled_layout[0][0].size
+                data.str_args = list(arg_names)
+                data._decoded()
+                setattr(self, arg_name, data)
+        self.str_args.extend(str_args)
         
     def _parse(self, type, arg_name=None):
         """
@@ -686,12 +1497,11 @@ class DataType(object):
         If arg_name is provided, result will be
         assigned as attribute of this instance.
         """
-        data = type(self.unparsed)
+        data = type(self.raw, self._end)
         if arg_name:
             setattr(self, arg_name, data)
             self.str_args.append(arg_name)
-        self.unparsed = data.unparsed
-        data.unparsed = ""
+        self._end = data._stop = data._end
         return data
 
     def __str__(self):
@@ -706,13 +1516,47 @@ class DataType(object):
         return self.__str__()
 
 
+class LazyDataType(object):
+    """
+    A packet's raw data tagged with its DataType. On first
+    access of an attribute other than raw, data_type or
+    data_type.eager_fields the data is decoded, and this
+    instance becomes an instance of data_type.
+    """
+
+    def __init__(self, data_type, raw_str):
+        self.raw = raw_str
+        self.data_type = data_type
+        if data_type.eager_fields:
+            compiled, segments, str_args = data_type.compiled_layout()[0]
+            args = compiled.unpack_from(raw_str)
+            self.__dict__.update((k, v) for k, v in zip(str_args, args) if k in data_type.eager_fields)
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        self._decode()
+        return getattr(self, name)
+
+    def _decode(self):
+        data = self.data_type(self.raw)
+        self.__class__ = data.__class__
+        self.__dict__ = data.__dict__
+
+    def __str__(self):
+        self._decode()
+        return str(self)
+
+    def __repr__(self):
+        self._decode()
+        return repr(self)
+
+
 class TimeType(DataType):
     
     EPOCH = 631065600 # Dec 31, 1989 @ 12:00am UTC  
 
-    def __init__(self, data):
-       super(TimeType, self).__init__(data)
-       self._unpack("<I", ["time"])
+    layout = [("<I", ["time"])]
 
     @property
     def gmtime(self):
@@ -722,70 +1566,68 @@ class PositionType(DataType):
     
     INVALID_SEMI_CIRCLE = 2**31 - 1
 
-    def __init__(self, data):
-        super(PositionType, self).__init__(data)
-        self._unpack("<ii", ["lat", "lon"])
+    layout = [("<ii", ["lat", "lon"])]
+
+    def _decoded(self):
         self.valid = self.lat != self.INVALID_SEMI_CIRCLE and self.lon != self.INVALID_SEMI_CIRCLE
         if self.valid:
             self.deglat = self.lat * (180. / 2**31)
             self.deglon = self.lon * (180. / 2**31)
         else:
-            self.deglat, self.deflon, lat, lon = [None] * 4
+            self.deglat, self.deglon = None, None
 
 
 class CommandIdType(DataType):
     
-    def __init__(self, data):
-        super(CommandIdType, self).__init__(data)
-        self._unpack("<H", ["command_id"])
+    layout = [("<H", ["command_id"])]
 
 
 class RecordsType(DataType):
 
-    def __init__(self, data):
-        super(RecordsType, self).__init__(data)
-        self._unpack("<H", ["count"])
+    layout = [("<H", ["count"])]
+    decode_eagerly = True
 
 
 class ProductDataType(DataType):
 
-    def __init__(self, data):
-        super(ProductDataType, self).__init__(data)
-        self._unpack("<Hh", ["product_id", "software_version"])
+    layout = [("<Hh", ["product_id", "software_version"])]
+
+    def __init__(self, data, offset=0):
+        super(ProductDataType, self).__init__(data, offset)
         self.description = [str for str in self.unparsed.split("\x00") if str]
         self.str_args.append("description")
 
 
 class ExtProductDataType(DataType):
     
-    def __init__(self, data):
-        super(ExtProductDataType, self).__init__(data)
-        self.description = [str for str in data.split("\x00") if str]
+    def __init__(self, data, offset=0):
+        super(ExtProductDataType, self).__init__(data, offset)
+        self.description = [str for str in self.unparsed.split("\x00") if str]
         self.str_args.append("description")
 
 
 class ProtocolArrayType(DataType):
     
-    def __init__(self, data):
-        super(ProtocolArrayType, self).__init__(data)
-        self.protocol_array = ["%s%03d" % (proto, ord(msb) << 8 | ord(lsb)) for proto, lsb, msb in chunk(data, 3)]
+    def __init__(self, data, offset=0):
+        super(ProtocolArrayType, self).__init__(data, offset)
+        self.protocol_array = ["%s%03d" % (proto, ord(msb) << 8 | ord(lsb)) for proto, lsb, msb in chunk(self.unparsed, 3)]
         self.str_args.append("protocol_array")
 
 
 class WorkoutStepType(DataType):
 
-    def __init__(self, data):
-        super(WorkoutStepType, self).__init__(data)
-        self._unpack("<16sffHBBBB2x", [
-            "custom_name",
-            "target_custom_zone_low",
-            "target_cusomt_zone_hit",
-            "duration_value",
-            "intensity",
-            "duration_type",
-            "target_type",
-            "target_value",
-        ])
+    layout = [("<16sffHBBBB2x", [
+        "custom_name",
+        "target_custom_zone_low",
+        "target_cusomt_zone_hit",
+        "duration_value",
+        "intensity",
+        "duration_type",
+        "target_type",
+        "target_value",
+    ])]
+
+    def _decoded(self):
         self.custom_name = self.custom_name[:self.custom_name.index("\x00")]
 
 
@@ -794,9 +1636,10 @@ class D1008(DataType):
     Workout
     """
     
-    def __init__(self, data):
-        super(D1008, self).__init__(data)
-        self._unpack("<I", ["num_valid_steps"])
+    layout = [("<I", ["num_valid_steps"])]
+
+    def __init__(self, data, offset=0):
+        super(D1008, self).__init__(data, offset)
         self.steps = [None] * self.num_valid_steps
         for step_num in xrange(0, self.num_valid_steps):
             self.steps[step_num] = self._parse(WorkoutStepType)
@@ -809,22 +1652,19 @@ class D1009(DataType):
     Run
     """
 
-    def __init__(self, data):
-        super(D1009, self).__init__(data)
-        self._unpack("<HHHBBBx2x", [
+    layout = [
+        ("<HHHBBBx2x", [
             "track_index",
             "first_lap_index",
             "last_lap_index",
             "sport_type",
             "program_type",
             "multisport",
-        ])
-        self._parse(TimeType, "time")
-        self._unpack("<f", ["distance"])
-        self.workout = D1008(self.unparsed)
-        self.unparsed = self.workout.unparsed
-        self.workout.unparsed = ""
-        self.str_args.append("workout")
+        ]),
+        (TimeType, "time"),
+        ("<f", ["distance"]),
+        (D1008, "workout"),
+    ]
 
 
 class D1011(DataType):
@@ -832,25 +1672,27 @@ class D1011(DataType):
     Lap
     """
 
-    def __init__(self, data):
-        super(D1011, self).__init__(data)
-        self._unpack("<H2x", ["index"])
-        self._parse(TimeType, "start_time")
-        self._unpack("<Iff", [
+    layout = [
+        ("<H2x", ["index"]),
+        (TimeType, "start_time"),
+        ("<Iff", [
             "total_time",
             "total_dist",
             "max_speed",
-        ])
-        self._parse(PositionType, "begin")
-        self._parse(PositionType, "end")
-        self._unpack("HBBBBB", [
+        ]),
+        (PositionType, "begin"),
+        (PositionType, "end"),
+        ("<HBBBBB", [
             "calories",
             "avg_heart_rate",
             "max_heart_rate",
             "intensity",
             "avg_cadence",
             "trigger_method",
-        ])
+        ]),
+    ]
+
+    def _decoded(self):
         if self.avg_heart_rate == 0: self.avg_heart_rate = None
         if self.max_heart_rate == 0: self.max_heart_rate = None
         if self.avg_cadence == 0xFF: self.avg_cadence = None
@@ -861,15 +1703,15 @@ class D1015(D1011):
     Lap + extra mystery bytes
     """
 
-    def __init__(self, data):
-        super(D1015, self).__init__(data)
-        self._unpack("BBBBB", [
+    layout = D1011.layout + [
+        ("<BBBBB", [
             "undocumented_0",
             "undocumented_1",
             "undocumented_2",
             "undocumented_3",
             "undocumented_4",
-        ])
+        ]),
+    ]
 
 
 class D311(DataType):
@@ -877,9 +1719,7 @@ class D311(DataType):
     wpt header
     """
     
-    def __init__(self, data):
-        super(D311, self).__init__(data)
-        self._unpack("<H", ["index"])
+    layout = [("<H", ["index"])]
 
 
 class D304(DataType):
@@ -889,17 +1729,19 @@ class D304(DataType):
     
     INVALID_FLOAT = struct.unpack("<f", "\x51\x59\x04\x69")[0]
 
-    def __init__(self, data):
-        super(D304, self).__init__(data)
-        self._parse(PositionType, "posn")
-        self._parse(TimeType, "time")
-        self._unpack("<ffBBB", [
+    layout = [
+        (PositionType, "posn"),
+        (TimeType, "time"),
+        ("<ffBBB", [
             "alt",
             "distance",
             "heart_rate",
             "cadence",
             "sensor",
-        ])
+        ]),
+    ]
+
+    def _decoded(self):
         if self.alt == self.INVALID_FLOAT: self.alt = None
         if self.distance == self.INVALID_FLOAT: self.distance = None
         if self.cadence == 0xFF: self.cadence = None
@@ -910,17 +1752,124 @@ class D1018(DataType):
     """
     An array of waypoints
     undocumented.
+
+    If numpy is available, the waypoints are decoded
+    into array (see decode_wpt_array()) and wpts
+    are only created when first accessed.
     """
     
-    def __init__(self, data):
-        super(D1018, self).__init__(data)
-        self._unpack("<I", ["num_valid_wpt"])
-        self.wpts = [None] * self.num_valid_wpt
+    layout = [("<I", ["num_valid_wpt"])]
+    eager_fields = ["num_valid_wpt"]
+    use_numpy = numpy is not None
+
+    def __init__(self, data, offset=0):
+        super(D1018, self).__init__(data, offset)
         self.str_args.append("wpts")
-        for n in xrange(0, self.num_valid_wpt):
-            self.wpts[n] = self._parse(D304)
-            # word alignment
-            self.unparsed = self.unparsed[1:]
+        if self.use_numpy:
+            self.array = decode_wpt_array(self.raw, self._end, self.num_valid_wpt)
+            self._wpts_offset = self._end
+            self._end += self.num_valid_wpt * WPT_DTYPE.itemsize
+        else:
+            self.array = None
+            self.wpts = [None] * self.num_valid_wpt
+            for n in xrange(0, self.num_valid_wpt):
+                self.wpts[n] = self._parse(D304)
+                # word alignment
+                self._end += 1
+
+    def __getattr__(self, name):
+        # only called when wpts has not been created yet
+        if name != "wpts" or self.__dict__.get("array") is None:
+            raise AttributeError(name)
+        self.wpts = self._wpts_from_array()
+        return self.wpts
+
+    def _wpts_from_array(self):
+        """
+        Create D304 instances equivalent to those
+        created by the pure python decoder.
+        """
+        a = self.array
+        nan_to_none = lambda col: [None if v != v else v for v in col.tolist()]
+        int_or_none = lambda col: [None if v != v else int(v) for v in col.tolist()]
+        columns = zip(a["lat"].tolist(), a["lon"].tolist(), a["valid"].tolist(),
+                      nan_to_none(a["deglat"]), nan_to_none(a["deglon"]), a["time"].tolist(),
+                      nan_to_none(a["alt"]), nan_to_none(a["distance"]),
+                      int_or_none(a["heart_rate"]), int_or_none(a["cadence"]), a["sensor"].tolist())
+        size = WPT_DTYPE.itemsize
+        offset = self._wpts_offset
+        wpts = []
+        for lat, lon, valid, deglat, deglon, t, alt, distance, heart_rate, cadence, sensor in columns:
+            posn = PositionType.__new__(PositionType)
+            posn.__dict__.update(raw=self.raw, _offset=offset, _end=offset + 8, _stop=offset + 8,
+                                 str_args=["lat", "lon"], lat=lat, lon=lon, valid=valid, deglat=deglat, deglon=deglon)
+            time = TimeType.__new__(TimeType)
+            time.__dict__.update(raw=self.raw, _offset=offset + 8, _end=offset + 12, _stop=offset + 12,
+                                 str_args=["time"], time=t)
+            wpt = D304.__new__(D304)
+            wpt.__dict__.update(raw=self.raw, _offset=offset, _end=offset + 23, _stop=offset + 23,
+                                str_args=["posn", "time", "alt", "distance", "heart_rate", "cadence", "sensor"],
+                                posn=posn, time=time, alt=alt, distance=distance,
+                                heart_rate=heart_rate, cadence=cadence, sensor=sensor)
+            wpts.append(wpt)
+            offset += size
+        return wpts
+
+
+if numpy is not None:
+    # D304 + word alignment
+    WPT_DTYPE = numpy.dtype([
+        ("lat", "<i4"),
+        ("lon", "<i4"),
+        ("time", "<u4"),
+        ("alt", "<f4"),
+        ("distance", "<f4"),
+        ("heart_rate", "u1"),
+        ("cadence", "u1"),
+        ("sensor", "u1"),
+        ("pad", "u1"),
+    ])
+
+    DECODED_WPT_DTYPE = numpy.dtype([
+        ("lat", "<i4"),
+        ("lon", "<i4"),
+        ("valid", "?"),
+        ("deglat", "<f8"),
+        ("deglon", "<f8"),
+        ("time", "<i8"),
+        ("alt", "<f8"),
+        ("distance", "<f8"),
+        ("heart_rate", "<f8"),
+        ("cadence", "<f8"),
+        ("sensor", "u1"),
+    ])
+
+def decode_wpt_array(raw, offset, count):
+    """
+    Decode count D304 waypoints from raw at offset into
+    a numpy array of DECODED_WPT_DTYPE. Values which are
+    None in D304 (e.g. invalid positon, missing heart rate)
+    are NaN.
+    """
+    size = count * WPT_DTYPE.itemsize
+    if len(raw) - offset == size - 1:
+        # last waypoint may be missing its alignment byte,
+        # the pure python decoder doesn't require it either
+        raw, offset = raw[offset:] + "\x00", 0
+    wpts = numpy.frombuffer(raw, WPT_DTYPE, count, offset)
+    result = numpy.empty(count, DECODED_WPT_DTYPE)
+    for name in ("lat", "lon", "time", "sensor"):
+        result[name] = wpts[name]
+    result["valid"] = valid = ((wpts["lat"] != PositionType.INVALID_SEMI_CIRCLE)
+                               & (wpts["lon"] != PositionType.INVALID_SEMI_CIRCLE))
+    result["deglat"] = numpy.where(valid, wpts["lat"] * (180. / 2**31), numpy.nan)
+    result["deglon"] = numpy.where(valid, wpts["lon"] * (180. / 2**31), numpy.nan)
+    invalid_float = numpy.float32(D304.INVALID_FLOAT)
+    result["alt"] = numpy.where(wpts["alt"] == invalid_float, numpy.nan, wpts["alt"])
+    result["distance"] = numpy.where(wpts["distance"] == invalid_float, numpy.nan, wpts["distance"])
+    result["heart_rate"] = numpy.where(wpts["heart_rate"] == 0, numpy.nan, wpts["heart_rate"])
+    result["cadence"] = numpy.where(wpts["cadence"] == 0xFF, numpy.nan, wpts["cadence"])
+    return result
         
 
 class DeviceNotSupportedError(Exception):
@@ -68,50 +68,114 @@ def downloader():
         antd.cfg.create_strava_plugin(),
         antd.cfg.create_gupload_plugin(),
         antd.cfg.create_tcx_plugin(),
+        antd.cfg.create_fit_plugin(),
+        # may delete raw files, after the plugins which read them
+        antd.cfg.create_archive_plugin(),
         antd.cfg.create_notification_plugin()
     )
     
     # create an ANTFS host from configuration
     host = antd.cfg.create_antfs_host()
+    # in daemon mode, optionally schedule downloads across many devices
+    scheduler = antd.cfg.create_sync_scheduler(host) if args.daemon else None
+    # device being downloaded, if set when an error is caught
+    # we attempt to reconnect and resume the download.
+    dev = None
+    # raw files written by each attempt of the download
+    raw_files = []
+    # in summary mode, if runs and laps of dev were published
+    summary_published = False
     try:
         failed_count = 0
         while failed_count <= antd.cfg.get_retry():
             try:
-                _log.info("Searching for ANT devices.")
-                # in daemon mode we do not attempt to pair with unknown devices
-                # (it requires gps watch to wake up and would drain battery of
-                # any un-paired devices in range.)
-                beacon = host.search(include_unpaired_devices=not args.daemon,
-                                     include_devices_with_no_data=args.force or not args.daemon)
-                if beacon and (beacon.data_available or args.force):
-                    _log.info("Device has data. Linking.")
-                    host.link()
-                    _log.info("Pairing with device.")
-                    client_id = host.auth(pair=not args.daemon)
+                if dev is not None and host.reconnect():
+                    _log.info("Reconnected to device, resuming download.")
+                else:
+                    dev = None
+                    raw_files = []
+                    summary_published = False
+                    _log.info("Searching for ANT devices.")
+                    # in daemon mode we do not attempt to pair with unknown devices
+                    # (it requires gps watch to wake up and would drain battery of
+                    # any un-paired devices in range.)
+                    if scheduler:
+                        beacon = scheduler.next_device(include_devices_with_no_data=args.force)
+                    else:
+                        beacon = host.search(include_unpaired_devices=not args.daemon,
+                                             include_devices_with_no_data=args.force or not args.daemon)
+                    if beacon and (beacon.data_available or args.force):
+                        _log.info("Device has data. Linking.")
+                        host.link()
+                        _log.info("Pairing with device.")
+                        client_id = host.auth(pair=not args.daemon)
+                        # create a garmin device, and initialize its
+                        # ant initialize its capabilities.
+                        dev = antd.Device(host, antd.cfg.get_ack_mode())
+                    elif not args.daemon:
+                        _log.info("Found device, but no data available for download.")
+                if dev is not None:
                     raw_name = time.strftime("%Y%m%d-%H%M%S.raw")
                     raw_full_path = antd.cfg.get_path("antd", "raw_output_dir", raw_name, 
                                                       {"device_id": hex(host.device_id)})
+                    raw_files.append(raw_full_path)
                     with open(raw_full_path, "w") as file:
                         _log.info("Saving raw data to %s.", file.name)
-                        # create a garmin device, and initialize its
-                        # ant initialize its capabilities.
-                        dev = antd.Device(host)
-                        antd.garmin.dump(file, dev.get_product_data())
-                        # download runs
-                        runs = dev.get_runs()
-                        antd.garmin.dump(file, runs)
-                        if antd.cfg.get_delete_from_device(): dev.delete_runs()
+                        antd.garmin.dump(file, dev.product_data)
+                        # packets are written as they are received, so
+                        # a partial download is saved if link is lost.
+                        sink = antd.garmin.RawSink(file)
+                        try:
+                            # download runs, unless deleting from device only
+                            # tracks newer than the last sync are downloaded.
+                            if antd.cfg.get_delete_from_device():
+                                since = None
+                            else:
+                                since = host.known_client_keys.get_meta(host.device_id, "last_run_time")
+                            summary = antd.cfg.get_sync_mode() == "summary"
+                            # when resumed, runs and laps are replayed from
+                            # dev's checkpoint, they are not downloaded again.
+                            runs = dev.get_runs(since=since, sink=sink, tracks=not summary)
+                            if summary:
+                                if not summary_published:
+                                    # publish runs and laps, before the much
+                                    # larger track download.
+                                    sink.flush()
+                                    _log.info("Publishing run and lap summary.")
+                                    antd.plugin.publish_data(host.device_id, "summary", [raw_full_path])
+                                    summary_published = True
+                                runs = dev.get_tracks(runs, sink=sink)
+                        finally:
+                            sink.close()
+                        if antd.cfg.get_delete_from_device():
+                            dev.delete_runs()
+                    # a resumed download replays the packets of previous
+                    # attempts, their partial files are no longer needed.
+                    for partial_full_path in set(raw_files) - set([raw_full_path]):
+                        _log.debug("Removing partial raw file %s.", partial_full_path)
+                        try: os.unlink(partial_full_path)
+                        except OSError: _log.warning("Failed to remove %s.", partial_full_path, exc_info=True)
+                    raw_files = []
+                    # write raw_full_path.idx, index of runs, laps and tracks
+                    antd.garmin.RawIndex.load(raw_full_path)
+                    host.known_client_keys.set_meta(host.device_id,
+                            last_run_time=antd.garmin.newest_run_time(dev, runs),
+                            last_sync=time.time(),
+                            product_id=dev.device_id.product_id,
+                            software_version=dev.device_id.software_version,
+                            model="".join(dev.device_id.description))
+                    if scheduler: scheduler.success()
+                    dev = None
                     _log.info("Closing session.")
                     host.disconnect()
                     _log.info("Excuting plugins.")
                     # dispatcher data to plugins
                     antd.plugin.publish_data(host.device_id, "raw", [raw_full_path])
-                elif not args.daemon:
-                    _log.info("Found device, but no data available for download.")
                 if not args.daemon: break
                 failed_count = 0
             except antd.AntError:
                 _log.warning("Caught error while communicating with device, will retry.", exc_info=True) 
+                if scheduler: scheduler.failure()
                 failed_count += 1
     finally:
         try: host.close()
@@ -29,6 +29,7 @@
 
 import os.path
 import antd.plugin as plugin
+import antd.garmin as garmin
 import logging
 
 _log = logging.getLogger("antd.notif")
@@ -56,6 +57,13 @@ class NotifPlugin(plugin.Plugin):
                     "Uploaded files [%s] to Garmin Connect" % ", ".join(filenames),
                     "notification-message-im")
                 n.show()
+            elif format == "summary":
+                # runs and laps are downloaded, tracks are still to come
+                n = pynotify.Notification(
+                    "Ant+ Downloader",
+                    "Found %d run(s), downloading tracks" % sum(map(count_runs, files)),
+                    "notification-message-im")
+                n.show()
 #           elif format == "tcx":
 #               n = pynotify.Notification(
 #                   "Ant+ Downloader",
@@ -64,3 +72,14 @@ class NotifPlugin(plugin.Plugin):
 #               n.show()
         finally:
             return files
+
+
+def count_runs(file_name):
+    """
+    Return the number of runs in the given raw file.
+    The file is indexed in memory, no .idx is saved,
+    (file may be a download still in progress.)
+    """
+    with open(file_name, "rb") as file:
+        index = garmin.RawIndex.build(file.read())
+    return len(index.offsets(garmin.L001.PID_RUN))
@@ -99,14 +99,33 @@ def recover_and_publish_data(plugin):
     if q.queue:
         try:
             _log.debug("Attempting to reprocess failed files.")
-            for device_sn, format, file in list(q.queue):
-                if plugin.data_available(device_sn, format, [file]):
+            # one batch per device and format, in queue order
+            batches = []
+            for device_sn, format, file in q.queue:
+                if not batches or batches[-1][:2] != (device_sn, format):
+                    batches.append((device_sn, format, []))
+                batches[-1][2].append(file)
+            for device_sn, format, files in batches:
+                processed = plugin.data_available(device_sn, format, files) or []
+                for file in processed:
                     q.queue.remove((device_sn, format, file))
         except Exception:
             _log.warning("Plugin failed. %s", plugin, exc_info=True)
         finally:
             q.save_queue()
     
+def is_pending(file, exclude=None):
+    """
+    Return True if file is queued by any registered plugin,
+    other than exclude, it failed and will be retried.
+    """
+    for plugin in _plugins:
+        if plugin is exclude: continue
+        q = PluginQueue(plugin)
+        q.load_queue()
+        if any(queued == file for device_sn, format, queued in q.queue): return True
+    return False
+    
 def publish_data(device_sn, format, files):
     for plugin in _plugins:
         try:
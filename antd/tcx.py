@@ -32,6 +32,11 @@ import time
 import os
 import glob
 import shutil
+import itertools
+import multiprocessing
+import hashlib
+import sqlite3
+import contextlib
 import lxml.etree as etree
 import lxml.builder as builder
 
@@ -40,37 +45,243 @@ import antd.garmin as garmin
 
 _log = logging.getLogger("antd.tcx")
 
-E = builder.ElementMaker(nsmap={
+NSMAP = {
     None: "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2",
     "ext": "http://www.garmin.com/xmlschemas/ActivityExtension/v2",
     "xsi": "http://www.w3.org/2001/XMLSchema-instance",
-})
+}
+
+E = builder.ElementMaker(nsmap=NSMAP)
 
 X = builder.ElementMaker(namespace="http://www.garmin.com/xmlschemas/ActivityExtension/v2")
 
 class TcxPlugin(plugin.Plugin):
+    """
+    Converts raw files to tcx. If workers > 1 (0 for
+    one per cpu) each run is converted by a pool of
+    worker processes. Results are published in the order
+    of files and runs, regardless of which finishes first.
+    If manifest is set (see Manifest) only runs which are
+    new or changed since last exported are converted.
+    Runs of a sync (raw file) are written one per document,
+    or if batch_runs != 1 or batch_points is set, batched
+    into documents of up to batch_runs runs (0 for any
+    number) and batch_points track points (0 for any).
+    Subclasses may convert to another format by overriding
+    format, output_dir() and task().
+    """
     
+    format = "tcx"
     tcx_output_dir = "."
+    workers = 1
+    serializer = "lxml"
+    pretty_print = True
+    manifest = None
+    batch_runs = 1
+    batch_points = 0
 
     def data_available(self, device_sn, format, files):
         if "raw" != format: return files
         processed = []
         result = []
+        manifest = None
         try:
+            dir = self.output_dir(device_sn)
+            if not os.path.exists(dir): os.makedirs(dir)
+            if self.manifest:
+                manifest = Manifest(self.manifest % {"device_id": hex(device_sn)})
+            workers = self.workers or multiprocessing.cpu_count()
+            batching = self.batch_runs != 1 or self.batch_points
+            # (start_time, digest) of runs already being exported
+            scheduled = set()
+            # (file, [(export_run() args, runs converted), ...])
+            tasks = []
             for file in files:
-                _log.info("TcxPlugin: processing %s.", file)
+                _log.info("%s: processing %s.", type(self).__name__, file)
                 try:
-                    dir = self.tcx_output_dir % {"device_id": hex(device_sn)}
-                    if not os.path.exists(dir): os.makedirs(dir)
-                    files = export_tcx(device_sn, file, dir)
-                    result.extend(files)
-                    processed.append(file)
+                    runs = None
+                    if manifest or workers > 1 or batching:
+                        runs = list_runs(file)
+                    if manifest:
+                        runs = [r for r in runs if r[1:3] not in scheduled and not manifest.is_exported(*r[1:3])]
+                        scheduled.update(r[1:3] for r in runs)
+                        _log.debug("%s: %s has %d new or changed run(s).", type(self).__name__, file, len(runs))
+                    if runs is None:
+                        file_tasks = [(self.task(device_sn, file, dir, None), None)]
+                    elif batching:
+                        file_tasks = [(self.task(device_sn, file, dir, [r[0] for r in batch], True), batch)
+                                      for batch in split_batches(runs, self.batch_runs, self.batch_points)]
+                    elif workers > 1:
+                        # each run is a task, replay of raw is repeated
+                        file_tasks = [(self.task(device_sn, file, dir, [r[0]]), [r]) for r in runs]
+                    else:
+                        file_tasks = [(self.task(device_sn, file, dir, [r[0] for r in runs]), runs)] if runs else []
+                    tasks.append((file, file_tasks))
                 except Exception:
                     _log.warning("Failed to process %s. Maybe a datatype is unimplemented?", file, exc_info=True)
-            plugin.publish_data(device_sn, "tcx", result)
+            results = self.map(export_run, [args for file, file_tasks in tasks for args, runs in file_tasks], workers)
+            for file, file_tasks in tasks:
+                out_files = [(results.next(), runs) for args, runs in file_tasks]
+                if any(files is None for files, runs in out_files): continue
+                for files, runs in out_files:
+                    if manifest: self.add_to_manifest(manifest, file, files, runs)
+                    result.extend(files)
+                processed.append(file)
+            plugin.publish_data(device_sn, self.format, result)
         finally:
+            if manifest: manifest.close()
             return processed
 
+    def add_to_manifest(self, manifest, raw_file_name, files, runs):
+        """
+        Record the runs (see list_runs) converted to files,
+        one file per run, or one file of all runs.
+        """
+        if len(files) == len(runs):
+            manifest.add([(start_time, digest, out_file) for (index, start_time, digest, points), out_file in zip(runs, files)])
+        elif len(files) == 1:
+            manifest.add([(start_time, digest, files[0]) for index, start_time, digest, points in runs])
+        else:
+            _log.warning("%s: %s, %d of %d run(s) exported, not added to manifest.",
+                         type(self).__name__, raw_file_name, len(files), len(runs))
+
+    def output_dir(self, device_sn):
+        return self.tcx_output_dir % {"device_id": hex(device_sn)}
+
+    def task(self, device_sn, raw_file_name, output_dir, track_indexes, combine=False):
+        """
+        Return the arguments of export_run() which convert
+        the given runs (all if track_indexes is None), into
+        a single document if combine is True.
+        """
+        return (export_tcx, device_sn, raw_file_name, output_dir, track_indexes,
+                self.serializer, self.pretty_print, combine)
+
+    def map(self, func, args, workers):
+        """
+        Return iterator of func applied to each of args, in
+        order. Using a process pool if workers > 1.
+        """
+        workers = min(workers, len(args))
+        if workers <= 1:
+            return itertools.imap(func, args)
+        _log.debug("%s: converting %d run(s), %d worker(s).", type(self).__name__, len(args), workers)
+        pool = multiprocessing.Pool(workers)
+        try:
+            return iter(pool.map(func, args, chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+
+
+def list_runs(raw_file_name):
+    """
+    Return (track_index, start_time, digest, points) of
+    each run in the raw file, unless the file is an incremental
+    download, then only runs which have track points (see
+    garmin.extract_runs). digest is the sha1 of the
+    run's packets, its laps and track.
+    """
+    with garmin.RawFile(raw_file_name) as raw:
+        tracks = set(hdr.index for hdr in raw.records(garmin.L001.PID_TRK_HDR))
+        incremental = not raw.tracks_complete()
+        laps_by_index = dict((l.index, l) for l in reversed(raw.records(garmin.L001.PID_LAP)))
+        result = []
+        for run in raw.records(garmin.L001.PID_RUN):
+            if incremental and run.track_index not in tracks: continue
+            laps = [laps_by_index[n] for n in xrange(run.first_lap_index, run.last_lap_index + 1) if n in laps_by_index]
+            if not laps: continue
+            digest = hashlib.sha1(run.raw)
+            for lap in laps: digest.update(lap.raw)
+            digest.update(raw.track_data(run.track_index))
+            result.append((run.track_index, laps[0].start_time.time, digest.hexdigest(), raw.track_points(run.track_index)))
+        return result
+
+def split_batches(runs, max_runs, max_points):
+    """
+    Split runs (see list_runs) into consecutive batches of
+    at most max_runs runs and max_points track points, 0
+    for no limit. A run with more than max_points is
+    a batch of its own.
+    """
+    batches = []
+    points = 0
+    for run in runs:
+        if (batches and (not max_runs or len(batches[-1]) < max_runs)
+                and (not max_points or points + run[3] <= max_points)):
+            batches[-1].append(run)
+            points += run[3]
+        else:
+            batches.append([run])
+            points = run[3]
+    return batches
+
+def export_run(args):
+    """
+    Convert runs of a raw file, args is a tuple of an
+    export function, e.g. export_tcx(), and its arguments.
+    Returns files written, or None if conversion failed.
+    """
+    try:
+        return args[0](*args[1:])
+    except Exception:
+        _log.warning("Failed to process %s. Maybe a datatype is unimplemented?", args[2], exc_info=True)
+
+
+class Manifest(object):
+    """
+    sqlite backed record of the runs of a device which
+    have been exported to tcx. Runs are keyed by start
+    time, with a digest of their packets (see list_runs),
+    so a run is exported again only if the device's data
+    for it changed.
+    """
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, file):
+        self.file = file
+        dir = os.path.dirname(file)
+        if dir and not os.path.isdir(dir): os.makedirs(dir)
+        self.conn = sqlite3.connect(file, timeout=30, isolation_level=None)
+        self.conn.text_factory = str
+        with self._transaction() as conn:
+            (version,) = conn.execute("PRAGMA user_version").fetchone()
+            if version < self.SCHEMA_VERSION:
+                conn.execute("CREATE TABLE IF NOT EXISTS run (start_time INTEGER PRIMARY KEY, digest TEXT, file TEXT)")
+                conn.execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, start_time):
+        """
+        Return (digest, file) of the run, or None.
+        """
+        return self.conn.execute("SELECT digest, file FROM run WHERE start_time = ?", (start_time,)).fetchone()
+
+    def is_exported(self, start_time, digest):
+        row = self.get(start_time)
+        return row is not None and row[0] == digest
+
+    def add(self, runs):
+        """
+        Record [(start_time, digest, file), ...] as exported.
+        """
+        with self._transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO run (start_time, digest, file) VALUES (?, ?, ?)", runs)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        else:
+            self.conn.execute("COMMIT")
+
 
 def format_time(gmtime):
     return time.strftime("%Y-%m-%dT%H:%M:%SZ", gmtime)
@@ -98,12 +309,12 @@ def format_sensor_state(sensor):
     else: return "Absent"
 
 def create_wpt(wpt, sport_type):
-    elements = [E.Time(format_time(wpt.time.gmtime))]
-    if wpt.posn.valid:
+    elements = [E.Time(format_time(time.gmtime(garmin.TimeType.EPOCH + wpt.time)))]
+    if wpt.valid:
         elements.extend([
             E.Position(
-                E.LatitudeDegrees(str(wpt.posn.deglat)),
-                E.LongitudeDegrees(str(wpt.posn.deglon)))])
+                E.LatitudeDegrees(str(wpt.deglat)),
+                E.LongitudeDegrees(str(wpt.deglon)))])
     if wpt.alt is not None:
         elements.append(E.AltitudeMeters(str(wpt.alt)))
     if wpt.distance is not None:
@@ -118,7 +329,12 @@ def create_wpt(wpt, sport_type):
     #if len(elements) > 1:
     return E.Trackpoint(*elements)
 
-def create_lap(lap, sport_type):
+def create_lap_summary(activity, lap_num):
+    """
+    Return the elements of lap which precede its Track.
+    """
+    lap = activity.laps[lap_num]
+    sport_type = activity.sport_type
     elements = [
         E.TotalTimeSeconds("%0.2f" % (lap.total_time / 100.)),
         E.DistanceMeters(str(lap.total_dist)),
@@ -134,11 +350,24 @@ def create_lap(lap, sport_type):
         elements.append(
             E.Cadence(str(lap.avg_cadence)))
     elements.append(E.TriggerMethod(format_trigger_method(lap.trigger_method)))
-    wpts = [el for el in (create_wpt(w, sport_type) for w in lap.wpts) if el is not None]
+    return elements
+
+def create_lap_extensions(activity, lap_num):
+    """
+    Return the elements of lap which follow its Track.
+    """
+    lap = activity.laps[lap_num]
+    if lap.avg_cadence is not None and activity.sport_type == 0:
+        return [E.Extensions(X.LX(X.AvgRunCadence(str(lap.avg_cadence))))]
+    return []
+
+def create_lap(activity, lap_num):
+    lap = activity.laps[lap_num]
+    elements = create_lap_summary(activity, lap_num)
+    wpts = [el for el in (create_wpt(activity.point(n), activity.sport_type) for n in activity.lap_points(lap_num)) if el is not None]
     if wpts:
         elements.append(E.Track(*wpts))
-    if lap.avg_cadence is not None and sport_type == 0:
-        elements.append(E.Extensions(X.LX(X.AvgRunCadence(str(lap.avg_cadence)))))
+    elements.extend(create_lap_extensions(activity, lap_num))
     return E.Lap(
         {"StartTime": format_time(lap.start_time.gmtime)},
         *elements)
@@ -156,11 +385,11 @@ def create_creator(device):
                                E.BuildMinor("0")))
 
 
-def create_activity(device, run):
-    laps = list(create_lap(l, run.sport_type) for l in run.laps)
+def create_activity(device, activity):
+    laps = list(create_lap(activity, n) for n in range(0, len(activity.laps)))
     return E.Activity(
-        {"Sport": format_sport(run.sport_type)},
-        E.Id(format_time(run.time.gmtime)),
+        {"Sport": format_sport(activity.sport_type)},
+        E.Id(format_time(activity.start_time.gmtime)),
         *(laps + [create_creator(device)]))
 
 def create_document(device, runs):
@@ -169,26 +398,275 @@ def create_document(device, runs):
             *list(create_activity(device, r) for r in runs)))
     return doc
 
-def export_tcx(device_sn, raw_file_name, output_dir):
+def write_document(file, device, runs):
+    """
+    Write the TCX document of runs to file. Output is
+    the same as pretty printed create_document(), but
+    elements are written as they are created, so memory
+    used doesn't grow with the number of trackpoints.
+    """
+    # xmlfile always declares the default namespace first,
+    # root tag is written as tostring() would write it.
+    root = etree.tostring(E.TrainingCenterDatabase(), xml_declaration=True, encoding="UTF-8")
+    file.write(root[:-len("/>")] + ">")
+    with etree.xmlfile(_SkipStartTag(file), encoding="UTF-8") as xf:
+        with xf.element("TrainingCenterDatabase", nsmap=NSMAP):
+            xf.write("\n  ")
+            if not runs:
+                write_element(xf, E.Activities(), 1)
+            else:
+                with xf.element("Activities"):
+                    for run in runs:
+                        xf.write("\n    ")
+                        write_activity(xf, device, run, 2)
+                    xf.write("\n  ")
+            xf.write("\n")
+    file.write("\n")
+
+def write_activity(xf, device, activity, level):
+    with xf.element("Activity", {"Sport": format_sport(activity.sport_type)}):
+        xf.write(_indent(level + 1))
+        write_element(xf, E.Id(format_time(activity.start_time.gmtime)), level + 1)
+        for lap_num in range(0, len(activity.laps)):
+            xf.write(_indent(level + 1))
+            write_lap(xf, activity, lap_num, level + 1)
+        xf.write(_indent(level + 1))
+        write_element(xf, create_creator(device), level + 1)
+        xf.write(_indent(level))
+
+def write_lap(xf, activity, lap_num, level):
+    lap = activity.laps[lap_num]
+    with xf.element("Lap", {"StartTime": format_time(lap.start_time.gmtime)}):
+        for el in create_lap_summary(activity, lap_num):
+            xf.write(_indent(level + 1))
+            write_element(xf, el, level + 1)
+        points = activity.lap_points(lap_num)
+        if len(points):
+            xf.write(_indent(level + 1))
+            with xf.element("Track"):
+                for n in points:
+                    xf.write(_indent(level + 2))
+                    write_element(xf, create_wpt(activity.point(n), activity.sport_type), level + 2)
+                xf.write(_indent(level + 1))
+        for el in create_lap_extensions(activity, lap_num):
+            xf.write(_indent(level + 1))
+            write_element(xf, el, level + 1)
+        xf.write(_indent(level))
+
+def write_element(xf, el, level):
+    """
+    Write el, and its children, indented as pretty_print
+    would when el is at given depth of the document.
+    """
+    attrib = el.attrib
+    if len(el):
+        with xf.element(el.tag, attrib and dict(attrib)):
+            indent = _indent(level + 1)
+            for child in el:
+                xf.write(indent)
+                write_element(xf, child, level + 1)
+            xf.write(_indent(level))
+    elif el.text is not None:
+        with xf.element(el.tag, attrib and dict(attrib)):
+            xf.write(el.text)
+    else:
+        xf.write(etree.Element(el.tag, dict(attrib)))
+
+_indents = ["\n" + "  " * level for level in range(0, 16)]
+
+def _indent(level):
+    return _indents[level]
+
+class _SkipStartTag(object):
+    """
+    File wrapper which discards the first start tag
+    written to it.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.skip = True
+
+    def write(self, data):
+        if self.skip:
+            end = data.find(">")
+            if end < 0: return
+            data = data[end + 1:]
+            self.skip = False
+        self.file.write(data)
+
+def write_template(file, device, runs, pretty_print=True):
+    """
+    Write the TCX document of runs to file. Output is
+    the same as create_document() serialized by lxml,
+    with or without pretty_print. Trackpoints are written
+    as text from precomputed fragments, no elements are
+    created per trackpoint.
+    """
+    indents = _indents if pretty_print else [""] * len(_indents)
+    root = etree.tostring(E.TrainingCenterDatabase(), xml_declaration=True, encoding="UTF-8")
+    file.write(root[:-len("/>")] + ">")
+    if not runs:
+        file.write(indents[1] + "<Activities/>")
+    else:
+        format = TimeFormat()
+        file.write(indents[1] + "<Activities>")
+        for activity in runs:
+            file.write(indents[2] + '<Activity Sport="%s">' % format_sport(activity.sport_type))
+            file.write(_serialize(E.Id(format_time(activity.start_time.gmtime)), 3, indents))
+            for lap_num in range(0, len(activity.laps)):
+                lap = activity.laps[lap_num]
+                file.write(indents[3] + '<Lap StartTime="%s">' % format_time(lap.start_time.gmtime))
+                for el in create_lap_summary(activity, lap_num):
+                    file.write(_serialize(el, 4, indents))
+                points = activity.lap_points(lap_num)
+                if len(points):
+                    file.write(indents[4] + "<Track>")
+                    _write_points(file, activity, points, format, indents)
+                    file.write(indents[4] + "</Track>")
+                for el in create_lap_extensions(activity, lap_num):
+                    file.write(_serialize(el, 4, indents))
+                file.write(indents[3] + "</Lap>")
+            file.write(_serialize(create_creator(device), 3, indents))
+            file.write(indents[2] + "</Activity>")
+        file.write(indents[1] + "</Activities>")
+    file.write(indents[0] + "</TrainingCenterDatabase>")
+    if pretty_print: file.write("\n")
+
+def _write_points(file, activity, points, format, indents):
+    """
+    Write Trackpoints of the given indexes, as create_wpt()
+    would, at the depth they occur in the document.
+    """
+    i5, i6, i7, i8 = indents[5:9]
+    time_open = i5 + "<Trackpoint>" + i6 + "<Time>"
+    lat_open = "</Time>" + i6 + "<Position>" + i7 + "<LatitudeDegrees>"
+    lon_open = "</LatitudeDegrees>" + i7 + "<LongitudeDegrees>"
+    lon_close = "</LongitudeDegrees>" + i6 + "</Position>"
+    alt_open = i6 + "<AltitudeMeters>"
+    dist_open = i6 + "<DistanceMeters>"
+    hr_open = i6 + "<HeartRateBpm>" + i7 + "<Value>"
+    hr_close = "</Value>" + i6 + "</HeartRateBpm>"
+    if activity.sport_type != 0:
+        cad_open = i6 + "<Cadence>"
+        cad_close = "</Cadence>"
+    else:
+        cad_open = i6 + "<Extensions>" + i7 + "<ext:TPX>" + i8 + "<ext:RunCadence>"
+        cad_close = "</ext:RunCadence>" + i7 + "</ext:TPX>" + i6 + "</Extensions>"
+    close = i5 + "</Trackpoint>"
+    invalid = garmin.PositionType.INVALID_SEMI_CIRCLE
+    scale = 180. / 2**31
+    times, lats, lons = activity.time, activity.lat, activity.lon
+    alts, dists, hrs, cads = activity.alt, activity.distance, activity.heart_rate, activity.cadence
+    out = []
+    append = out.append
+    for n in points:
+        lat, lon = lats[n], lons[n]
+        if lat != invalid and lon != invalid:
+            append(time_open + format(times[n]) + lat_open + str(lat * scale) + lon_open + str(lon * scale) + lon_close)
+        else:
+            append(time_open + format(times[n]) + "</Time>")
+        alt = alts[n]
+        if alt == alt: append(alt_open + str(alt) + "</AltitudeMeters>")
+        dist = dists[n]
+        if dist == dist: append(dist_open + str(dist) + "</DistanceMeters>")
+        hr = hrs[n]
+        if hr: append(hr_open + str(hr) + hr_close)
+        cad = cads[n]
+        if cad != 0xFF: append(cad_open + str(cad) + cad_close)
+        append(close)
+        if len(out) > 4096:
+            file.write("".join(out))
+            del out[:]
+    file.write("".join(out))
+
+def _serialize(el, level, indents):
+    """
+    Return el as text, as lxml would serialize it at the
+    given depth of the document. Prefixes are those of NSMAP.
+    """
+    tag = _qname(el.tag)
+    attrib = "".join(' %s="%s"' % (_qname(k), _escape(v, True)) for k, v in el.attrib.items())
+    if len(el):
+        children = "".join(_serialize(child, level + 1, indents) for child in el)
+        return "%s<%s%s>%s%s</%s>" % (indents[level], tag, attrib, children, indents[level], tag)
+    elif el.text is not None:
+        return "%s<%s%s>%s</%s>" % (indents[level], tag, attrib, _escape(el.text), tag)
+    else:
+        return "%s<%s%s/>" % (indents[level], tag, attrib)
+
+_prefixes = dict((ns, prefix) for prefix, ns in NSMAP.items())
+
+def _qname(tag):
+    if tag[0] != "{": return tag
+    ns, local = tag[1:].split("}", 1)
+    prefix = _prefixes[ns]
+    return local if prefix is None else prefix + ":" + local
+
+def _escape(text, attrib=False):
+    if isinstance(text, unicode): text = text.encode("UTF-8")
+    text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    if attrib: text = text.replace('"', "&quot;")
+    return text
+
+_seconds = ["%02dZ" % n for n in range(0, 60)]
+
+class TimeFormat(object):
+    """
+    Formats garmin times (seconds since garmin epoch) as
+    format_time() would. Date, hour and minute are formatted
+    once per minute, track points are usually a second apart.
+    """
+
+    def __init__(self):
+        self.minute = None
+        self.prefix = None
+
+    def __call__(self, t):
+        t += garmin.TimeType.EPOCH
+        minute = t // 60
+        if minute != self.minute:
+            self.minute = minute
+            self.prefix = time.strftime("%Y-%m-%dT%H:%M:", time.gmtime(minute * 60))
+        return self.prefix + _seconds[t % 60]
+
+def export_tcx(device_sn, raw_file_name, output_dir, track_indexes=None, serializer="lxml", pretty_print=True, combine=False):
     """
     Given a garmin raw packet dump, tcx to specified output directory.
+    raw_file_name may also be a stream which replays a dump,
+    e.g. archive.Archive.open(), with a file_name attribute.
+    If track_indexes is provided, only those runs are exported.
+    serializer is "lxml" (write_document) or "template"
+    (write_template), output is the same. Each run is written
+    to its own document, or if combine is True, all to one.
     """
-    with open(raw_file_name) as file:
-        result = []
-        host = garmin.MockHost(file.read())
-        host.device_id = device_sn
-        device = garmin.Device(host)
-        run_pkts = device.get_runs()
-        runs = garmin.extract_runs(device, run_pkts)
-        for run in runs:
-            tcx_name = time.strftime("%Y%m%d-%H%M%S.tcx", run.time.gmtime)
-            tcx_full_path = os.path.sep.join([output_dir, tcx_name])
-            _log.info("tcx: writing %s -> %s.", os.path.basename(raw_file_name), tcx_full_path)
-            with open(tcx_full_path, "w") as file:
-                doc = create_document(device, [run])
-                file.write(etree.tostring(doc, pretty_print=True, xml_declaration=True, encoding="UTF-8"))
-            result.append(tcx_full_path)
-        return result
+    if serializer not in ("lxml", "template"):
+        raise ValueError("Unknown serializer %s." % serializer)
+    if isinstance(raw_file_name, basestring):
+        with garmin.RawFile(raw_file_name) as host:
+            return export_tcx(device_sn, host, output_dir, track_indexes, serializer, pretty_print, combine)
+    host = raw_file_name
+    result = []
+    host.device_id = device_sn
+    device = garmin.Device(host)
+    run_pkts = device.get_runs()
+    runs = garmin.extract_runs(device, run_pkts, track_indexes)
+    for runs in [runs] if combine and runs else [[run] for run in runs]:
+        tcx_name = time.strftime("%Y%m%d-%H%M%S", runs[0].start_time.gmtime)
+        if len(runs) > 1:
+            # first and last run of the document
+            tcx_name += time.strftime("-%Y%m%d-%H%M%S", runs[-1].start_time.gmtime)
+        tcx_full_path = os.path.sep.join([output_dir, tcx_name + ".tcx"])
+        _log.info("tcx: writing %s -> %s.", os.path.basename(host.file_name), tcx_full_path)
+        with open(tcx_full_path, "w") as file:
+            if serializer == "template":
+                write_template(file, device, runs, pretty_print)
+            elif pretty_print:
+                write_document(file, device, runs)
+            else:
+                file.write(etree.tostring(create_document(device, runs), xml_declaration=True, encoding="UTF-8"))
+        result.append(tcx_full_path)
+    return result
 
 
 # vim: ts=4 sts=4 et
@@ -43,8 +43,7 @@ if len(sys.argv) != 2:
 	print "usage: %s <file>" % sys.argv[0]
 	sys.exit(1)
 
-with open(sys.argv[1]) as file:
-	host = garmin.MockHost(file.read())
+with garmin.RawFile(sys.argv[1]) as host:
 	#device = garmin.Device(host)
 	for idx, pkt in enumerate(host.reader):
 		if pkt:
@@ -0,0 +1,30 @@
+#!/usr/bin/python
+
+import sys
+import time
+import logging
+
+import antd.garmin as garmin
+import emulator
+
+logging.basicConfig(
+        level=logging.INFO,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+stream = emulator.Garmin(emulator.history(runs=runs, laps_per_run=2, wpts_per_lap=60))
+stream.burst_size = 1024
+logging.getLogger("antd.garmin").setLevel(logging.WARNING)
+dev = garmin.Device(stream)
+pkts = dev.get_runs()
+_LOG.info("%d run(s), %d track packet(s).", runs, len(pkts[2]))
+
+start = time.time()
+activities = garmin.extract_runs(dev, pkts)
+_LOG.info("extract_runs: %0.3fs", time.time() - start)
+assert len(activities) == runs and all(len(a) == 120 for a in activities)
+
+# vim: ts=4 sts=4 et
@@ -0,0 +1,38 @@
+#!/usr/bin/python
+
+import sys
+import time
+import logging
+import StringIO
+
+import antd.garmin as garmin
+import antd.tcx as tcx
+import antd.fit as fit
+import emulator
+
+logging.basicConfig(
+        level=logging.INFO,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+laps = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+logging.getLogger("antd").setLevel(logging.WARNING)
+stream = emulator.Garmin(emulator.history(runs=1, laps_per_run=laps, wpts_per_lap=3600))
+stream.device_id = 1
+dev = garmin.Device(stream)
+runs = garmin.extract_runs(dev, dev.get_runs())
+_LOG.info("%d track point(s).", len(runs[0]))
+
+for name, write in [
+        ("tcx (lxml)", lambda file: tcx.write_document(file, dev, runs)),
+        ("tcx (template)", lambda file: tcx.write_template(file, dev, runs)),
+        ("tcx (template, compact)", lambda file: tcx.write_template(file, dev, runs, False)),
+        ("fit", lambda file: fit.write_activity(file, dev, runs[0]))]:
+    out = StringIO.StringIO()
+    start = time.time()
+    write(out)
+    _LOG.info("%s: %0.3fs, %0.1fKB", name, time.time() - start, len(out.getvalue()) / 1024.)
+
+# vim: ts=4 sts=4 et
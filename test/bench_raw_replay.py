@@ -0,0 +1,56 @@
+#!/usr/bin/python
+
+import sys
+import time
+import struct
+import logging
+import tempfile
+
+import antd.garmin as garmin
+import emulator
+
+logging.basicConfig(
+        level=logging.INFO,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+def sliced_reader(data):
+    # the MockHost reader before packets were read by offset
+    while data:
+        (length,) = struct.unpack("<H", data[2:4])
+        if length: pkt = data[0:length + 4]
+        else: pkt = ""
+        data = data[length + 4:]
+        yield pkt
+
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+logging.getLogger("antd.garmin").setLevel(logging.WARNING)
+stream = emulator.Garmin(emulator.history(runs=runs, laps_per_run=2, wpts_per_lap=60))
+stream.wpts_per_packet = 1
+dev = garmin.Device(stream)
+raw = tempfile.NamedTemporaryFile(suffix=".raw")
+garmin.dump(raw, dev.product_data)
+garmin.dump(raw, dev.get_runs())
+raw.flush()
+size = raw.tell()
+_LOG.info("%d run(s), %0.1fMB raw file.", runs, size / 1024. / 1024.)
+
+start = time.time()
+with open(raw.name) as file:
+    count = sum(1 for pkt in sliced_reader(file.read()))
+_LOG.info("sliced read: %d packet(s) %0.3fs", count, time.time() - start)
+
+start = time.time()
+with garmin.RawFile(raw.name) as host:
+    assert sum(1 for pkt in host.reader) == count
+_LOG.info("RawFile read: %d packet(s) %0.3fs", count, time.time() - start)
+
+start = time.time()
+with garmin.RawFile(raw.name) as host:
+    dev = garmin.Device(host)
+    assert len(garmin.extract_runs(dev, dev.get_runs())) == runs
+_LOG.info("RawFile replay and extract_runs: %0.3fs", time.time() - start)
+
+# vim: ts=4 sts=4 et
@@ -0,0 +1,47 @@
+#!/usr/bin/python
+
+import sys
+import os
+import time
+import shutil
+import logging
+import tempfile
+import multiprocessing
+
+import antd.garmin as garmin
+import antd.plugin as plugin
+import antd.tcx as tcx
+import emulator
+
+logging.basicConfig(
+        level=logging.INFO,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+files = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+runs = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+logging.getLogger("antd").setLevel(logging.WARNING)
+dir = tempfile.mkdtemp()
+try:
+    raw_files = []
+    for n in range(0, files):
+        dev = garmin.Device(emulator.Garmin(emulator.history(runs=runs, wpts_per_lap=600, start_time=600000000 + n * 10000000)))
+        raw_files.append(os.path.join(dir, "%d.raw" % n))
+        with open(raw_files[-1], "w") as file:
+            garmin.dump(file, dev.product_data)
+            garmin.dump(file, dev.get_runs())
+    _LOG.info("%d file(s), %d run(s) each, %d cpu(s).", files, runs, multiprocessing.cpu_count())
+
+    for workers in (1, 2, 4):
+        p = tcx.TcxPlugin()
+        p.workers = workers
+        p.tcx_output_dir = os.path.join(dir, "tcx-%d" % workers)
+        start = time.time()
+        assert p.data_available(1, "raw", raw_files) == raw_files
+        _LOG.info("workers=%d: %0.3fs", workers, time.time() - start)
+finally:
+    shutil.rmtree(dir)
+
+# vim: ts=4 sts=4 et
@@ -0,0 +1,473 @@
+"""
+An emulated ANT-FS client (GPS watch) which can be used
+in place of an ant.Session, so antfs.Host can be tested
+without hardware. Commands are handled synchronously,
+each write queues the watches reply for the next read.
+"""
+
+import struct
+import logging
+
+import antd.ant as ant
+import antd.antfs as antfs
+import antd.garmin as garmin
+import antd.plugin as plugin
+
+_log = logging.getLogger("antd.emulator")
+
+
+class Watch(object):
+    """
+    ANT-FS client state machine. files maps
+    file index to data, index 0 (the directory)
+    is generated from the other files.
+    """
+
+    max_block_size = 512
+    link_freq = 50
+
+    def __init__(self, device_number=0x1234, device_id=0xdeadbeef, key="\x01" * 8,
+                 files=None, data_available=True, pairing_enabled=False):
+        self.device_number = device_number
+        self.device_id = device_id
+        self.key = key
+        self.files = dict(files or {})
+        self.data_available = data_available
+        self.pairing_enabled = pairing_enabled
+        self.state = antfs.Beacon.STATE_LINK
+        self.freq = None
+        self.uploads = {}
+
+    @property
+    def rf_freq(self):
+        return self.freq if self.state != antfs.Beacon.STATE_LINK else self.link_freq
+
+    def beacon(self):
+        status_1 = (0x04
+                | (0x80 if self.pairing_enabled else 0)
+                | (0x20 if self.data_available else 0)
+                | 0x10)
+        return struct.pack("<BBBBI", antfs.Beacon.DATA_PAGE_ID, status_1, self.state, 0x03, antfs.ANTFS_HOST_ID)
+
+    def directory(self):
+        files = [antfs.Directory.File(index, 0x80, 0x04, index, 0, antfs.Directory.FLAG_READ
+                                      | antfs.Directory.FLAG_WRITE | antfs.Directory.FLAG_ERASE, len(data), 0)
+                 for index, data in sorted(self.files.items())]
+        return antfs.Directory(files).pack()
+
+    def handle(self, msg):
+        """
+        Process the given command, return reply or None.
+        """
+        cmd = antfs.Command.unpack(self.beacon() + msg)
+        if not cmd:
+            return
+        handler = self.handlers.get(cmd.command_id)
+        if handler:
+            return handler(self, self.beacon() + msg)
+
+    def _link(self, msg):
+        if self.state == antfs.Beacon.STATE_LINK:
+            self.freq = ord(msg[10])
+            self.state = antfs.Beacon.STATE_AUTH
+
+    def _disconnect(self, msg):
+        self.state = antfs.Beacon.STATE_LINK
+        self.freq = None
+
+    def _auth(self, msg):
+        data_page_id, command_id, op_id, length, host_id = struct.unpack("<BBBBI", msg[8:16])
+        response = antfs.Auth.RESPONSE_NA
+        auth_string = ""
+        if op_id == antfs.Auth.OP_CLIENT_SN:
+            auth_string = "emulated"
+        elif op_id == antfs.Auth.OP_PASSKEY:
+            if msg[16:16 + length] == self.key:
+                response = antfs.Auth.RESPONSE_ACCEPT
+                self.state = antfs.Beacon.STATE_TRANSPORT
+            else:
+                response = antfs.Auth.RESPONSE_REJECT
+        elif op_id == antfs.Auth.OP_PAIR:
+            if self.pairing_enabled:
+                response = antfs.Auth.RESPONSE_ACCEPT
+                auth_string = self.key
+                self.state = antfs.Beacon.STATE_TRANSPORT
+            else:
+                response = antfs.Auth.RESPONSE_REJECT
+        return antfs.pad(struct.pack("<BBBBI", antfs.Command.DATA_PAGE_ID, antfs.Command.AUTH | 0x80,
+                                     response, len(auth_string), self.device_id) + auth_string)
+
+    def _download(self, msg):
+        request = antfs.Download.unpack(msg)
+        if self.state != antfs.Beacon.STATE_TRANSPORT:
+            return antfs.DownloadResponse(antfs.DownloadResponse.RESPONSE_NOT_READY).pack()
+        if request.index == 0:
+            data = self.directory()
+        elif request.index in self.files:
+            data = self.files[request.index]
+        else:
+            return antfs.DownloadResponse(antfs.DownloadResponse.RESPONSE_NOT_EXIST).pack()
+        if not request.initial and antfs.crc16(data[:request.offset]) != request.crc_seed:
+            return antfs.DownloadResponse(antfs.DownloadResponse.RESPONSE_CRC_INCORRECT).pack()
+        block_size = min(request.max_block_size or self.max_block_size, self.max_block_size)
+        block = data[request.offset:request.offset + block_size]
+        return antfs.DownloadResponse(antfs.DownloadResponse.RESPONSE_OK, block, request.offset,
+                                      len(data), antfs.crc16(block, request.crc_seed)).pack()
+
+    def _upload(self, msg):
+        request = antfs.Upload.unpack(msg)
+        if self.state != antfs.Beacon.STATE_TRANSPORT:
+            return antfs.UploadResponse(antfs.UploadResponse.RESPONSE_NOT_READY).pack()
+        data = self.files.get(request.index, "")[:request.offset]
+        self.uploads[request.index] = (data, request.max_size)
+        return antfs.UploadResponse(antfs.UploadResponse.RESPONSE_OK, len(data), 0xFFFFFFFF,
+                                    self.max_block_size, antfs.crc16(data)).pack()
+
+    def _upload_data(self, msg):
+        upload = antfs.UploadData.unpack(msg)
+        for index, (data, max_size) in self.uploads.items():
+            if upload.offset == len(data):
+                block = upload.data[:max_size - len(data)]
+                if antfs.crc16(data) != upload.crc_seed or antfs.crc16(block, upload.crc_seed) != upload.crc:
+                    break
+                data += block
+                self.uploads[index] = (data, max_size)
+                if len(data) >= max_size:
+                    self.files[index] = data
+                    del self.uploads[index]
+                return antfs.UploadDataResponse(antfs.UploadDataResponse.RESPONSE_OK).pack()
+        return antfs.UploadDataResponse(antfs.UploadDataResponse.RESPONSE_FAILED).pack()
+
+    def _erase(self, msg):
+        request = antfs.Erase.unpack(msg)
+        if self.state != antfs.Beacon.STATE_TRANSPORT:
+            return antfs.EraseResponse(antfs.EraseResponse.RESPONSE_NOT_READY).pack()
+        if self.files.pop(request.index, None) is None:
+            return antfs.EraseResponse(antfs.EraseResponse.RESPONSE_FAILED).pack()
+        return antfs.EraseResponse(antfs.EraseResponse.RESPONSE_OK).pack()
+
+    handlers = {
+        antfs.Command.LINK: _link,
+        antfs.Command.DISCONNECT: _disconnect,
+        antfs.Command.AUTH: _auth,
+        antfs.Command.DOWNLOAD: _download,
+        antfs.Command.UPLOAD: _upload,
+        antfs.Command.UPLOAD_DATA: _upload_data,
+        antfs.Command.ERASE: _erase,
+    }
+
+
+class Channel(object):
+    """
+    Implements the subset of ant.Channel used by antfs.Host.
+    When opened, the channel starts tracking the next watch
+    which is in range (round robin), matching rf frequency
+    and device number (if set.)
+    """
+
+    def __init__(self, session, channel_number):
+        self._session = session
+        self.channel_number = channel_number
+        self.replies = []
+        self.is_open = False
+        self.rf_freq = 66
+        self.device_number = 0
+        self.watch = None
+        self.get_id_count = 0
+
+    def open(self):
+        self.is_open = True
+        self.watch = self._session.next_watch(self)
+
+    def close(self):
+        self.is_open = False
+        self.watch = None
+
+    def assign(self, channel_type, network_number): pass
+    def unassign(self): pass
+    def set_period(self, messaging_period=8192): pass
+    def set_search_timeout(self, search_timeout=12): pass
+    def set_search_waveform(self, search_waveform=None): pass
+
+    def set_id(self, device_number=0, device_type_id=0, trans_type=0):
+        self.device_number = device_number
+
+    def set_rf_freq(self, rf_freq=66):
+        self.rf_freq = rf_freq
+
+    def get_id(self):
+        self.get_id_count += 1
+        return ant.ChannelId(self.channel_number, self.watch.device_number if self.watch else 0, 1, 5)
+
+    def recv_broadcast(self, timeout=None, extended=False):
+        self._check_tracking(ant.AntTimeoutError)
+        beacon = self.watch.beacon()
+        if extended and self._session.lib_config & ant.LIB_CONFIG_CHANNEL_ID:
+            beacon += struct.pack("<BHBB", ant.LIB_CONFIG_CHANNEL_ID, self.watch.device_number, 1, 5)
+        return beacon
+
+    def send_acknowledged(self, data, timeout=None, retry=None, direct=False):
+        self.write(data)
+
+    def send_burst(self, data, timeout=None, retry=None):
+        self.write(data)
+
+    def write(self, data, timeout=None, retry=None):
+        self._check_tracking(ant.AntTxFailedError)
+        reply = self.watch.handle(ant.data_tostring(data))
+        if reply:
+            self.replies.append(self.watch.beacon() + reply)
+
+    def read(self, timeout=None):
+        if not self.is_open:
+            raise ant.AntChannelClosedError("Channel closed.")
+        if not self.replies:
+            raise ant.AntTimeoutError("No reply to command.")
+        return self.replies.pop(0)
+
+    def _check_tracking(self, error):
+        if not self.is_open:
+            raise ant.AntChannelClosedError("Channel closed.")
+        if not self.watch or self.watch.rf_freq != self.rf_freq:
+            # watch may have changed frequency, try to find it again
+            self.watch = self._session.next_watch(self)
+        if not self.watch:
+            raise error("No device found.")
+
+
+class Network(object):
+
+    def __init__(self, session, network_number):
+        self._session = session
+        self.network_number = network_number
+
+    def set_key(self, network_key="\x00" * 8): pass
+
+
+class Session(object):
+    """
+    Implements the subset of ant.Session used by antfs.Host.
+    watches is one or more Watch which are in range.
+    extended_messages=False emulates AP1 hardware.
+    """
+
+    def __init__(self, watches, extended_messages=True):
+        self.watches = list(watches) if isinstance(watches, (list, tuple)) else [watches]
+        self.extended_messages = extended_messages
+        self.lib_config = 0
+        self.channels = [Channel(self, n) for n in range(0, 8)]
+        self.networks = [Network(self, n) for n in range(0, 3)]
+        self._next = 0
+
+    def next_watch(self, channel):
+        for n in range(0, len(self.watches)):
+            watch = self.watches[(self._next + n) % len(self.watches)]
+            if (watch.rf_freq == channel.rf_freq
+                    and channel.device_number in (0, watch.device_number)):
+                self._next = (self._next + n + 1) % len(self.watches)
+                return watch
+
+    def set_lib_config(self, lib_config):
+        if not self.extended_messages:
+            raise ant.AntError("Failed to execute command message_code=%d." % ant.INVALID_MESSAGE)
+        self.lib_config = lib_config
+
+    def reset_system(self):
+        self.lib_config = 0
+        for channel in self.channels:
+            channel.close()
+            channel.replies = []
+
+    def close(self):
+        self.reset_system()
+
+
+class Garmin(object):
+    """
+    Emulated garmin device, implements the stream
+    (write/read) used by garmin.Device. Returns a
+    synthetic history of runs, see history().
+    packets_sent counts data packets transfered.
+    air_time is simulated seconds spent on the radio,
+    writes cost a channel period (wait for the
+    acknowledgement) and reads a period plus the
+    burst transfer time.
+    """
+
+    protocol_array = ["P000", "L001", "A010", "A1000", "D1009", "A906", "D1015", "A302", "D311", "D1018"]
+    product_id = 1018
+    software_version = 280
+    description = "Forerunner 405"
+    # max waypoints per PID_TRK_DATA_ARRAY packet
+    wpts_per_packet = 16
+    # tracks are sent oldest first unless set
+    newest_first = False
+    # track_index of runs which have no track (e.g. deleted)
+    missing_tracks = ()
+    # max bytes of packets returned per read (burst),
+    # by default a single packet is returned per read.
+    burst_size = 0
+    channel_period = 1 / 8.
+    # time to transfer one 8 byte ANT burst packet
+    burst_packet_time = 1 / 200.
+
+    def __init__(self, runs=None):
+        self.runs = runs or []
+        self.pending = []
+        self.packets_sent = 0
+        self.commands = []
+        self.acks = 0
+        self.air_time = 0
+
+    def write(self, msg):
+        self.air_time += self.channel_period
+        pid, length, data = garmin.unpack(msg)
+        if pid == garmin.P000.PID_ACK:
+            self.acks += 1
+            return
+        elif pid == garmin.L000.PID_PRODUCT_RQST:
+            self.pending = self.product_data()
+        elif pid == garmin.L001.PID_COMMAND_DATA:
+            (command,) = struct.unpack("<H", data[:2])
+            self.commands.append(command)
+            if command == garmin.A010.CMND_ABORT_TRANSFER:
+                self.pending = self.pending[-1:]
+            else:
+                self.pending = self.transfer(command)
+
+    def read(self):
+        burst = ""
+        while self.pending and (not burst or len(burst) + len(self.pending[0]) <= self.burst_size):
+            self.packets_sent += 1
+            burst += self.pending.pop(0)
+        # plus 8 byte ANT-FS direct header
+        self.air_time += self.channel_period + (len(burst) + 15) // 8 * self.burst_packet_time
+        return burst
+
+    def product_data(self):
+        protocols = "".join(struct.pack("<cH", p[0], int(p[1:])) for p in self.protocol_array)
+        return [self.packet(garmin.L000.PID_PRODUCT_DATA, struct.pack("<Hh", self.product_id,
+                    self.software_version) + self.description + "\x00"),
+                self.packet(garmin.L000.PID_PROTOCOL_ARRAY, protocols)]
+
+    def transfer(self, command):
+        records = []
+        if command == garmin.A010.CMND_TRANSFER_RUNS:
+            records = [self.packet(garmin.L001.PID_RUN, run.pack()) for run in self.runs]
+        elif command == garmin.A010.CMND_TRANSFER_LAPS:
+            records = [self.packet(garmin.L001.PID_LAP, lap.pack()) for run in self.runs for lap in run.laps]
+        elif command == garmin.A010.CMND_TRANSFER_TRK:
+            for run in (reversed(self.runs) if self.newest_first else self.runs):
+                if run.track_index in self.missing_tracks: continue
+                records.append(self.packet(garmin.L001.PID_TRK_HDR, struct.pack("<H", run.track_index)))
+                wpts = [wpt for lap in run.laps for wpt in lap.wpts]
+                for n in range(0, len(wpts), self.wpts_per_packet):
+                    chunk = wpts[n:n + self.wpts_per_packet]
+                    records.append(self.packet(garmin.L001.PID_TRK_DATA_ARRAY,
+                            struct.pack("<I", len(chunk)) + "".join(w.pack() + "\x00" for w in chunk)))
+        count = len(records)
+        if command == garmin.A010.CMND_TRANSFER_TRK:
+            # each waypoint in a PID_TRK_DATA_ARRAY is a record
+            runs = [run for run in self.runs if run.track_index not in self.missing_tracks]
+            count = len(runs) + sum(len(lap.wpts) for run in runs for lap in run.laps)
+        return ([self.packet(garmin.L001.PID_RECORDS, struct.pack("<H", min(count, 0xFFFF)))]
+                + records + [self.packet(garmin.L001.PID_XFER_CMPLT, struct.pack("<H", command))])
+
+    def packet(self, pid, data):
+        return struct.pack("<HH", pid, len(data)) + data
+
+
+class Run(object):
+
+    def __init__(self, track_index, laps):
+        self.track_index = track_index
+        self.laps = laps
+
+    def pack(self):
+        return (struct.pack("<HHHBBBx2xIf", self.track_index, self.laps[0].index, self.laps[-1].index,
+                            1, 0, 0, self.laps[0].start_time, sum(l.distance for l in self.laps))
+                + struct.pack("<I16sb", 0, "", 0))
+
+
+class Lap(object):
+
+    def __init__(self, index, start_time, wpts):
+        self.index = index
+        self.start_time = start_time
+        self.wpts = wpts
+        self.distance = wpts[-1].distance - wpts[0].distance if wpts else 0
+
+    def pack(self):
+        begin = self.wpts[0] if self.wpts else Wpt(self.start_time, 0)
+        end = self.wpts[-1] if self.wpts else begin
+        return struct.pack("<H2xIIffiiiiHBBBBBBBBBB", self.index, self.start_time,
+                           (end.time - begin.time) * 100, self.distance, 4.,
+                           begin.lat, begin.lon, end.lat, end.lon, 100, 140, 160, 0, 0xFF, 0, 0, 0, 0, 0, 0)
+
+
+class Wpt(object):
+
+    def __init__(self, time, distance, lat=0x1fffffff, lon=-0x1fffffff):
+        self.time = time
+        self.distance = distance
+        self.lat = lat
+        self.lon = lon
+
+    def pack(self):
+        return struct.pack("<iiIffBBB", self.lat, self.lon, self.time, 100., self.distance, 150, 0xFF, 1)
+
+
+def history(runs=10, laps_per_run=3, wpts_per_lap=100, start_time=600000000):
+    """
+    Generate a synthetic history of runs, one run a day,
+    each lap is a km, with a waypoint every second.
+    """
+    result = []
+    lap_index = 0
+    for run_index in range(0, runs):
+        time = start_time + run_index * 86400
+        laps = []
+        for lap_num in range(0, laps_per_run):
+            wpts = [Wpt(time + n, lap_num * 1000. + n * 1000. / wpts_per_lap, lat=0x1fffffff + run_index * 1000 + n)
+                    for n in range(0, wpts_per_lap)]
+            laps.append(Lap(lap_index, time, wpts))
+            lap_index += 1
+            time += wpts_per_lap
+        result.append(Run(run_index, laps))
+    return result
+
+
+
+def save_raw(file_name, history):
+    """
+    Write a raw file of a full download of the
+    given history (see history()), returns file_name.
+    """
+    dev = garmin.Device(Garmin(history))
+    with open(file_name, "w") as file:
+        garmin.dump(file, dev.product_data)
+        garmin.dump(file, dev.get_runs())
+    return file_name
+
+
+class Recorder(plugin.Plugin):
+    """
+    Plugin which records (device_sn, format, files)
+    of all data published to it.
+    """
+
+    def __init__(self):
+        self.published = []
+
+    def data_available(self, device_sn, format, files):
+        self.published.append((device_sn, format, files))
+        return files
+
+    def files(self):
+        """
+        All files published, in order.
+        """
+        return [file for device_sn, format, files in self.published for file in files]
+
+
+# vim: ts=4 sts=4 et
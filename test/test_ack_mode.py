@@ -0,0 +1,48 @@
+#!/usr/bin/python
+
+import sys
+import logging
+
+import antd.garmin as garmin
+import emulator
+
+logging.basicConfig(
+        level=logging.INFO,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+def download(ack_mode, burst_size):
+    history = emulator.history(runs=20, wpts_per_lap=300)
+    stream = emulator.Garmin(history)
+    stream.burst_size = burst_size
+    dev = garmin.Device(stream, ack_mode)
+    stream.air_time = stream.acks = 0
+    runs = dev.get_runs()
+    wpts = len(list(garmin.extract_wpts(dev, runs[2], 0))) * len(history)
+    _LOG.info("ack_mode=%s burst_size=%d: %d ack(s), %0.1fs air time, %d wpts/sec",
+              ack_mode, burst_size, stream.acks, stream.air_time, wpts / stream.air_time)
+    return stream, garmin.extract_runs(dev, runs)
+
+# same result regardless of ack mode
+each, each_runs = download(garmin.Device.ACK_EACH, 1024)
+burst, burst_runs = download(garmin.Device.ACK_BURST, 1024)
+assert [(a.time, a.distance) for a in each_runs] == [(a.time, a.distance) for a in burst_runs]
+assert burst.acks < each.acks
+assert burst.air_time < each.air_time
+
+# one packet per burst, no difference
+each, each_runs = download(garmin.Device.ACK_EACH, 0)
+burst, burst_runs = download(garmin.Device.ACK_BURST, 0)
+assert burst.acks == each.acks
+
+try:
+    garmin.Device(emulator.Garmin(), "none")
+    assert False
+except ValueError:
+    pass
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et
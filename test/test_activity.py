@@ -0,0 +1,71 @@
+#!/usr/bin/python
+
+import sys
+import logging
+import struct
+
+import antd.garmin as garmin
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+history = emulator.history(runs=1, laps_per_run=3, wpts_per_lap=10)
+wpts = [w for lap in history[0].laps for w in lap.wpts]
+# add some missing values
+wpts[1].lat = wpts[1].lon = 2**31 - 1
+raw = [w.pack() for w in wpts]
+raw[2] = raw[2][:12] + "\x51\x59\x04\x69" * 2 + "\x00\x50\x00"
+raw[3] = raw[3][:20] + "\x8c\x00\x01"
+data = struct.pack("<I", len(raw)) + "".join(r + "\x00" for r in raw)
+
+def activity(use_numpy):
+    garmin.D1018.use_numpy = use_numpy
+    d1018 = garmin.D1018(data)
+    laps = [garmin.D1015(lap.pack()) for lap in history[0].laps]
+    result = garmin.Activity(garmin.D1009(history[0].pack()), laps)
+    result.extend(d1018)
+    result.assign_laps()
+    return d1018, result
+
+expected, python = activity(False)
+assert len(python) == 30
+assert [list(python.lap_points(n)) for n in range(0, 3)] == [range(0, 10), range(10, 20), range(20, 30)]
+for n, wpt in enumerate(expected.wpts):
+    point = python.point(n)
+    assert point.time == wpt.time.time and point.valid == wpt.posn.valid
+    assert point.deglat == wpt.posn.deglat and point.deglon == wpt.posn.deglon
+    assert point.alt == wpt.alt and point.distance == wpt.distance
+    assert point.heart_rate == wpt.heart_rate and point.cadence == wpt.cadence
+    assert point.sensor == wpt.sensor
+assert not python.point(1).valid and python.point(1).deglat is None
+assert python.point(2).alt is None and python.point(2).heart_rate is None
+assert python.point(2).cadence == 0x50 and python.point(3).cadence == 0
+assert python.point(4).cadence is None and python.point(3).heart_rate == 0x8c
+
+# single waypoint packets (PID_TRK_DATA)
+single = garmin.Activity(python.run, python.laps)
+for wpt in expected.wpts: single.append(wpt)
+assert [single.point(n) for n in range(0, 30)] == [python.point(n) for n in range(0, 30)]
+
+# empty laps, and points recorded before the first lap started
+laps = [garmin.D1015(lap.pack()) for lap in history[0].laps] + [garmin.D1015(history[0].laps[2].pack())]
+laps[1].start_time.time = laps[2].start_time.time
+laps[3].start_time.time = 0xFFFFFFFF
+edge = garmin.Activity(python.run, laps)
+for t in [laps[0].start_time.time - 5] + list(python.time[:30]): edge.time.append(t)
+edge.assign_laps()
+assert [len(edge.lap_points(n)) for n in range(0, 4)] == [21, 0, 10, 0]
+
+if garmin.numpy is not None:
+    d1018, vectorized = activity(True)
+    assert "wpts" not in d1018.__dict__
+    assert [vectorized.point(n) for n in range(0, 30)] == [python.point(n) for n in range(0, 30)]
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et
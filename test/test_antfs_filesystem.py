@@ -0,0 +1,63 @@
+#!/usr/bin/python
+
+import sys
+import logging
+
+import antd.antfs as antfs
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+data = "".join(chr(n % 251) for n in xrange(0, 5000))
+watch = emulator.Watch(files={1: data, 2: "erase me"})
+keys = antfs.DeviceDb()
+keys.add_key(watch.device_id, watch.key)
+keys.add_device_id(watch.device_number, watch.device_id)
+host = antfs.Host(emulator.Session(watch), keys)
+
+assert host.search()
+host.link()
+host.auth(pair=False)
+
+directory = host.download_directory()
+_LOG.info("DIRECTORY: %s", directory)
+assert [(f.index, f.size) for f in directory.files] == [(1, len(data)), (2, 8)]
+
+# full download, multiple blocks
+assert host.download(1) == data
+
+# resume a broken download
+prefix = data[:1234]
+assert prefix + host.download(1, len(prefix), antfs.crc16(prefix)) == data
+
+# resume with wrong crc is rejected
+try:
+    host.download(1, len(prefix), 0x1234)
+    assert False, "expected download with bad crc seed to fail"
+except antfs.AntFsError:
+    pass
+
+# upload, and append
+host.upload(3, "hello ")
+host.upload(3, "world", offset=6)
+assert host.download(3) == "hello world"
+
+# erase
+host.erase(2)
+assert [f.index for f in host.download_directory().files] == [1, 3]
+try:
+    host.erase(2)
+    assert False, "expected erase of missing file to fail"
+except antfs.AntFsError:
+    pass
+
+host.close()
+_LOG.info("OK")
+
+
+# vim: ts=4 sts=4 et
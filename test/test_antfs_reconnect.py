@@ -0,0 +1,50 @@
+#!/usr/bin/python
+
+import sys
+import logging
+
+import antd.antfs as antfs
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+watch = emulator.Watch(files={1: "data"})
+keys = antfs.DeviceDb()
+keys.add_key(watch.device_id, watch.key)
+keys.add_device_id(watch.device_number, watch.device_id)
+session = emulator.Session(watch)
+host = antfs.Host(session, keys)
+
+assert host.reconnect() is None
+assert host.search()
+host.link()
+host.auth(pair=False)
+_LOG.info("LINK: %s", host.last_link)
+assert host.last_link.device_number == watch.device_number
+assert host.last_link.frequency == watch.freq
+
+# link lost, but device still in transport
+session.reset_system()
+assert host.reconnect().device_state == antfs.Beacon.STATE_TRANSPORT
+assert host.download(1) == "data"
+
+# device dropped back to auth, key is re-sent
+session.reset_system()
+watch.state = antfs.Beacon.STATE_AUTH
+assert host.reconnect().device_state == antfs.Beacon.STATE_TRANSPORT
+assert host.download(1) == "data"
+
+# device reverted to link state, full search required
+session.reset_system()
+watch.state = antfs.Beacon.STATE_LINK
+assert host.reconnect() is None
+
+_LOG.info("OK")
+
+
+# vim: ts=4 sts=4 et
@@ -0,0 +1,48 @@
+#!/usr/bin/python
+
+import sys
+import logging
+import struct
+import array
+
+import antd.ant as ant
+import antd.antfs as antfs
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+# extended data is split from payload when unpacking ANT messages
+msg = [ant.SYNC, 14, ant.RecvBroadcastData.ID, 0] + [0x43] * 8 + [0x80, 0x34, 0x12, 0x01, 0x05]
+msg.append(ant.generate_checksum(msg))
+cmd = ant.Core(None).unpack(array.array("B", msg))
+assert isinstance(cmd, ant.RecvBroadcastData)
+assert cmd.data == "\x43" * 8
+beacon = antfs.Beacon.unpack(cmd.data + cmd.extended_data)
+assert beacon.device_number == 0x1234 and beacon.data == ""
+assert antfs.Beacon.unpack(cmd.data).device_number is None
+
+def search(extended_messages):
+    watches = [emulator.Watch(device_number=n, device_id=n) for n in range(1, 41)]
+    keys = antfs.DeviceDb()
+    keys.add_key(40, watches[-1].key)
+    keys.add_device_id(40, 40)
+    session = emulator.Session(watches, extended_messages)
+    host = antfs.Host(session, keys)
+    assert host.search(search_timeout=5)
+    assert host.device_id == 40 and host.device_number == 40
+    return session.channels[0].get_id_count
+
+# AP2, device number comes with beacon
+assert search(True) == 0
+# AP1, fallback to get_id()
+assert search(False) == 40
+
+_LOG.info("OK")
+
+
+# vim: ts=4 sts=4 et
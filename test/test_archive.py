@@ -0,0 +1,128 @@
+#!/usr/bin/python
+
+import sys
+import os
+import shutil
+import logging
+import tempfile
+import StringIO
+
+import antd.garmin as garmin
+import antd.archive as archive
+import antd.plugin as plugin
+import antd.tcx as tcx
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+def sync(runs):
+    """
+    Raw file contents of a download of history with given runs.
+    """
+    dev = garmin.Device(emulator.Garmin(emulator.history(runs=runs, wpts_per_lap=20)))
+    raw = StringIO.StringIO()
+    garmin.dump(raw, dev.product_data)
+    garmin.dump(raw, dev.get_runs())
+    return raw.getvalue()
+
+syncs = [("%d.raw" % n, sync(n + 3)) for n in range(0, 6)]
+dir = tempfile.mkdtemp()
+try:
+    a = archive.Archive(os.path.join(dir, "archive"))
+    a.block_size = 1024
+    a.segment_size = 2048
+    for n, (name, data) in enumerate(syncs):
+        assert a.add(name, data, sync_time=1000 + n)
+    # already archived
+    assert a.add(syncs[0][0], syncs[0][1]) == 0
+    assert [name for name, sync_time in a.syncs()] == [name for name, data in syncs]
+    for name, data in syncs:
+        assert a.read(name) == data
+    segments = [f for f in os.listdir(a.dir) if f.endswith(".seg")]
+    size = sum(os.path.getsize(os.path.join(a.dir, f)) for f in segments)
+    raw_size = sum(len(data) for name, data in syncs)
+    _LOG.info("raw=%d bytes, archive=%d bytes in %d segment(s).", raw_size, size, len(segments))
+    assert len(segments) > 1 and size < raw_size / 4
+    assert a.verify() > len(syncs)
+
+    # archived syncs can be converted to tcx
+    tcx_dir = os.path.join(dir, "tcx")
+    os.mkdir(tcx_dir)
+    assert len(tcx.export_tcx(1, a.open("5.raw"), tcx_dir)) == 8
+
+    # retention, unused packets reclaimed
+    a.apply_retention(keep_syncs=4)
+    assert [name for name, sync_time in a.syncs()] == ["2.raw", "3.raw", "4.raw", "5.raw"]
+    # history is repeated by every sync, so most packets are still used
+    a.compact_ratio = 0.95
+    a.apply_retention(keep_days=1, now=1005 + 86400)
+    assert [name for name, sync_time in a.syncs()] == ["5.raw"]
+    assert a.read("5.raw") == syncs[5][1]
+    compacted = sum(os.path.getsize(os.path.join(a.dir, f)) for f in os.listdir(a.dir) if f.endswith(".seg"))
+    assert compacted < size and not os.path.exists(a.dir + ".old")
+    a.close()
+
+    # corrupt block detected
+    segment = os.path.join(a.dir, "000000.seg")
+    with open(segment, "r+b") as file:
+        file.seek(100)
+        byte = file.read(1)
+        file.seek(100)
+        file.write(chr(ord(byte) ^ 0xFF))
+    with archive.Archive(a.dir) as a:
+        try:
+            a.verify()
+            assert False
+        except archive.ArchiveError:
+            pass
+
+    # plugin
+    raw_dir = os.path.join(dir, "raw")
+    os.mkdir(raw_dir)
+    files = []
+    for name, data in syncs:
+        files.append(os.path.join(raw_dir, name))
+        with open(files[-1], "w") as file: file.write(data)
+    p = archive.ArchivePlugin()
+    p.archive_dir = os.path.join(dir, "%(device_id)s")
+    p.keep_syncs = 3
+    p.delete_raw = True
+    assert p.data_available(1, "tcx", files) == files
+    assert p.data_available(1, "raw", files) == files
+    assert not os.listdir(raw_dir)
+    with archive.Archive(os.path.join(dir, "0x1")) as a:
+        assert [name for name, sync_time in a.syncs()] == ["3.raw", "4.raw", "5.raw"]
+        assert a.read("4.raw") == syncs[4][1]
+
+    # raw file pending retry in an earlier plugin isn't deleted
+    # until that plugin, then archive's retry, succeed
+    class Converter(plugin.Plugin):
+        cache = os.path.join(dir, "converter.txt")
+        fail = True
+        def data_available(self, device_sn, format, files):
+            return [] if self.fail else files
+    converter = Converter()
+    p.cache = os.path.join(dir, "archive.txt")
+    with open(files[0], "w") as file: file.write(syncs[0][1])
+    plugin.register_plugins(converter, p)
+    try:
+        plugin.publish_data(1, "raw", files[:1])
+        assert os.path.isfile(files[0])
+        converter.fail = False
+        plugin.recover_and_publish_data(converter)
+        assert os.path.isfile(files[0])
+        plugin.recover_and_publish_data(p)
+        assert not os.path.exists(files[0]) and not os.path.exists(p.cache)
+    finally:
+        del plugin._plugins[:]
+finally:
+    shutil.rmtree(dir)
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+
+import sys
+import os
+import shutil
+import logging
+import tempfile
+import threading
+import multiprocessing
+import sqlite3
+
+import antd.antfs as antfs
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+def increment(file_name, count):
+    """
+    read-modify-write of device 1's counter, count times.
+    """
+    db = antfs.DeviceDb(file_name)
+    for n in range(0, count):
+        with db._transaction() as conn:
+            (value,) = conn.execute("SELECT value FROM device_meta WHERE device_id = 1 AND name = 'counter'").fetchone()
+            conn.execute("UPDATE device_meta SET value = ? WHERE device_id = 1 AND name = 'counter'", (value + 1,))
+    db.close()
+
+dir = tempfile.mkdtemp()
+try:
+    # pairings of legacy known_devices.cfg are imported once
+    legacy_file = os.path.join(dir, "known_devices.cfg")
+    legacy = antfs.KnownDeviceDb(legacy_file)
+    legacy.add_key(0xdeadbeef, "\x01" * 8)
+    legacy.add_device_id(0x1234, 0xdeadbeef)
+    legacy.add_key(0x00c0ffee, "\x02" * 8)
+    db_file = os.path.join(dir, "known_devices.db")
+    db = antfs.DeviceDb(db_file, legacy_file)
+    assert db.get_device_ids() == [0x00c0ffee, 0xdeadbeef]
+    assert db.get_key(0xdeadbeef) == "\x01" * 8 and db.get_key(0x00c0ffee) == "\x02" * 8
+    assert db.get_device_id(0x1234) == 0xdeadbeef and db.get_device_number(0xdeadbeef) == 0x1234
+    db.delete_device(0x00c0ffee)
+    db.close()
+    db = antfs.DeviceDb(db_file, legacy_file)
+    assert db.get_device_ids() == [0xdeadbeef]
+
+    # metadata round trip, None removes an entry
+    db.set_meta(0xdeadbeef, last_sync=1330000000.5, transport_freq=19, model="Forerunner 405")
+    db.close()
+    db = antfs.DeviceDb(db_file)
+    assert db.get_all_meta(0xdeadbeef) == {"last_sync": 1330000000.5, "transport_freq": 19, "model": "Forerunner 405"}
+    db.set_meta(0xdeadbeef, model=None)
+    assert db.get_meta(0xdeadbeef, "model") is None and db.get_meta(0xdeadbeef, "model", "?") == "?"
+    assert db.get_meta(0x12345678, "last_sync") is None and db.get_all_meta(0x12345678) == {}
+
+    # write lock is taken by BEGIN IMMEDIATE, a writer
+    # in another connection waits for commit or times out
+    other = antfs.DeviceDb(db_file, timeout=.1)
+    with db._transaction():
+        try:
+            other.set_meta(0xdeadbeef, last_sync=0)
+            assert False
+        except sqlite3.OperationalError:
+            pass
+    other.set_meta(0xdeadbeef, last_sync=0)
+    assert db.get_meta(0xdeadbeef, "last_sync") == 0
+    other.close()
+
+    # no lost updates from concurrent processes
+    db.set_meta(1, counter=0)
+    procs = [multiprocessing.Process(target=increment, args=(db_file, 50)) for n in range(0, 4)]
+    for proc in procs: proc.start()
+    for proc in procs: proc.join()
+    assert all(proc.exitcode == 0 for proc in procs)
+    assert db.get_meta(1, "counter") == 200
+
+    # threads sharing one connection don't interleave transactions
+    errors = []
+    def thread_increment(device_id):
+        try:
+            for n in range(0, 200):
+                db.set_meta(device_id, counter=db.get_meta(device_id, "counter", 0) + 1)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=thread_increment, args=(n,)) for n in range(10, 14)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert not errors, errors
+    assert [db.get_meta(n, "counter") for n in range(10, 14)] == [200] * 4
+    db.close()
+finally:
+    shutil.rmtree(dir)
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et
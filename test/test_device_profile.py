@@ -0,0 +1,50 @@
+#!/usr/bin/python
+
+import sys
+import logging
+import StringIO
+
+import antd.garmin as garmin
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+# devices of same model and firmware share one profile
+stream = emulator.Garmin(emulator.history(runs=2))
+dev = garmin.Device(stream)
+assert stream.product_data() and dev.product_data.by_pid[garmin.L000.PID_PRODUCT_DATA]
+other = garmin.Device(emulator.Garmin())
+assert other.profile is dev.profile
+assert other.run_proto is not dev.run_proto and other.run_proto.trk_proto is other.trk_proto
+assert isinstance(dev.trk_proto, garmin.A302)
+
+# firmware update, new profile
+update = emulator.Garmin()
+update.software_version = 300
+assert garmin.Device(update).profile is not dev.profile
+
+# optional protocols the device doesn't implement are skipped
+no_trks = emulator.Garmin()
+no_trks.protocol_array = [p for p in no_trks.protocol_array if p not in ("A302", "D311", "D1018")]
+limited = garmin.Device(no_trks)
+assert limited.trk_proto is None and "get_trks" in limited.profile.skip
+# A1000 requires tracks, not retried for later devices
+assert limited.run_proto is None and "get_runs" in limited.profile.skip
+assert garmin.Device(no_trks).profile is limited.profile
+
+# raw replay reuses the profile of the live device
+raw = StringIO.StringIO()
+garmin.dump(raw, dev.product_data)
+garmin.dump(raw, dev.get_runs())
+replay = garmin.Device(garmin.MockHost(raw.getvalue()))
+assert replay.profile is dev.profile
+assert len(garmin.extract_runs(replay, replay.get_runs())) == 2
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+import sys
+import os
+import struct
+import shutil
+import logging
+import tempfile
+import StringIO
+
+import antd.garmin as garmin
+import antd.antfs as antfs
+import antd.plugin as plugin
+import antd.fit as fit
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+BASE_TYPES = {0x00: "B", 0x02: "B", 0x83: "h", 0x84: "H", 0x85: "i", 0x86: "I", 0x8C: "I"}
+
+def read_fit(data):
+    """
+    Return [(global message number, {field number: value})]
+    and the number of definition messages.
+    """
+    header_size, protocol, profile, size, magic, header_crc = struct.unpack("<BBHI4sH", data[:14])
+    assert header_size == 14 and magic == ".FIT" and len(data) == 14 + size + 2
+    assert antfs.crc16(data[:12]) == header_crc
+    assert antfs.crc16(data) == 0
+    formats = {}
+    messages = []
+    definitions = 0
+    offset = 14
+    while offset < 14 + size:
+        header = ord(data[offset])
+        offset += 1
+        assert not header & 0x80
+        if header & 0x40:
+            reserved, arch, number, count = struct.unpack("<BBHB", data[offset:offset + 5])
+            fields = [struct.unpack("<BBB", data[offset + 5 + n * 3:offset + 8 + n * 3]) for n in range(0, count)]
+            formats[header & 0x0F] = (number, [f[0] for f in fields],
+                                      struct.Struct("<" + "".join(BASE_TYPES[f[2]] for f in fields)))
+            offset += 5 + count * 3
+            definitions += 1
+        else:
+            number, nums, fmt = formats[header & 0x0F]
+            messages.append((number, dict(zip(nums, fmt.unpack(data[offset:offset + fmt.size])))))
+            offset += fmt.size
+    return messages, definitions
+
+# CRC-16/ARC check value
+assert antfs.crc16("123456789") == 0xBB3D
+
+history = emulator.history(runs=2, wpts_per_lap=20)
+history[1].laps[1].wpts[5].lat = history[1].laps[1].wpts[5].lon = 2**31 - 1
+stream = emulator.Garmin(history)
+stream.device_id = 1234567
+dev = garmin.Device(stream)
+runs = garmin.extract_runs(dev, dev.get_runs())
+run = runs[1]
+run.sport_type = 0
+run.alt[3] = float("nan")
+run.heart_rate[4] = 0
+run.cadence[2] = 88
+
+out = StringIO.StringIO()
+fit.write_activity(out, dev, run)
+messages, definitions = read_fit(out.getvalue())
+# one definition per message type, reused
+assert definitions == 6
+assert [m[0] for m in messages] == [0, 21] + ([20] * 20 + [19]) * 3 + [21, 18, 34]
+file_id = messages[0][1]
+assert file_id[0] == fit.FILE_ACTIVITY and file_id[3] == 1234567 and file_id[4] == run.start_time.time
+
+records = [m[1] for m in messages if m[0] == 20]
+assert len(records) == len(run)
+for n, record in enumerate(records):
+    point = run.point(n)
+    assert record[253] == point.time
+    if point.valid:
+        assert (record[0], record[1]) == (run.lat[n], run.lon[n])
+    else:
+        assert record[0] == record[1] == 0x7FFFFFFF
+    assert record[2] == (0xFFFF if point.alt is None else int(round((point.alt + 500) * 5)))
+    assert record[3] == (point.heart_rate or 0xFF)
+    assert record[4] == (0xFF if point.cadence is None else point.cadence)
+    assert record[5] == int(round(point.distance * 100))
+assert records[3][2] == 0xFFFF and records[4][3] == 0xFF and records[2][4] == 88
+
+laps = [m[1] for m in messages if m[0] == 19]
+for lap_num, (lap, expected) in enumerate(zip(laps, run.laps)):
+    assert lap[254] == lap_num and lap[2] == expected.start_time.time
+    assert lap[8] == expected.total_time * 10 and lap[9] == int(round(expected.total_dist * 100))
+    assert lap[25] == 1
+session = messages[-2][1]
+assert session[26] == 3 and session[8] == sum(l.total_time for l in run.laps) * 10
+assert session[2] == run.start_time.time and session[253] >= run.time[-1]
+
+# plugin, publishes "fit"
+dir = tempfile.mkdtemp()
+try:
+    raw_file_name = emulator.save_raw(os.path.join(dir, "runs.raw"), history)
+    recorder = emulator.Recorder()
+    plugin._plugins[:] = [recorder]
+    p = fit.FitPlugin()
+    p.fit_output_dir = os.path.join(dir, "%(device_id)s")
+    p.manifest = os.path.join(dir, "manifest.db")
+    assert p.data_available(1, "tcx", ["x.tcx"]) == ["x.tcx"]
+    assert p.data_available(1, "raw", [raw_file_name]) == [raw_file_name]
+    ((device_sn, format, files),) = recorder.published
+    assert format == "fit" and len(files) == 2
+    assert [os.path.dirname(f) for f in files] == [os.path.join(dir, "0x1")] * 2
+    with open(files[0]) as file:
+        messages, definitions = read_fit(file.read())
+    assert len([m for m in messages if m[0] == 20]) == 60
+    # already exported
+    del recorder.published[:]
+    assert p.data_available(1, "raw", [raw_file_name]) == [raw_file_name]
+    assert recorder.published == [(1, "fit", [])]
+finally:
+    plugin._plugins[:] = []
+    shutil.rmtree(dir)
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et
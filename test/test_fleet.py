@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+import sys
+import time
+import logging
+
+import antd.antfs as antfs
+import antd.fleet as fleet
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+watches = [emulator.Watch(device_number=n, device_id=n) for n in range(1, 6)]
+keys = antfs.DeviceDb()
+for watch in watches:
+    keys.add_key(watch.device_id, watch.key)
+    keys.add_device_id(watch.device_number, watch.device_id)
+session = emulator.Session(watches)
+host = antfs.Host(session, keys)
+scheduler = fleet.SyncScheduler(host)
+
+# scan finds every paired device in range
+beacons = host.scan(scan_timeout=5)
+assert sorted(b.device_id for b in beacons) == [1, 2, 3, 4, 5]
+
+# every device is eventually synced, the most recently
+# synced device is never chosen ahead of one still waiting
+now = time.time()
+keys.set_meta(3, last_sync=now - 60)
+keys.set_meta(4, last_sync=now - 3600)
+synced = []
+for n in range(0, 5):
+    beacon = scheduler.next_device()
+    assert beacon and host.device_id == scheduler.device_id
+    synced.append(host.device_id)
+    latency = scheduler.success()
+    assert latency >= 0 and keys.get_meta(synced[-1], "sync_latency") == latency
+assert sorted(synced) == [1, 2, 3, 4, 5]
+assert synced[-2:] == [4, 3]
+
+# link lost mid download, a resumed download is recorded
+# against the same device once reconnected
+assert scheduler.next_device(include_devices_with_no_data=True)
+device_id = scheduler.device_id
+host.link()
+host.auth(pair=False)
+scheduler.failure()
+assert keys.get_meta(device_id, "failed_count") == 1
+session.reset_system()
+assert host.reconnect() and host.device_id == device_id
+scheduler.success()
+assert keys.get_device_ids() == [1, 2, 3, 4, 5]
+assert keys.get_meta(device_id, "failed_count") == 0
+assert keys.get_meta(device_id, "attempt_count") == 0
+try: keys.set_meta(None, last_sync=now)
+except ValueError: pass
+else: assert False
+
+# devices which keep failing are tried less often, and not
+# more than max_attempts times per window
+scheduler.max_attempts = 2
+watches[0].data_available = False
+for watch in watches[2:]: watch.data_available = False
+assert scheduler.next_device() and scheduler.device_id == 2
+scheduler.failure()
+assert keys.get_meta(2, "failed_count") == 1
+assert scheduler.next_device() and scheduler.device_id == 2
+scheduler.failure()
+assert scheduler.next_device() is None
+
+report = dict((r[0], r[1:]) for r in scheduler.report())
+assert report[2][2] == 2 and report[1][2] == 0
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et
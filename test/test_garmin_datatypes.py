@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+import sys
+import logging
+import struct
+
+import antd.garmin as garmin
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+# adjacent formats and fixed size nested types are merged into one struct
+layout = garmin.D304.compiled_layout()
+assert len(layout) == 1 and layout[0][0].format == "<iiIffBBB"
+assert len(garmin.D1015.compiled_layout()) == 1
+# D304's posn and time are fixed size, and unpacked in place
+assert garmin.PositionType.is_fixed_size() and not garmin.D1018.is_fixed_size()
+assert [s[:2] + s[3:] for s in layout[0][1]] == [
+        (garmin.PositionType, "posn", 0, 2, 0), (garmin.TimeType, "time", 2, 3, 8),
+        (None, None, 3, 8, 12)]
+# a variable size nested type is parsed on its own
+assert (garmin.D1008, "workout") in garmin.D1009.compiled_layout()
+assert garmin.value_offsets("<HxI") == [0, 3] and garmin.value_offsets("<2B16sb") == [0, 1, 2, 18]
+
+# waypoint array decoded in place
+wpts = emulator.history(runs=1, laps_per_run=1, wpts_per_lap=50)[0].laps[0].wpts
+data = struct.pack("<I", len(wpts)) + "".join(w.pack() + "\x00" for w in wpts)
+d1018 = garmin.D1018(data)
+assert d1018.num_valid_wpt == 50 and d1018.unparsed == ""
+for wpt, expected in zip(d1018.wpts, wpts):
+    assert wpt.time.time == expected.time
+    assert wpt.posn.lat == expected.lat and wpt.posn.valid
+    assert abs(wpt.distance - expected.distance) < .01
+    assert wpt.cadence is None and wpt.heart_rate == 150
+    assert wpt.posn.unparsed == "" and wpt.unparsed == ""
+
+# sentinels
+wpt = garmin.D304(struct.pack("<iiI", 2**31 - 1, 2**31 - 1, 0) + "\x51\x59\x04\x69" * 2 + "\x00\xff\x00")
+assert not wpt.posn.valid and wpt.alt is None and wpt.distance is None
+assert wpt.heart_rate is None and wpt.cadence is None
+
+# numpy and pure python decoders agree, including sentinels
+if garmin.numpy is not None:
+    invalid = [struct.pack("<iiI", 2**31 - 1, 2**31 - 1, 5) + "\x51\x59\x04\x69" * 2 + "\x00\xff\x00\x00",
+               struct.pack("<iiIff", -2**30, 2**30, 6, -12.5, 1e6) + "\xff\x00\x01\x00"]
+    data = struct.pack("<I", len(wpts) + 2) + "".join(w.pack() + "\x00" for w in wpts) + "".join(invalid)
+    garmin.D1018.use_numpy = False
+    expected = garmin.D1018("xx" + data, 2)
+    garmin.D1018.use_numpy = True
+    actual = garmin.D1018("xx" + data, 2)
+    assert actual.array["valid"].sum() == len(wpts) + 1
+    assert str(actual) == str(expected)
+    for a, e in zip(actual.wpts, expected.wpts):
+        assert a.posn.__dict__ == e.posn.__dict__ and a.time.__dict__ == e.time.__dict__
+        assert (dict((k, v) for k, v in a.__dict__.items() if k not in ("posn", "time"))
+                == dict((k, v) for k, v in e.__dict__.items() if k not in ("posn", "time")))
+
+    # last waypoint without its alignment byte
+    garmin.D1018.use_numpy = False
+    expected = garmin.D1018(data[:-1])
+    garmin.D1018.use_numpy = True
+    actual = garmin.D1018(data[:-1])
+    assert len(actual.wpts) == len(wpts) + 2 and str(actual) == str(expected)
+
+# packets are decoded on first use, except fields needed for progress
+lazy = garmin.D1018.decode(data)
+assert isinstance(lazy, garmin.LazyDataType) and lazy.raw is data
+assert lazy.num_valid_wpt == struct.unpack("<I", data[:4])[0]
+assert isinstance(lazy, garmin.LazyDataType)
+assert lazy.wpts[0].time.time == wpts[0].time
+assert isinstance(lazy, garmin.D1018) and str(lazy) == str(garmin.D1018(data))
+assert isinstance(garmin.RecordsType.decode("\x01\x00"), garmin.RecordsType)
+assert str(garmin.D311.decode("\x05\x00")) == "D311[('index', 5)]"
+
+# trailing data is reported as unparsed
+expected = emulator.history(runs=1, laps_per_run=1)[0].laps[0]
+lap = garmin.D1011(expected.pack())
+assert lap.unparsed == "\x00" * 5 and "unparsed=0000000000" in str(lap)
+assert lap.end.lat == expected.wpts[-1].lat and lap.avg_cadence is None
+
+run = garmin.D1009(emulator.history(runs=1)[0].pack())
+assert run.workout.num_valid_steps == 0 and run.workout.name == "" and run.unparsed == ""
+assert "workout" in run.str_args
+
+step = struct.pack("<16sffHBBBB2x", "warmup", 0, 0, 600, 1, 0, 0, 0)
+workout = garmin.D1008(struct.pack("<I", 1) + step + struct.pack("<16sb", "easy", 1))
+assert workout.steps[0].custom_name == "warmup" and workout.steps[0].duration_value == 600
+assert workout.name == "easy" and workout.unparsed == ""
+
+product = garmin.ProductDataType(struct.pack("<Hh", 1018, 280) + "Forerunner 405\x00Software\x00")
+assert product.description == ["Forerunner 405", "Software"]
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+
+import sys
+import logging
+import tempfile
+
+import antd.garmin as garmin
+import antd.tcx as tcx
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+def download(since=None, **kwds):
+    stream = emulator.Garmin(emulator.history(runs=10))
+    for k, v in kwds.items(): setattr(stream, k, v)
+    dev = garmin.Device(stream)
+    stream.packets_sent = 0
+    runs = dev.get_runs(since)
+    return dev, stream, runs
+
+# full download
+dev, stream, runs = download()
+full = stream.packets_sent
+assert len(garmin.extract_runs(dev, runs)) == 10
+since = garmin.newest_run_time(dev, runs)
+assert since == emulator.history(runs=10)[-1].laps[-1].start_time
+
+# nothing new, tracks are not requested
+dev, stream, runs = download(since)
+assert garmin.A010.CMND_TRANSFER_TRK not in stream.commands
+assert len(runs) == 3 and garmin.extract_runs(dev, runs) == []
+_LOG.info("full=%d packets, incremental=%d packets", full, stream.packets_sent)
+assert stream.packets_sent < full / 4
+
+# two new runs, sent newest first, transfer aborted after them
+since = emulator.history(runs=10)[7].laps[0].start_time
+dev, stream, runs = download(since, newest_first=True)
+assert stream.commands[-1] == garmin.A010.CMND_ABORT_TRANSFER
+new_runs = garmin.extract_runs(dev, runs)
+assert [r.run.track_index for r in new_runs] == [8, 9]
+assert all(len(r) == 300 for r in new_runs)
+assert garmin.newest_run_time(dev, runs) > since
+
+# oldest first, nothing to skip, whole track transfer is read
+dev, stream, runs = download(since)
+assert garmin.A010.CMND_ABORT_TRANSFER not in stream.commands
+assert len(garmin.extract_runs(dev, runs)) == 10
+
+# run without a track, exported (laps only) from a full download
+dev, stream, runs = download(missing_tracks=(3,))
+all_runs = garmin.extract_runs(dev, runs)
+assert [r.run.track_index for r in all_runs] == range(0, 10)
+assert len(all_runs[3]) == 0 and len(all_runs[3].laps) == 3
+raw = tempfile.NamedTemporaryFile(suffix=".raw")
+garmin.dump(raw, dev.product_data)
+garmin.dump(raw, runs)
+raw.flush()
+with garmin.RawFile(raw.name) as host:
+    assert host.tracks_complete()
+assert [r[0] for r in tcx.list_runs(raw.name)] == range(0, 10)
+# but not from an incremental download
+since = emulator.history(runs=10)[7].laps[0].start_time
+dev, stream, runs = download(since, newest_first=True, missing_tracks=(3,))
+assert [r.run.track_index for r in garmin.extract_runs(dev, runs)] == [8, 9]
+raw = tempfile.NamedTemporaryFile(suffix=".raw")
+garmin.dump(raw, dev.product_data)
+garmin.dump(raw, runs)
+raw.flush()
+with garmin.RawFile(raw.name) as host:
+    assert not host.tracks_complete()
+assert [r[0] for r in tcx.list_runs(raw.name)] == [8, 9]
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+import sys
+import os
+import time
+import shutil
+import logging
+import tempfile
+
+import antd.garmin as garmin
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+def save_raw(file_name, since=None):
+    dev = garmin.Device(emulator.Garmin(emulator.history(runs=5)))
+    runs = dev.get_runs(since)
+    with open(file_name, "w") as file:
+        garmin.dump(file, dev.product_data)
+        garmin.dump(file, runs)
+    return dev, runs
+
+dir = tempfile.mkdtemp()
+try:
+    raw_file_name = os.path.join(dir, "full.raw")
+    dev, runs = save_raw(raw_file_name)
+
+    with garmin.RawFile(raw_file_name) as raw:
+        # product data, runs, laps, tracks
+        assert len(raw.index.sections) == 4
+        assert os.path.isfile(raw_file_name + ".idx")
+        assert [r.raw for r in raw.records(garmin.L001.PID_RUN)] == [r.data.raw for r in runs[0].by_pid[garmin.L001.PID_RUN]]
+        laps = raw.records(garmin.L001.PID_LAP)
+        assert len(laps) == 15 and laps[3].index == 3 and laps[3].start_time.time
+        for run in raw.records(garmin.L001.PID_RUN):
+            track = raw.track(run.track_index)
+            expected = list(garmin.extract_trk_pkts(dev, runs[2], run.track_index))
+            assert [p[2].raw for p in track[1:]] == [p.data.raw for p in expected]
+            assert track[0][2].index == run.track_index
+        assert raw.track(99) == []
+        # index is independent of replay
+        replay = garmin.Device(raw)
+        assert len(garmin.extract_runs(replay, replay.get_runs())) == 5
+
+    # saved index is used, and rebuilt if raw file changed
+    index = garmin.RawIndex.load(raw_file_name)
+    assert index.entries == garmin.RawIndex.build(open(raw_file_name).read()).entries
+    with open(raw_file_name + ".idx", "w") as file: file.write("junk")
+    assert garmin.RawIndex.load(raw_file_name).entries == index.entries
+    with open(raw_file_name, "a") as file: file.write("\x00" * 4)
+    assert len(garmin.RawIndex.load(raw_file_name).sections) == 5
+
+    # incremental download, nothing new, no track section
+    raw_file_name = os.path.join(dir, "incremental.raw")
+    save_raw(raw_file_name, since=garmin.newest_run_time(dev, runs))
+    with garmin.RawFile(raw_file_name) as raw:
+        assert not raw.index.offsets(garmin.L001.PID_TRK_HDR) and len(raw.records(garmin.L001.PID_RUN)) == 5
+        assert raw.track(0) == []
+
+    # listing runs of many archived files
+    logging.getLogger("antd.garmin").setLevel(logging.WARNING)
+    for n in range(0, 100): shutil.copy(os.path.join(dir, "full.raw"), os.path.join(dir, "%03d.raw" % n))
+    start = time.time()
+    for n in range(0, 100):
+        with garmin.RawFile(os.path.join(dir, "%03d.raw" % n)) as raw:
+            assert len(raw.records(garmin.L001.PID_RUN)) == 5
+    _LOG.info("Listed runs of 100 files, %0.2fms per file.", (time.time() - start) * 10)
+finally:
+    shutil.rmtree(dir)
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et
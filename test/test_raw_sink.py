@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+import sys
+import logging
+import tempfile
+import StringIO
+
+import antd.garmin as garmin
+import antd.ant as ant
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+class FlakyGarmin(emulator.Garmin):
+    """
+    Link is lost after fail_after reads.
+    """
+
+    fail_after = None
+
+    def read(self):
+        if self.fail_after is not None:
+            if not self.fail_after: raise ant.AntError("Link lost.")
+            self.fail_after -= 1
+        return super(FlakyGarmin, self).read()
+
+def download(dev, sink_file):
+    sink = garmin.RawSink(sink_file)
+    try:
+        return dev.get_runs(sink=sink)
+    finally:
+        sink.close()
+
+history = emulator.history(runs=4)
+
+# streamed file is identical to dump of result
+stream = FlakyGarmin(history)
+dev = garmin.Device(stream)
+expected = StringIO.StringIO()
+streamed = tempfile.TemporaryFile()
+runs = download(dev, streamed)
+garmin.dump(expected, runs)
+streamed.seek(0)
+assert streamed.read() == expected.getvalue()
+
+# link lost during track download, partial reply discarded
+stream = FlakyGarmin(history)
+dev = garmin.Device(stream)
+stream.fail_after = 20
+partial = tempfile.TemporaryFile()
+try:
+    download(dev, partial)
+    assert False
+except ant.AntError:
+    pass
+partial.seek(0)
+raw = partial.read()
+assert 0 < len(raw) < len(expected.getvalue())
+assert expected.getvalue().startswith(raw) and raw.endswith("\x00" * 4)
+product_data = StringIO.StringIO()
+garmin.dump(product_data, dev.product_data)
+replay = garmin.Device(garmin.MockHost(product_data.getvalue() + raw))
+assert len(replay.get_runs()[0].by_pid[garmin.L001.PID_RUN]) == 4
+
+# resumed download written to a new file is complete
+stream.fail_after = None
+resumed = tempfile.TemporaryFile()
+download(dev, resumed)
+resumed.seek(0)
+assert resumed.read() == expected.getvalue()
+
+# mmap'd replay of the saved file
+saved = tempfile.NamedTemporaryFile(suffix=".raw")
+saved.write(product_data.getvalue() + expected.getvalue())
+saved.flush()
+with garmin.RawFile(saved.name) as host:
+    replay = garmin.Device(host)
+    assert len(garmin.extract_runs(replay, replay.get_runs())) == 4
+    assert host.read() == ""
+with garmin.RawFile(saved.name) as host:
+    assert list(host.reader) == list(garmin.MockHost(open(saved.name).read()).reader)
+empty = tempfile.NamedTemporaryFile(suffix=".raw")
+with garmin.RawFile(empty.name) as host:
+    assert host.read() == ""
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et
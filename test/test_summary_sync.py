@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+import sys
+import os
+import shutil
+import logging
+import tempfile
+import StringIO
+
+import antd.ant as ant
+import antd.garmin as garmin
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+history = emulator.history(runs=10)
+
+# full download, for reference
+stream = emulator.Garmin(history)
+dev = garmin.Device(stream)
+stream.air_time = 0
+full = dev.get_runs()
+full_time = stream.air_time
+
+dir = tempfile.mkdtemp()
+try:
+    raw_file_name = os.path.join(dir, "summary.raw")
+    stream = emulator.Garmin(history)
+    dev = garmin.Device(stream)
+    stream.air_time = 0
+    with open(raw_file_name, "w") as file:
+        garmin.dump(file, dev.product_data)
+        sink = garmin.RawSink(file)
+        # runs and laps only
+        runs = dev.get_runs(sink=sink, tracks=False)
+        assert garmin.A010.CMND_TRANSFER_TRK not in stream.commands
+        assert garmin.extract_runs(dev, runs) == []
+        summary_time = stream.air_time
+        sink.flush()
+        with garmin.RawFile(raw_file_name) as raw:
+            assert len(raw.records(garmin.L001.PID_RUN)) == 10
+            assert len(raw.records(garmin.L001.PID_LAP)) == 30
+        # then tracks
+        assert dev.get_tracks(runs, sink=sink) is runs
+        sink.close()
+    _LOG.info("summary=%0.1fs, full=%0.1fs", summary_time, full_time)
+    assert summary_time < full_time / 4
+    assert len(garmin.extract_runs(dev, runs)) == 10
+    # raw file is the same as a full download
+    with garmin.RawFile(raw_file_name) as raw:
+        replay = garmin.Device(raw)
+        assert [p[2] and p[2].raw for p in replay.get_runs()[2]] == [p[2] and p[2].raw for p in full[2]]
+finally:
+    shutil.rmtree(dir)
+
+# link lost during track download, resume replays
+# runs and laps rather than downloading them again
+class FlakyGarmin(emulator.Garmin):
+    fail_after = None
+    def read(self):
+        if self.fail_after is not None:
+            if not self.fail_after: raise ant.AntError("Link lost.")
+            self.fail_after -= 1
+        return super(FlakyGarmin, self).read()
+
+stream = FlakyGarmin(history)
+dev = garmin.Device(stream)
+runs = dev.get_runs(tracks=False)
+stream.fail_after = 20
+try:
+    dev.get_tracks(runs)
+    assert False
+except ant.AntError:
+    pass
+stream.fail_after = None
+commands = len(stream.commands)
+resumed = tempfile.TemporaryFile()
+sink = garmin.RawSink(resumed)
+runs = dev.get_runs(sink=sink, tracks=False)
+assert len(stream.commands) == commands
+dev.get_tracks(runs, sink=sink)
+sink.close()
+assert stream.commands[commands:] == [garmin.A010.CMND_TRANSFER_TRK]
+assert not dev.checkpoints
+assert len(garmin.extract_runs(dev, runs)) == 10
+expected = StringIO.StringIO()
+garmin.dump(expected, full)
+resumed.seek(0)
+assert resumed.read() == expected.getvalue()
+
+# incremental, only new tracks are requested
+since = history[7].laps[-1].start_time
+stream = emulator.Garmin(history)
+stream.newest_first = True
+dev = garmin.Device(stream)
+runs = dev.get_runs(since=since, tracks=False)
+dev.get_tracks(runs)
+assert [a.run.track_index for a in garmin.extract_runs(dev, runs)] == [8, 9]
+
+# nothing new, tracks aren't requested
+stream = emulator.Garmin(history)
+dev = garmin.Device(stream)
+runs = dev.get_runs(since=history[-1].laps[-1].start_time, tracks=False)
+dev.get_tracks(runs)
+assert garmin.A010.CMND_TRANSFER_TRK not in stream.commands
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+import sys
+import os
+import shutil
+import logging
+import tempfile
+
+import antd.garmin as garmin
+import antd.plugin as plugin
+import antd.tcx as tcx
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+def activities(file_name):
+    with open(file_name) as file:
+        return file.read().count("<Activity ")
+
+# batches are consecutive, bounded by runs and points
+runs = [(n, n, "", points) for n, points in enumerate([10, 20, 30, 100, 5, 5])]
+split = lambda max_runs, max_points: [[r[0] for r in b] for b in tcx.split_batches(runs, max_runs, max_points)]
+assert split(1, 0) == [[0], [1], [2], [3], [4], [5]]
+assert split(0, 0) == [[0, 1, 2, 3, 4, 5]]
+assert split(4, 0) == [[0, 1, 2, 3], [4, 5]]
+assert split(0, 60) == [[0, 1, 2], [3], [4, 5]]
+assert split(2, 60) == [[0, 1], [2], [3], [4, 5]]
+assert tcx.split_batches([], 0, 0) == []
+
+dir = tempfile.mkdtemp()
+try:
+    history = emulator.history(runs=5, wpts_per_lap=10)
+    first = emulator.save_raw(os.path.join(dir, "first.raw"), history[0:4])
+    second = emulator.save_raw(os.path.join(dir, "second.raw"), history)
+    assert [r[3] for r in tcx.list_runs(first)] == [30] * 4
+
+    recorder = emulator.Recorder()
+    plugin._plugins[:] = [recorder]
+    output = {}
+    for workers in (1, 2):
+        for batch_runs, batch_points, expected in [(0, 0, [4]), (3, 0, [3, 1]), (0, 60, [2, 2])]:
+            p = tcx.TcxPlugin()
+            p.workers = workers
+            p.batch_runs, p.batch_points = batch_runs, batch_points
+            p.tcx_output_dir = os.path.join(dir, "tcx-%d-%d-%d" % (workers, batch_runs, batch_points))
+            del recorder.published[:]
+            assert p.data_available(1, "raw", [first]) == [first]
+            assert [activities(f) for f in recorder.files()] == expected
+            output[workers, batch_runs, batch_points] = [open(f).read() for f in recorder.files()]
+            assert output[workers, batch_runs, batch_points] == output[1, batch_runs, batch_points]
+
+    # combined document is the same as create_document of the runs
+    with garmin.RawFile(first) as host:
+        host.device_id = 1
+        dev = garmin.Device(host)
+        expected = tcx.etree.tostring(tcx.create_document(dev, garmin.extract_runs(dev, dev.get_runs())),
+                                      pretty_print=True, xml_declaration=True, encoding="UTF-8")
+    assert output[1, 0, 0] == [expected]
+    # named by first and last run, (0, 60) was the last batching
+    assert [os.path.basename(f) for f in recorder.files()] == [
+            "20090104-104000-20090105-104000.tcx", "20090106-104000-20090107-104000.tcx"]
+
+    # with manifest, only new runs are batched
+    p = tcx.TcxPlugin()
+    p.batch_runs = 0
+    p.tcx_output_dir = os.path.join(dir, "manifest")
+    p.manifest = os.path.join(dir, "manifest", "tcx.db")
+    del recorder.published[:]
+    assert p.data_available(1, "raw", [first]) == [first]
+    assert [activities(f) for f in recorder.files()] == [4]
+    manifest = tcx.Manifest(p.manifest)
+    assert set(manifest.get(r[1])[1] for r in tcx.list_runs(first)) == set(recorder.files())
+    manifest.close()
+    del recorder.published[:]
+    assert p.data_available(1, "raw", [second]) == [second]
+    assert [activities(f) for f in recorder.files()] == [1]
+    del recorder.published[:]
+    assert p.data_available(1, "raw", [first, second]) == [first, second]
+    assert recorder.files() == []
+finally:
+    plugin._plugins[:] = []
+    shutil.rmtree(dir)
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et
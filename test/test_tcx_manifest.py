@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+import sys
+import os
+import shutil
+import logging
+import tempfile
+
+import antd.plugin as plugin
+import antd.tcx as tcx
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+dir = tempfile.mkdtemp()
+try:
+    history = emulator.history(runs=4)
+    first = emulator.save_raw(os.path.join(dir, "first.raw"), history[0:3])
+    copy = emulator.save_raw(os.path.join(dir, "copy.raw"), history[0:3])
+    second = emulator.save_raw(os.path.join(dir, "second.raw"), history)
+    # same runs, first has a different track point
+    history[0].laps[0].wpts[10].distance += 1
+    changed = emulator.save_raw(os.path.join(dir, "changed.raw"), history)
+
+    runs = tcx.list_runs(first)
+    assert [r[0] for r in runs] == [0, 1, 2]
+    assert runs == tcx.list_runs(copy) == tcx.list_runs(second)[0:3]
+    changed_runs = tcx.list_runs(changed)
+    assert changed_runs[0][1] == runs[0][1] and changed_runs[0][2] != runs[0][2]
+    assert changed_runs[1:3] == runs[1:3]
+
+    recorder = emulator.Recorder()
+    plugin._plugins[:] = [recorder]
+    for workers in (1, 2):
+        p = tcx.TcxPlugin()
+        p.workers = workers
+        p.tcx_output_dir = os.path.join(dir, "tcx-%d" % workers)
+        p.manifest = os.path.join(dir, "manifest-%d", "tcx.db") % workers
+
+        def export(*files):
+            del recorder.published[:]
+            assert p.data_available(1, "raw", list(files)) == list(files)
+            return [os.path.basename(f) for f in recorder.files()]
+
+        # runs of copy are exported once
+        all = export(first, copy)
+        assert len(all) == 3
+        assert export(first) == []
+        new = export(second)
+        assert len(new) == 1 and new[0] not in all
+        manifest = tcx.Manifest(p.manifest)
+        assert manifest.get(runs[0][1]) == (runs[0][2], os.path.join(p.tcx_output_dir, all[0]))
+        manifest.close()
+        assert export(second) == []
+        # only the run which changed is exported again
+        assert export(changed) == all[0:1]
+        assert export(changed) == []
+        # without manifest, every run
+        p.manifest = None
+        assert len(export(first)) == 3
+finally:
+    plugin._plugins[:] = []
+    shutil.rmtree(dir)
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et
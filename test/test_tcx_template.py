@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+import sys
+import os
+import time
+import shutil
+import logging
+import tempfile
+import StringIO
+
+import antd.garmin as garmin
+import antd.tcx as tcx
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+# golden files are lxml output, run with --update to regenerate
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+
+history = emulator.history(runs=3, wpts_per_lap=8)
+# missing position
+history[1].laps[1].wpts[5].lat = history[1].laps[1].wpts[5].lon = 2**31 - 1
+stream = emulator.Garmin(history)
+stream.device_id = 1
+dev = garmin.Device(stream)
+dev.device_id.description = ["Forerunner <405> & co"]
+runs = garmin.extract_runs(dev, dev.get_runs())
+# running, with extensions
+runs[1].sport_type = 0
+for lap in runs[1].laps: lap.avg_cadence = 80
+for n in range(0, len(runs[1])): runs[1].cadence[n] = 85
+runs[1].cadence[3] = 0xFF
+# biking, lap without track points, missing values
+runs[2].lap_start[2] = len(runs[2])
+for n in range(0, len(runs[2])): runs[2].cadence[n] = 70
+runs[2].alt[3] = runs[2].distance[4] = float("nan")
+runs[2].heart_rate[5] = 0
+
+cases = {
+    "running": [runs[1]],
+    "missing": [runs[2]],
+    "all": runs,
+    "empty": [],
+}
+
+def template(runs, pretty_print):
+    out = StringIO.StringIO()
+    tcx.write_template(out, dev, runs, pretty_print)
+    return out.getvalue()
+
+def streamed(runs):
+    out = StringIO.StringIO()
+    tcx.write_document(out, dev, runs)
+    return out.getvalue()
+
+def tree(runs, pretty_print):
+    return tcx.etree.tostring(tcx.create_document(dev, runs), pretty_print=pretty_print, xml_declaration=True, encoding="UTF-8")
+
+for name, case in sorted(cases.items()):
+    for pretty_print in (True, False):
+        file_name = os.path.join(GOLDEN, name + (".tcx" if pretty_print else "-compact.tcx"))
+        if "--update" in sys.argv:
+            with open(file_name, "w") as file: file.write(tree(case, pretty_print))
+        with open(file_name) as file: golden = file.read()
+        assert tree(case, pretty_print) == golden, file_name
+        assert template(case, pretty_print) == golden, file_name
+        if pretty_print: assert streamed(case) == golden, file_name
+
+# time formatting, across minute, day and year boundaries, and backwards
+format = tcx.TimeFormat()
+for t in [0, 1, 59, 60, 61, 3599, 3600, 86399, 86400, 30, 10**8, 10**8 - 1, 2**32 - 1, 0]:
+    assert format(t) == tcx.format_time(time.gmtime(garmin.TimeType.EPOCH + t)), t
+
+# export_tcx with either serializer
+dir = tempfile.mkdtemp()
+try:
+    raw_file_name = os.path.join(dir, "runs.raw")
+    dev = garmin.Device(emulator.Garmin(emulator.history(runs=2)))
+    with open(raw_file_name, "w") as file:
+        garmin.dump(file, dev.product_data)
+        garmin.dump(file, dev.get_runs())
+    output = {}
+    for serializer in ("lxml", "template"):
+        for pretty_print in (True, False):
+            out = os.path.join(dir, "%s-%s" % (serializer, pretty_print))
+            os.mkdir(out)
+            files = tcx.export_tcx(1, raw_file_name, out, serializer=serializer, pretty_print=pretty_print)
+            assert len(files) == 2
+            output[serializer, pretty_print] = [open(f).read() for f in files]
+    assert output["lxml", True] == output["template", True]
+    assert output["lxml", False] == output["template", False]
+    try:
+        tcx.export_tcx(1, raw_file_name, dir, serializer="xslt")
+        assert False
+    except ValueError: pass
+finally:
+    shutil.rmtree(dir)
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et
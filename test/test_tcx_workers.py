@@ -0,0 +1,68 @@
+#!/usr/bin/python
+
+import sys
+import os
+import shutil
+import logging
+import tempfile
+
+import antd.plugin as plugin
+import antd.tcx as tcx
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+dir = tempfile.mkdtemp()
+try:
+    raw_files = [os.path.join(dir, "%d.raw" % n) for n in range(0, 3)]
+    emulator.save_raw(raw_files[0], emulator.history(runs=3, start_time=600000000))
+    emulator.save_raw(raw_files[1], emulator.history(runs=0))
+    emulator.save_raw(raw_files[2], emulator.history(runs=2, start_time=700000000))
+    broken = os.path.join(dir, "broken.raw")
+    with open(raw_files[0]) as file: data = file.read()
+    with open(broken, "w") as file: file.write(data[:len(data) / 2])
+
+    assert [r[0] for r in tcx.list_runs(raw_files[0])] == [0, 1, 2]
+    assert tcx.list_runs(raw_files[1]) == []
+
+    recorder = emulator.Recorder()
+    plugin._plugins[:] = [recorder]
+    output = {}
+    for workers in (1, 2, 0):
+        p = tcx.TcxPlugin()
+        p.workers = workers
+        p.tcx_output_dir = os.path.join(dir, "tcx-%d" % workers)
+        processed = p.data_available(1, "raw", raw_files + [broken])
+        # broken file is left for retry, all others processed
+        assert processed == raw_files
+        ((device_sn, format, files),) = recorder.published
+        del recorder.published[:]
+        assert device_sn == 1 and format == "tcx" and len(files) == 5
+        # published in order of raw file, then run
+        names = [os.path.basename(f) for f in files]
+        assert names == sorted(names)
+        output[workers] = [open(f).read() for f in files]
+    assert output[1] == output[2] == output[0]
+
+    # queued files are retried in one batch per device and format
+    recorder.cache = os.path.join(dir, "queue.txt")
+    q = plugin.PluginQueue(recorder)
+    q.add_to_queue(1, "raw", raw_files[0:2])
+    q.add_to_queue(2, "raw", raw_files[2:3])
+    q.add_to_queue(1, "raw", [broken])
+    q.save_queue()
+    plugin.recover_and_publish_data(recorder)
+    assert recorder.published == [(1, "raw", raw_files[0:2]), (2, "raw", raw_files[2:3]), (1, "raw", [broken])]
+    assert not os.path.exists(recorder.cache)
+finally:
+    plugin._plugins[:] = []
+    shutil.rmtree(dir)
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et
@@ -0,0 +1,46 @@
+#!/usr/bin/python
+
+import sys
+import logging
+import StringIO
+
+import antd.garmin as garmin
+import antd.tcx as tcx
+import emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+history = emulator.history(runs=4, wpts_per_lap=20)
+# missing position
+history[1].laps[1].wpts[5].lat = history[1].laps[1].wpts[5].lon = 2**31 - 1
+stream = emulator.Garmin(history)
+stream.device_id = 1
+dev = garmin.Device(stream)
+runs = garmin.extract_runs(dev, dev.get_runs())
+# running, with extensions
+runs[1].sport_type = 0
+for lap in runs[1].laps: lap.avg_cadence = 80
+for n in range(0, len(runs[1])): runs[1].cadence[n] = 85
+# lap without track points
+runs[2].lap_start[2] = len(runs[2])
+
+def streamed(runs):
+    out = StringIO.StringIO()
+    tcx.write_document(out, dev, runs)
+    return out.getvalue()
+
+def tree(runs):
+    return tcx.etree.tostring(tcx.create_document(dev, runs), pretty_print=True, xml_declaration=True, encoding="UTF-8")
+
+for case in ([runs[0]], [runs[1]], [runs[2]], runs, []):
+    assert streamed(case) == tree(case)
+assert "<ext:RunCadence>85</ext:RunCadence>" in streamed([runs[1]])
+
+_LOG.info("OK")
+
+# vim: ts=4 sts=4 et